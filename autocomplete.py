@@ -0,0 +1,211 @@
+from bisect import bisect_left
+from collections import Counter
+import re
+import numpy as np
+
+from helper_func import measure_time, LazyAttributes
+import inverted_index
+
+# Purpose: This script defines class PrefixIndex, which completes a prefix
+#          with the most frequent strings that start with it (binary search
+#          in a sorted list), and function get_suggestions, which completes
+#          a partial query typed in the search box with frequent phrases of
+#          the corpus and with the terms of the index vocabulary, most
+#          frequent first (see the /api/suggest route in web_ui.py). A
+#          suggestion takes a few microseconds, so the search box can ask
+#          for one on every keystroke.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+# the phrases suggested: runs of 2 to MAX_PHRASE_WORDS words that occur at
+# least MIN_PHRASE_COUNT times in the corpus
+MAX_PHRASE_WORDS = 5
+MIN_PHRASE_COUNT = 5
+# a word, as a user would type it (e.g. "don't"), and the words and
+# punctuation marks of a document (phrases do not span punctuation marks)
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)*")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)*|[^\sa-z0-9']+")
+# the completions of prefixes up to this length are computed up front, as
+# they are the most frequent and match the most strings
+PRECOMPUTED_PREFIX_LENGTH = 2
+# the largest number of suggestions get_suggestions returns (the prefix 
+# indexes keep as many completions of each prefix)
+MAX_SUGGESTIONS = 20
+
+class PrefixIndex:
+  def __init__(self, freq, num_results = 10):
+    # inputs:
+    #   freq: a dictionary that maps a string to its frequency
+    #   num_results: an integer, the largest number of completions returned
+    self.strings = sorted(freq) # a sorted list of strings
+    # self.freqs: an integer array, the frequency of each string
+    self.freqs = np.array([freq[string] for string in self.strings],
+                          dtype = np.int64)
+    self.num_results = num_results
+    # self.precomputed: a dictionary that maps a short prefix to its
+    # completions
+    self.precomputed = dict()
+    for prefix in set(string[:length] for string in self.strings
+                      for length in range(1, PRECOMPUTED_PREFIX_LENGTH + 1)):
+      self.precomputed[prefix] = self.search(prefix)
+
+  def __len__(self):
+    return(len(self.strings))
+
+  def search(self, prefix):
+    # returns a list of the (at most num_results) most frequent strings
+    # that start with prefix, in descending order of frequency (ties in
+    # alphabetical order)
+    start = bisect_left(self.strings, prefix)
+    end = bisect_left(self.strings, prefix + "\U0010ffff", lo = start)
+    freqs = self.freqs[start:end]
+    if len(freqs) > self.num_results:
+      # only sort the strings at least as frequent as the num_results-th
+      kth = np.partition(freqs, len(freqs) - self.num_results)[
+        len(freqs) - self.num_results
+      ]
+      top = np.flatnonzero(freqs >= kth)
+    else:
+      top = np.arange(len(freqs))
+    top = top[np.argsort(-freqs[top], kind = "stable")][:self.num_results]
+    return([self.strings[start + i] for i in top.tolist()])
+
+  def complete(self, prefix):
+    # see search
+    if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH:
+      return(self.precomputed.get(prefix, []))
+    return(self.search(prefix))
+
+# function: count_phrases -----------------------------------------------------
+@measure_time
+def count_phrases(documents, stop_words, max_words = MAX_PHRASE_WORDS,
+                  min_count = MIN_PHRASE_COUNT):
+  # count the phrases of 2 to max_words words that occur at least min_count
+  # times in the documents; a phrase of n words can only be frequent if its
+  # first and last n - 1 words are frequent phrases, so each pass only 
+  # counts the extensions of the frequent phrases of the previous pass
+  # output: a dictionary that maps a phrase (words separated by a space) to
+  #         its number of occurrences; phrases made of stop words only are
+  #         left out
+
+  # the words and punctuation marks of all documents in one array of token
+  # IDs (with a "." at the end of each document)
+  word_ids = dict()
+  tokens = (token for document in documents for token in 
+            TOKEN_PATTERN.findall(str(document).lower()) + ["."])
+  ids = np.fromiter((word_ids.setdefault(token, len(word_ids)) 
+                     for token in tokens), dtype = np.int64)
+  names = list(word_ids)
+  is_word = np.array([WORD_PATTERN.fullmatch(name) is not None 
+                      for name in names], dtype = bool)
+  counts = np.bincount(ids, minlength = len(names))
+  # phrase_ids[i]: the ID of the frequent phrase of the previous pass that
+  # starts at position i (-1 if there is none), and phrases: the words of
+  # each of those phrases
+  phrase_ids = np.where(is_word[ids] & (counts[ids] >= min_count), ids, -1)
+  phrases = [(name,) for name in names]
+  phrase_freq = dict()
+  for num_words in range(2, max_words + 1):
+    # a phrase of num_words words at position i is identified by its first
+    # and its last num_words - 1 words, i.e. phrase_ids[i] and 
+    # phrase_ids[i + 1]
+    starts = np.flatnonzero((phrase_ids[:-1] >= 0) & (phrase_ids[1:] >= 0))
+    keys, inverse, counts = np.unique(
+      phrase_ids[starts] * len(phrases) + phrase_ids[starts + 1], 
+      return_inverse = True, return_counts = True
+    )
+    frequent = np.flatnonzero(counts >= min_count)
+    if len(frequent) == 0:
+      break
+    new_ids = np.full(len(keys), -1, dtype = np.int64)
+    new_ids[frequent] = np.arange(len(frequent))
+    phrase_ids = np.full(len(phrase_ids) - 1, -1, dtype = np.int64)
+    phrase_ids[starts] = new_ids[inverse.ravel()]
+    phrases = [phrases[key // len(phrases)] + phrases[key % len(phrases)][-1:]
+               for key in keys[frequent].tolist()]
+    for phrase, count in zip(phrases, counts[frequent].tolist()):
+      if not all(word in stop_words for word in phrase):
+        phrase_freq[" ".join(phrase)] = count
+  return(phrase_freq)
+
+# function: load_suggesters ---------------------------------------------------
+def load_suggesters():
+  # build the prefix indexes of the phrases and the terms of the current
+  # index (see inverted_index.indexes); the terms come from its vocabulary,
+  # unless the index is stemmed (stems are not words to suggest)
+  # output: a tuple of the version of the index (see Indexes.version) and 
+  #         the two PrefixIndex objects
+  snapshot = inverted_index.lazy_data.get("indexes")
+  stop_words = set(snapshot.stop_list)
+  phrase_freq = count_phrases(snapshot.documents, stop_words)
+  if snapshot.do_stem:
+    term_freq = Counter(
+      word for document in snapshot.documents
+      for word in WORD_PATTERN.findall(str(document).lower())
+      if word not in stop_words
+    )
+  else:
+    term_freq = snapshot.corpus_term_freq
+  term_freq = {term: freq for term, freq in term_freq.items()
+               if WORD_PATTERN.fullmatch(term) is not None}
+  return(snapshot.version, 
+         PrefixIndex(phrase_freq, num_results = MAX_SUGGESTIONS), 
+         PrefixIndex(term_freq, num_results = MAX_SUGGESTIONS))
+
+# function: get_suggesters ----------------------------------------------------
+def get_suggesters():
+  # returns the two PrefixIndex objects of the current index; they are 
+  # built again (once, by the first caller) when the index has changed 
+  # since they were built (see inverted_index.update_index)
+  version = inverted_index.lazy_data.get("indexes").version
+  suggesters = lazy_data.get("suggesters")
+  if suggesters[0] != version:
+    with lazy_data.lock:
+      if lazy_data.get("suggesters")[0] != version:
+        lazy_data.unload("suggesters")
+      suggesters = lazy_data.get("suggesters")
+  return(suggesters[1:])
+
+# function: get_suggestions ---------------------------------------------------
+def get_suggestions(query, num_results = 8):
+  # complete a partial query: the frequent phrases that start with it, then
+  # the query with its last (partial) word completed by the most frequent
+  # terms that start with it
+  # inputs:
+  #   query: a string, the text typed in the search box
+  #   num_results: an integer, the largest number of suggestions (at most
+  #                MAX_SUGGESTIONS)
+  # output: a list of strings
+  text = " ".join(query.lower().split())
+  # keep the opening quote of a phrase query (see
+  # inverted_index.PHRASE_PATTERN)
+  quote = ""
+  if text.startswith('"'):
+    quote, text = '"', text[1:].lstrip()
+  if text == "":
+    return([])
+  phrases, terms = get_suggesters()
+  if query[-1].isspace():
+    # a finished word: only suggest longer phrases
+    suggestions = phrases.complete(text + " ")
+  else:
+    # a partial word: the phrases (half of the suggestions at most, unless
+    # there are not enough terms), and the completions of the word
+    head, _, last = text.rpartition(" ")
+    phrase_list = phrases.complete(text)
+    suggestions = phrase_list[:(num_results // 2)] + [
+      head + " " + term if head else term for term in terms.complete(last)
+    ] + phrase_list[(num_results // 2):]
+  return([quote + suggestion for suggestion
+          in dict.fromkeys(suggestions)][:num_results])
+
+# -----------------------------------------------------------------------------
+# the data below is loaded when it is first used (e.g. by get_suggestions),
+# or by inverted_index.preload (see helper_func.LazyAttributes)
+#  - suggesters: the version of the index they were built from, and two
+#    PrefixIndex objects, the frequent phrases and the terms of the corpus
+#    (use get_suggesters)
+lazy_data = LazyAttributes(globals(), dict(
+  suggesters = load_suggesters
+))
+__getattr__ = lazy_data.get
@@ -0,0 +1,548 @@
+import time
+import os
+import gc
+import numpy as np
+
+from helper_func import read_dict, save_dict
+from postings import read_index
+
+# Purpose: This script measures the performance of the search engine's
+#          building blocks on the full corpus. Run `python -m benchmark` 
+#          from the project's root folder. That the fast paths give the 
+#          same results as the implementations they replace is tested in
+#          tests/test_search.py (run `python -m pytest`).
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+def get_rss():
+  # returns the resident memory (in MB) of the current process
+  with open("/proc/self/status") as f:
+    for line in f:
+      if line.startswith("VmRSS:"):
+        return(int(line.split()[1]) / 1024)
+  return(float("nan"))
+
+def measure_load(load_func, *args):
+  # returns the loaded object, the load time (in sec) and the increase of
+  # resident memory (in MB) caused by loading the object
+  gc.collect()
+  rss_start = get_rss()
+  time_start = time.time()
+  obj = load_func(*args)
+  time_end = time.time()
+  gc.collect()
+  return(obj, time_end - time_start, get_rss() - rss_start)
+
+# function: compare_index_formats ---------------------------------------------
+def compare_index_formats(indexes):
+  # compare the (doc_id, term) tuple dictionary used by earlier versions
+  # (rebuilt from the postings of the given Indexes object and pickled to a
+  # temporary file, so both formats hold the same corpus) against the 
+  # memory-mapped binary index of the Indexes object, in terms of file 
+  # size, load time and resident memory
+  import tempfile, shutil
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    pickle_path = os.path.join(tmp_dir, "term_to_freq_pos.pkl")
+    save_dict(make_term_to_freq_pos(indexes), pickle_path)
+    gc.collect()
+    for name, load_func, file_path in [
+      ("binary index", read_index, indexes.index_dir),
+      ("term_to_freq_pos", read_dict, pickle_path)
+    ]:
+      obj, load_time, rss = measure_load(load_func, file_path)
+      print("{:<18s} file size {:8.1f} MB | load time {:6.2f} sec | "
+            "resident memory {:8.1f} MB".format(
+              name, get_size(file_path) / 1024**2, load_time, rss
+            ))
+      del obj
+  finally:
+    shutil.rmtree(tmp_dir)
+
+def make_term_to_freq_pos(indexes):
+  # returns the index in the format of earlier versions: a dictionary that
+  # maps a tuple (doc_id, term) to a list [frequency, list of positions]
+  store = indexes.merge_segments().store
+  offsets, doc_ords, freqs, pos_offsets, positions = [
+    np.asarray(arr).tolist() for arr in [
+      store.offsets, store.doc_ords, store.freqs, store.pos_offsets, 
+      store.positions
+    ]
+  ]
+  doc_id = list(indexes.doc_id)
+  term_to_freq_pos = dict()
+  for term_id, term in enumerate(store.terms):
+    for p in range(offsets[term_id], offsets[term_id + 1]):
+      term_to_freq_pos[(doc_id[doc_ords[p]], term)] = [
+        freqs[p], positions[pos_offsets[p]:pos_offsets[p + 1]]
+      ]
+  return(term_to_freq_pos)
+
+def get_size(path):
+  # returns the size (in bytes) of a file, or of all files in a directory
+  if os.path.isdir(path):
+    return(sum(os.path.getsize(os.path.join(path, file_name))
+               for file_name in os.listdir(path)))
+  return(os.path.getsize(path))
+
+# function: compare_scoring_modes ---------------------------------------------
+def compare_scoring_modes(indexes, queries, ranker_params):
+  # score each query with the batch and the scalar scoring functions, and
+  # report the time spent by each mode
+  # inputs:
+  #   indexes: an Indexes object
+  #   queries: a list of strings
+  #   ranker_params: a dictionary that maps ranker name to its parameters
+  for ranker, params in ranker_params.items():
+    elapsed = dict()
+    for batch in [True, False]:
+      time_start = time.time()
+      for query in queries:
+        indexes.score_candidates(query, ranker, batch = batch, **params)
+      elapsed[batch] = time.time() - time_start
+    print("{:<8s} batch {:7.4f} sec | scalar {:7.4f} sec | "
+          "speedup {:5.1f}x".format(
+            ranker, elapsed[True], elapsed[False], 
+            elapsed[False] / max(elapsed[True], 1e-9)
+          ))
+
+# function: compare_top_k_modes -----------------------------------------------
+def compare_top_k_modes(get_retrieval_results, queries, ranker_params,
+                        num_results = 20):
+  # retrieve the top num_results documents of each query with and without 
+  # dynamic pruning, and report the time spent by each mode
+  # inputs:
+  #   get_retrieval_results: the function inverted_index.get_retrieval_results
+  #   queries, ranker_params: see compare_scoring_modes
+  for ranker, params in ranker_params.items():
+    elapsed = dict()
+    for pruning in [True, False]:
+      time_start = time.time()
+      for query in queries:
+        get_retrieval_results(
+          query, ranker, num_results = num_results, pruning = pruning, 
+          use_cache = False, **params
+        )
+      elapsed[pruning] = time.time() - time_start
+    print("{:<8s} pruning {:7.4f} sec | exhaustive {:7.4f} sec".format(
+      ranker, elapsed[True], elapsed[False]
+    ))
+
+# function: compare_batch_queries ---------------------------------------------
+def compare_batch_queries(get_retrieval_results, get_batch_retrieval_results,
+                          queries, ranker_params, num_results = 10, 
+                          num_repeats = 10):
+  # retrieve the results of all queries (repeated num_repeats times, as in a
+  # replayed query log) one query at a time and in one batch, and report
+  # the time spent by each
+  # inputs:
+  #   get_retrieval_results, get_batch_retrieval_results: the functions of
+  #     the same names in inverted_index
+  #   queries, ranker_params: see compare_scoring_modes
+  queries = list(queries) * num_repeats
+  for ranker, params in ranker_params.items():
+    time_start = time.time()
+    for query in queries:
+      get_retrieval_results(
+        query, ranker, num_results = num_results, pruning = False, 
+        use_cache = False, **params
+      )
+    elapsed_single = time.time() - time_start
+    time_start = time.time()
+    get_batch_retrieval_results(
+      queries, ranker, num_results = num_results, **params
+    )
+    elapsed_batch = time.time() - time_start
+    print("{:<8s} {} queries: one at a time {:7.4f} sec | batch {:7.4f} sec"
+          .format(ranker, len(queries), elapsed_single, elapsed_batch))
+
+# function: compare_evaluation ------------------------------------------------
+def compare_evaluation(get_batch_retrieval_results, queries, ranker_params,
+                       num_results = 10):
+  # evaluate the results of each ranker with the vectorized evaluation 
+  # (ranker_evaluation.evaluate_query_result) and query by query with the
+  # original functions, and report the time spent by each
+  from data_prep import uid_to_rowidx
+  from ranker_evaluation import evaluate_query_result, \
+                                evaluate_query_result_per_query
+  import pandas as pd
+  for ranker, params in ranker_params.items():
+    result_lists = get_batch_retrieval_results(
+      queries, ranker, num_results = num_results, **params
+    )
+    query_result = pd.DataFrame(dict(
+      query_id = [q_id for q_id, result_list in enumerate(result_lists)
+                       for _ in result_list],
+      doc_id = [uid_to_rowidx[u_id] for result_list in result_lists
+                                    for u_id in result_list]
+    ))
+    elapsed = dict()
+    for name, evaluate in [("vectorized", evaluate_query_result),
+                           ("per query", evaluate_query_result_per_query)]:
+      time_start = time.time()
+      evaluate(query_result)
+      elapsed[name] = time.time() - time_start
+    print("{:<8s} vectorized {:7.4f} sec | per query {:7.4f} sec".format(
+      ranker, elapsed["vectorized"], elapsed["per query"]
+    ))
+
+# function: compare_snippet_rendering -----------------------------------------
+def compare_snippet_rendering(u_ids, plus_minus = 1):
+  # render the context of the given utterances with ScriptIndex and with 
+  # get_script_with_uid, and report the time per utterance of each
+  from data_prep import script_utterance, script_index, get_script_with_uid
+  for output_format in ["html", "terminal"]:
+    elapsed = dict()
+    for name, render in [
+      ("ScriptIndex", lambda: script_index.render_many(
+        u_ids, plus_minus, output_format
+      )),
+      ("get_script_with_uid", lambda: [get_script_with_uid(
+        script_utterance, u_id, plus_minus, output_format
+      ) for u_id in u_ids])
+    ]:
+      time_start = time.time()
+      render()
+      elapsed[name] = time.time() - time_start
+    print("{:<8s} ScriptIndex {:8.1f} us/hit | get_script_with_uid {:8.1f} "
+          "us/hit".format(
+            output_format, 1e6 * elapsed["ScriptIndex"] / len(u_ids),
+            1e6 * elapsed["get_script_with_uid"] / len(u_ids)
+          ))
+
+# function: compare_episode_rendering -----------------------------------------
+def compare_episode_rendering(u_ids):
+  # render the episode of each utterance with ScriptIndex (uncached and 
+  # cached) and with get_episode_with_uid, and report the time per episode
+  # of each
+  from data_prep import script_utterance, script_index, get_episode_with_uid
+  elapsed = dict()
+  script_index.episode_cache.clear()
+  for name, render in [
+    ("ScriptIndex", script_index.render_episode),
+    ("ScriptIndex (cached)", script_index.render_episode),
+    ("get_episode_with_uid", 
+     lambda u_id: get_episode_with_uid(script_utterance, u_id))
+  ]:
+    time_start = time.time()
+    for u_id in u_ids:
+      render(u_id)
+    elapsed[name] = time.time() - time_start
+  print(" | ".join("{} {:8.1f} us/episode".format(
+    name, 1e6 * elapsed[name] / len(u_ids)
+  ) for name in elapsed))
+
+# function: compare_update_rebuild --------------------------------------------
+def compare_update_rebuild(Indexes, documents, doc_id, speakers, stop_words,
+                           num_new = 500, num_replaced = 100):
+  # report the time it takes to add the last num_new documents to an index
+  # of the other documents and replace num_replaced of them with 
+  # Indexes.update_documents, and to rebuild the index from scratch instead
+  import tempfile, shutil
+  tmp_dir = tempfile.mkdtemp()
+  new_documents = list(documents)
+  replaced = list(range(0, len(documents) - num_new,
+                        max(1, (len(documents) - num_new) // num_replaced)))
+  for doc_ord in replaced:
+    new_documents[doc_ord] = documents[doc_ord + 1]
+  updated = Indexes(
+    documents[:-num_new], stop_words, doc_id[:-num_new], 
+    speakers = speakers[:-num_new], 
+    index_dir = os.path.join(tmp_dir, "base/"), rebuild = True
+  )
+  time_start = time.time()
+  changed = replaced + list(range(len(documents) - num_new, len(documents)))
+  updated.update_documents(
+    [new_documents[i] for i in changed], [doc_id[i] for i in changed], 
+    [speakers[i] for i in changed]
+  )
+  elapsed_update = time.time() - time_start
+  time_start = time.time()
+  Indexes(
+    new_documents, stop_words, doc_id, speakers = speakers, 
+    index_dir = os.path.join(tmp_dir, "full/"), rebuild = True
+  )
+  print("{} documents: update {:.2f} sec | rebuild {:.2f} sec".format(
+    len(changed), elapsed_update, time.time() - time_start
+  ))
+  shutil.rmtree(tmp_dir)
+
+# function: compare_build_workers ---------------------------------------------
+def compare_build_workers(Indexes, documents, doc_id, speakers, stop_words,
+                          worker_counts = (1, 2, 4, 8)):
+  # build the index with different numbers of worker processes, and report
+  # the build time of each
+  import tempfile, shutil
+  tmp_dir = tempfile.mkdtemp()
+  for num_workers in worker_counts:
+    time_start = time.time()
+    Indexes(
+      documents, stop_words, doc_id, speakers = speakers, 
+      index_dir = os.path.join(tmp_dir, f"workers_{num_workers}/"), 
+      rebuild = True, num_workers = num_workers
+    )
+    elapsed = time.time() - time_start
+    print("{:2d} workers: built in {:6.2f} sec".format(num_workers, elapsed))
+  shutil.rmtree(tmp_dir)
+
+# function: compare_index_cache -----------------------------------------------
+def compare_index_cache(Indexes, documents, doc_id, speakers, stop_words):
+  # open the index with stem = False and True in turn, starting from an
+  # empty index cache (each setting is built once in its own directory and
+  # then opened from it), and report the time each takes, and the time 
+  # spent computing the key of the index
+  from postings import get_index_key
+  import tempfile, shutil
+  tmp_dir = tempfile.mkdtemp()
+  for stem in [False, True, False, True]:
+    time_start = time.time()
+    indexes = Indexes(documents, stop_words, doc_id, speakers = speakers, 
+                      stem = stem, index_dir = tmp_dir)
+    print("stem = {!s:5}: opened in {:6.2f} sec from {}".format(
+      stem, time.time() - time_start, os.path.basename(indexes.index_dir)
+    ))
+  time_start = time.time()
+  get_index_key(documents, doc_id, speakers, stop_words, stem = False)
+  print("computed the key in {:.3f} sec".format(time.time() - time_start))
+  shutil.rmtree(tmp_dir)
+
+# function: compare_tokenizers ------------------------------------------------
+def compare_tokenizers(documents, stop_words):
+  # tokenize the documents with Tokenizer and with word_tokenize (and 
+  # porter.stem) called on every document and token, and report the 
+  # throughput of each in tokens per second, with and without stemming
+  from nltk import word_tokenize
+  from nltk.stem import PorterStemmer
+  from tokenizer import Tokenizer, stem
+  porter = PorterStemmer()
+  stop_list = list(stop_words)
+  def tokenize_baseline(document, do_stem):
+    doc_tokens = word_tokenize(document.strip().lower())
+    doc_tokens = [term for term in doc_tokens if term not in stop_list]
+    if do_stem:
+      doc_tokens = [porter.stem(term) for term in doc_tokens]
+    return(doc_tokens)
+  for do_stem in [False, True]:
+    tokenizer = Tokenizer(stop_words, do_stem)
+    stem.cache_clear()
+    elapsed = dict()
+    for name, tokenize in [
+      ("Tokenizer", lambda doc: tokenizer.tokenize(doc, True)),
+      ("word_tokenize", lambda doc: tokenize_baseline(doc, do_stem))
+    ]:
+      time_start = time.time()
+      num_tokens = sum(len(tokenize(doc)) for doc in documents)
+      elapsed[name] = time.time() - time_start
+    print("stem = {!s:<5s} Tokenizer {:9.0f} tokens/sec | word_tokenize "
+          "{:9.0f} tokens/sec".format(
+            do_stem, num_tokens / max(elapsed["Tokenizer"], 1e-9),
+            num_tokens / max(elapsed["word_tokenize"], 1e-9)
+          ))
+
+
+# function: compare_import_times ----------------------------------------------
+def compare_import_times(modules = ["data_prep", "ranker_evaluation", 
+                                   "inverted_index"], num_rounds = 3):
+  # report the time it takes to import each module in a new Python process
+  # (the data is loaded on first use, see helper_func.LazyAttributes)
+  import subprocess, sys
+  for module in modules:
+    code = "import {}".format(module)
+    elapsed = []
+    for _ in range(num_rounds):
+      time_start = time.time()
+      subprocess.run([sys.executable, "-c", code], check = True)
+      elapsed.append(time.time() - time_start)
+    print("import {:<18s} {:6.2f} sec".format(module, min(elapsed)))
+
+# function: check_worker_memory -----------------------------------------------
+def check_worker_memory(preload, get_retrieval_results, queries, 
+                        num_workers = 4, num_rounds = 10):
+  # load the data with preload, then fork num_workers processes that each 
+  # serve the queries num_rounds times like the web app (search, then render
+  # the results), and report the memory of each worker that is private to 
+  # it (i.e. not shared with the other processes)
+  def get_memory():
+    # returns the private and the shared memory (in MB) of this process
+    memory = dict()
+    with open("/proc/self/smaps_rollup") as f:
+      for line in f:
+        fields = line.split()
+        memory[fields[0].rstrip(":")] = int(fields[1]) / 1024 \
+          if fields[1].isdigit() else None
+    return(memory["Private_Clean"] + memory["Private_Dirty"], 
+           memory["Shared_Clean"] + memory["Shared_Dirty"])
+  time_start = time.time()
+  preload()
+  print("preloaded in {:.2f} sec".format(time.time() - time_start))
+  from data_prep import script_index
+  read_fd, write_fd = os.pipe()
+  pids = []
+  for _ in range(num_workers):
+    pid = os.fork()
+    if pid == 0:
+      os.close(read_fd)
+      for _ in range(num_rounds):
+        for query in queries:
+          result_list = get_retrieval_results(
+            query, SEARCH_RANKER, num_results = 20, use_cache = False, 
+            **RANKER_PARAMS[SEARCH_RANKER]
+          )
+          script_index.render_many(result_list, plus_minus = 1, 
+                                   output_format = "html")
+      gc.collect()
+      os.write(write_fd, "{:.1f} {:.1f}\n".format(*get_memory()).encode())
+      os._exit(0)
+    pids.append(pid)
+  os.close(write_fd)
+  for pid in pids:
+    os.waitpid(pid, 0)
+  with os.fdopen(read_fd) as f:
+    for worker, line in enumerate(f):
+      private, shared = line.split()
+      print("worker {}: private memory {:>7s} MB | shared memory {:>7s} "
+            "MB".format(worker, private, shared))
+
+
+# function: check_metrics_overhead --------------------------------------------
+def check_metrics_overhead(get_retrieval_results, queries, num_rounds = 20):
+  # report the cost of recording the time of a stage (see metrics.py), and
+  # the number of stages recorded per query, i.e. the cost of the
+  # instrumentation per query
+  from metrics import StageMetrics, start_trace, end_trace
+  from inverted_index import RANKER_PARAMS, SEARCH_RANKER
+  test_metrics = StageMetrics("test_seconds", "test")
+  num_calls = 100000
+  time_start = time.perf_counter()
+  for _ in range(num_calls):
+    with test_metrics.time("stage"):
+      pass
+  cost = (time.perf_counter() - time_start) / num_calls
+  num_stages = 0
+  for _ in range(num_rounds):
+    for query in queries:
+      token = start_trace()
+      get_retrieval_results(query, SEARCH_RANKER, num_results = 20, 
+                            use_cache = False, 
+                            **RANKER_PARAMS[SEARCH_RANKER])
+      num_stages += len(end_trace(token))
+  num_stages /= num_rounds * len(queries)
+  print("{:.2f} us per stage x {:.1f} stages per query = {:.2f} us per "
+        "query".format(cost * 1e6, num_stages, cost * 1e6 * num_stages))
+
+# function: compare_paging ----------------------------------------------------
+def compare_paging(get_retrieval_results, get_ranked_page, queries, 
+                   page_size = 20, num_pages = 10):
+  # compare paging through the results of each query by ranking it again 
+  # with a larger num_results for each page, and by slicing the ranked list
+  # kept by get_ranked_page (as /api/search does), and report the time per
+  # query of each
+  from inverted_index import RANKER_PARAMS, SEARCH_RANKER
+  ranker_params = RANKER_PARAMS[SEARCH_RANKER]
+  time_rerank = time_slice = 0.0
+  for query in queries:
+    time_start = time.perf_counter()
+    for page in range(num_pages):
+      get_retrieval_results(
+        query, SEARCH_RANKER, num_results = (page + 1) * page_size, 
+        use_cache = False, **ranker_params
+      )
+    time_rerank += time.perf_counter() - time_start
+    time_start = time.perf_counter()
+    for page in range(num_pages):
+      get_ranked_page(
+        query, SEARCH_RANKER, offset = page * page_size, 
+        page_size = page_size, 
+        **ranker_params
+      )
+    time_slice += time.perf_counter() - time_start
+  print("{} pages x {} queries: rerank {:.1f} ms/query | slice {:.1f} "
+        "ms/query".format(
+          num_pages, len(queries), time_rerank / len(queries) * 1000, 
+          time_slice / len(queries) * 1000
+        ))
+
+# function: compare_sharding --------------------------------------------------
+def compare_sharding(rank_documents, indexes, start_shards, queries, 
+                     ranker_params, num_shards = 4):
+  # compare the time per query of ranking on the shards of the index (see 
+  # sharding.py) and in this process, with and without a character filter
+  # and a limit on the number of results
+  pool = start_shards(num_shards)
+  query_ctxs = [indexes.get_query_context(query) for query in queries]
+  time_local = time_sharded = 0.0
+  for ranker, params in ranker_params.items():
+    for character in ["", "Joey Tribbiani"]:
+      for num_results, pruning in [(20, True), (None, False)]:
+        for query_ctx in query_ctxs:
+          time_start = time.perf_counter()
+          rank_documents(indexes, query_ctx, ranker, character, num_results,
+                         pruning, **params)
+          time_local += time.perf_counter() - time_start
+          time_start = time.perf_counter()
+          pool.rank_documents(query_ctx, ranker, character, num_results, 
+                              pruning, **params)
+          time_sharded += time.perf_counter() - time_start
+  pool.close()
+  num_queries = len(ranker_params) * 4 * len(queries)
+  print("{} shards: local {:.3f} ms/query | sharded {:.3f} ms/query".format(
+    num_shards, time_local / num_queries * 1000, 
+    time_sharded / num_queries * 1000
+  ))
+
+# function: check_suggestions -------------------------------------------------
+def check_suggestions(get_suggestions, queries):
+  # report the time taken to suggest completions (see autocomplete.py) for
+  # every prefix of each query, as if it were typed one key at a time
+  prefixes = [query[:end] for query in queries 
+              for end in range(1, len(query) + 1)]
+  get_suggestions(prefixes[0])
+  elapsed = []
+  for prefix in prefixes:
+    time_start = time.perf_counter()
+    get_suggestions(prefix)
+    elapsed.append(time.perf_counter() - time_start)
+  elapsed = np.array(elapsed) * 1e6
+  print("{} prefixes: mean {:.1f} us | p99 {:.1f} us | max {:.1f} us".format(
+    len(prefixes), elapsed.mean(), np.percentile(elapsed, 99), elapsed.max()
+  ))
+
+
+if __name__ == "__main__":
+  compare_import_times()
+
+  from inverted_index import preload, get_retrieval_results
+  from data_prep import query_list
+  check_worker_memory(preload, get_retrieval_results, query_list)
+
+  from inverted_index import indexes, RANKER_PARAMS, SEARCH_RANKER
+  compare_index_formats(indexes)
+  ranker_params = RANKER_PARAMS
+  compare_scoring_modes(indexes, query_list, ranker_params)
+  compare_top_k_modes(get_retrieval_results, query_list, ranker_params)
+  from inverted_index import get_batch_retrieval_results
+  compare_batch_queries(get_retrieval_results, get_batch_retrieval_results,
+                        query_list, ranker_params)
+  compare_evaluation(get_batch_retrieval_results, query_list, ranker_params)
+  check_metrics_overhead(get_retrieval_results, query_list)
+  from inverted_index import get_ranked_page
+  compare_paging(get_retrieval_results, get_ranked_page, query_list)
+  from inverted_index import rank_documents
+  from sharding import start_shards
+  compare_sharding(rank_documents, indexes, start_shards, query_list, 
+                   ranker_params)
+  compare_snippet_rendering([u_id for query in query_list 
+                             for u_id in get_retrieval_results(
+                               query, SEARCH_RANKER, num_results = 20, 
+                               **RANKER_PARAMS[SEARCH_RANKER]
+                             )])
+  from autocomplete import get_suggestions
+  check_suggestions(get_suggestions, query_list)
+  from data_prep import script_utterance
+  compare_episode_rendering(script_utterance.u_id.iloc[::500].tolist())
+
+  from inverted_index import Indexes, documents, doc_id, speakers, stop_words
+  compare_update_rebuild(Indexes, documents, doc_id, speakers, stop_words)
+  compare_build_workers(Indexes, documents, doc_id, speakers, stop_words)
+  compare_index_cache(Indexes, documents, doc_id, speakers, stop_words)
+  compare_tokenizers(documents, stop_words)
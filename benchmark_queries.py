@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import platform
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+from inverted_index import RANKER_PARAMS, SEARCH_RANKER
+
+# Purpose: This script benchmarks the search engine end to end: it replays
+#          the testing queries (friends-queries.txt) and a synthetic log of
+#          the kind of queries the web app receives, with and without a
+#          character filter, and reports the latency (p50/p95/p99) of each
+#          ranker, the throughput (queries per second) with 1..N threads
+#          and processes, the index load time and the peak resident memory.
+#          The results are saved as JSON, so that runs can be compared
+#          across commits. It only uses the bundled data. Run
+#          `python -m benchmark_queries` from the project's root folder
+#          (`--help` lists the options).
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+# the settings of the web app's search results page (see web_ui.py)
+WEB_RANKER = SEARCH_RANKER
+WEB_NUM_RESULTS = 20
+NUM_FILTER_CHARACTERS = 20 # the characters offered by the search form
+
+# function: make_query_log ----------------------------------------------------
+def make_query_log(transcripts, num_queries = 500, seed = 0):
+  # returns a list of num_queries synthetic queries, made from random
+  # utterances (transcripts) the way people search the script:
+  #  - 40%: a line they remember, 3 to 8 consecutive words of an utterance
+  #  - 30%: a few keywords, 1 to 3 words of an utterance
+  #  - 20%: a line in double quotes (a phrase query)
+  #  - 10%: two words of an utterance within 10 tokens (a proximity query)
+  rand = random.Random(seed)
+  query_log = []
+  while len(query_log) < num_queries:
+    words = [word.strip(".,!?\"") for word in
+             str(transcripts[rand.randrange(len(transcripts))]).split()]
+    words = [word for word in words if word != ""]
+    if len(words) < 2:
+      continue
+    kind = rand.random()
+    if kind < 0.4:
+      length = rand.randint(3, 8)
+      start = rand.randrange(max(len(words) - length, 0) + 1)
+      query_log.append(" ".join(words[start:(start + length)]))
+    elif kind < 0.7:
+      query_log.append(" ".join(rand.sample(words, min(len(words),
+                                                      rand.randint(1, 3)))))
+    elif kind < 0.9:
+      length = rand.randint(2, 4)
+      start = rand.randrange(max(len(words) - length, 0) + 1)
+      query_log.append('"{}"'.format(" ".join(words[start:(start + length)])))
+    else:
+      query_log.append('"{} {}"~10'.format(*rand.sample(words, 2)))
+  return(query_log)
+
+# function: make_workload -----------------------------------------------------
+def make_workload(queries, characters, seed = 0):
+  # returns a list of (query, filter_by_character) tuples: every query once
+  # without a character filter and once filtered by a random character
+  rand = random.Random(seed)
+  return([(query, "") for query in queries] +
+         [(query, rand.choice(characters)) for query in queries])
+
+# function: get_percentiles ---------------------------------------------------
+def get_percentiles(latencies):
+  # returns a dictionary with the mean, p50, p95 and p99 of the latencies
+  # (in sec), in milliseconds
+  latencies = np.array(latencies) * 1000
+  return(dict(
+    mean_ms = float(np.mean(latencies)),
+    p50_ms = float(np.percentile(latencies, 50)),
+    p95_ms = float(np.percentile(latencies, 95)),
+    p99_ms = float(np.percentile(latencies, 99))
+  ))
+
+# function: run_query ---------------------------------------------------------
+def run_query(task, ranker = WEB_RANKER):
+  # run one query of the workload like the web app does (the result cache is
+  # not used, so every query is ranked)
+  from inverted_index import get_retrieval_results
+  query, filter_by_character = task
+  return(get_retrieval_results(
+    query, ranker, filter_by_character = filter_by_character,
+    num_results = WEB_NUM_RESULTS, use_cache = False, **RANKER_PARAMS[ranker]
+  ))
+
+def run_queries(tasks):
+  # run the queries of a part of the workload, returns how many were run
+  for task in tasks:
+    run_query(task)
+  return(len(tasks))
+
+# function: measure_latency ---------------------------------------------------
+def measure_latency(workload, rankers):
+  # run the workload with each ranker, and return a list of dictionaries
+  # with the latency percentiles of the queries with and without a
+  # character filter; the workload is run once before it is timed, so that
+  # the per-ranker caches (e.g. Indexes.score_bounds) are filled, as they
+  # are in a web app that has been running for a while
+  results = []
+  for ranker in rankers:
+    for task in workload:
+      run_query(task, ranker)
+    latencies = dict(none = [], character = [])
+    for task in workload:
+      time_start = time.perf_counter()
+      run_query(task, ranker)
+      latencies["character" if task[1] != "" else "none"].append(
+        time.perf_counter() - time_start
+      )
+    for filter_type, values in latencies.items():
+      results.append(dict(ranker = ranker, filter = filter_type,
+                          num_queries = len(values),
+                          **get_percentiles(values)))
+      print("{:<8s} filter = {:<9s} p50 {:7.2f} ms | p95 {:7.2f} ms | "
+            "p99 {:7.2f} ms".format(ranker, filter_type,
+                                    results[-1]["p50_ms"],
+                                    results[-1]["p95_ms"],
+                                    results[-1]["p99_ms"]))
+  return(results)
+
+# function: measure_throughput ------------------------------------------------
+def measure_throughput(workload, num_workers, mode = "threads"):
+  # run the workload (split into one part per worker) with num_workers
+  # threads or forked processes, and return the number of queries per second
+  parts = [workload[i::num_workers] for i in range(num_workers)]
+  if mode == "threads":
+    executor = ThreadPoolExecutor(max_workers = num_workers)
+  else:
+    executor = ProcessPoolExecutor(
+      max_workers = num_workers,
+      mp_context = multiprocessing.get_context("fork")
+    )
+  with executor:
+    # start the workers before the clock does
+    list(executor.map(run_queries, [[]] * num_workers))
+    time_start = time.perf_counter()
+    num_queries = sum(executor.map(run_queries, parts))
+    elapsed = time.perf_counter() - time_start
+  return(num_queries / elapsed)
+
+# function: measure_load ------------------------------------------------------
+def measure_load():
+  # open the index (and load the rest of the web app's data) in a new Python
+  # process, and return a dictionary with the time it takes and the peak
+  # resident memory of that process
+  code = """if True:
+    import json, resource, time
+    import inverted_index
+    time_start = time.perf_counter()
+    inverted_index.lazy_data.load("indexes")
+    index_load_sec = time.perf_counter() - time_start
+    inverted_index.preload()
+    print(json.dumps(dict(
+      index_load_sec = index_load_sec,
+      preload_sec = time.perf_counter() - time_start,
+      peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    )))
+  """
+  output = subprocess.run([sys.executable, "-c", code], check = True,
+                          capture_output = True, text = True).stdout
+  return(json.loads(output.strip().splitlines()[-1]))
+
+# function: get_commit --------------------------------------------------------
+def get_commit():
+  # returns the hash of the checked out git commit (with a "+" if there are
+  # uncommitted changes), or None outside of a git repository
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                            check = True, capture_output = True,
+                            text = True).stdout.strip()
+    changes = subprocess.run(["git", "status", "--porcelain",
+                              "--untracked-files=no"], check = True,
+                             capture_output = True, text = True).stdout
+  except (OSError, subprocess.CalledProcessError):
+    return(None)
+  return(commit + ("+" if changes.strip() != "" else ""))
+
+# function: run_benchmark -----------------------------------------------------
+def run_benchmark(num_synthetic = 500, max_workers = os.cpu_count(),
+                  rankers = None, seed = 0):
+  # run all measurements, returns a dictionary that can be saved as JSON
+  # inputs:
+  #   num_synthetic: the number of queries of the synthetic log
+  #   max_workers: the throughput is measured with 1, 2, 4, ... up to
+  #                max_workers threads and processes
+  #   rankers: a list of rankers (default: all rankers of Indexes)
+  load = measure_load()
+  print("index opened in {:.2f} sec, data loaded in {:.2f} sec, peak "
+        "resident memory {:.1f} MB".format(
+          load["index_load_sec"], load["preload_sec"], load["peak_rss_mb"]
+        ))
+  import data_prep
+  import inverted_index
+  inverted_index.preload()
+  if rankers is None:
+    rankers = list(inverted_index.indexes.ranker_map)
+  queries = data_prep.query_list + make_query_log(
+    data_prep.script_utterance.transcript.tolist(), num_synthetic, seed
+  )
+  workload = make_workload(
+    queries, data_prep.character_list[:NUM_FILTER_CHARACTERS], seed
+  )
+  latency = measure_latency(workload, rankers)
+  throughput = []
+  num_workers_list = [num_workers for num_workers in [1, 2, 4, 8, 16, 32, 64]
+                      if num_workers < max_workers] + [max_workers]
+  for mode in ["threads", "processes"]:
+    for num_workers in num_workers_list:
+      qps = measure_throughput(workload, num_workers, mode)
+      throughput.append(dict(mode = mode, num_workers = num_workers,
+                             qps = qps))
+      print("{:2d} {:<9s} {:8.1f} queries/sec".format(num_workers, mode, qps))
+  return(dict(
+    commit = get_commit(),
+    created = datetime.now().isoformat(timespec = "seconds"),
+    python = platform.python_version(),
+    cpu_count = os.cpu_count(),
+    num_documents = inverted_index.indexes.doc_count,
+    num_queries = len(workload),
+    num_synthetic = num_synthetic,
+    seed = seed,
+    load = load,
+    latency = latency,
+    throughput = throughput,
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  ))
+
+# function: compare_results ---------------------------------------------------
+def compare_results(old, new):
+  # print the results of two runs (see run_benchmark) side by side
+  print("{:<32s} {:>10s} {:>10s} {:>8s}".format(
+    "", str(old["commit"]), str(new["commit"]), "change"
+  ))
+  def print_row(label, old_value, new_value):
+    if old_value == 0:
+      change = "{:>8s}".format("n/a")
+    else:
+      change = "{:>+7.1f}%".format((new_value / old_value - 1) * 100)
+    print("{:<32s} {:>10.2f} {:>10.2f} {}".format(
+      label, old_value, new_value, change
+    ))
+  for key in ["index_load_sec", "preload_sec", "peak_rss_mb"]:
+    print_row(key, old["load"][key], new["load"][key])
+  old_latency = {(row["ranker"], row["filter"]): row for row in old["latency"]}
+  for row in new["latency"]:
+    old_row = old_latency.get((row["ranker"], row["filter"]))
+    if old_row is not None:
+      for key in ["p50_ms", "p95_ms", "p99_ms"]:
+        print_row("{} {} {}".format(row["ranker"], row["filter"], key),
+                  old_row[key], row[key])
+  old_qps = {(row["mode"], row["num_workers"]): row["qps"]
+             for row in old["throughput"]}
+  for row in new["throughput"]:
+    if (row["mode"], row["num_workers"]) in old_qps:
+      print_row("{} {} qps".format(row["num_workers"], row["mode"]),
+                old_qps[(row["mode"], row["num_workers"])], row["qps"])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description = "Benchmark the latency and throughput of queries."
+  )
+  parser.add_argument("--synthetic", type = int, default = 500,
+                      help = "number of synthetic queries (default: 500)")
+  parser.add_argument("--workers", type = int, default = os.cpu_count(),
+                      help = "largest number of threads and processes used "
+                             "to measure the throughput (default: number of"
+                             " CPUs)")
+  parser.add_argument("--rankers", nargs = "+",
+                      help = "rankers to measure (default: all)")
+  parser.add_argument("--seed", type = int, default = 0,
+                      help = "seed of the synthetic query log (default: 0)")
+  parser.add_argument("--output",
+                      help = "JSON file of the results (default: "
+                             "./data/benchmarks/<commit>.json)")
+  parser.add_argument("--compare",
+                      help = "JSON file of an earlier run to compare with")
+  args = parser.parse_args()
+
+  results = run_benchmark(args.synthetic, args.workers, args.rankers,
+                          args.seed)
+  output = args.output
+  if output is None:
+    os.makedirs("./data/benchmarks/", exist_ok = True)
+    output = "./data/benchmarks/{}.json".format(
+      results["commit"] or datetime.now().strftime("%Y%m%d-%H%M%S")
+    )
+  with open(output, "w") as f:
+    json.dump(results, f, indent = 2)
+  print(f"Saved the results to {output}")
+  if args.compare is not None:
+    with open(args.compare) as f:
+      compare_results(json.load(f), results)
@@ -0,0 +1,37 @@
+import argparse
+import os
+
+# Purpose: This script (re)builds the binary index directory used by class
+#          Indexes (see postings.write_index) in the index cache. Run 
+#          `python -m build_index` from the project's root folder to build
+#          an index ahead of its first use (e.g. `--stem` for the stemmed
+#          index); Indexes also builds the index on first use if needed, and
+#          a change of the corpus or the stop words gets a new index.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Build the binary index.")
+  parser.add_argument("--index-dir", default = "./data/index/",
+                      help = "index cache directory (default: ./data/index/)")
+  parser.add_argument("--stem", action = "store_true",
+                      help = "stem the terms with the Porter stemmer")
+  parser.add_argument("--workers", type = int, default = os.cpu_count(),
+                      help = "number of processes used to tokenize and index"
+                             " the documents (default: number of CPUs)")
+  args = parser.parse_args()
+
+  from inverted_index import Indexes, documents, doc_id, speakers, stop_words
+  from helper_func import print_phase_times
+  indexes = Indexes(
+    documents = documents,
+    doc_id = doc_id,
+    stop_words = stop_words,
+    stem = args.stem,
+    speakers = speakers,
+    index_dir = args.index_dir,
+    rebuild = True,
+    num_workers = args.workers
+  )
+  print("saved the index to {}".format(indexes.index_dir))
+  print_phase_times()
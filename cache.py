@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import threading
+import time
+
+# Purpose: This script defines class LRUCache, a thread-safe, bounded
+#          least-recently-used cache whose entries expire after a given
+#          time-to-live, with hit/miss counters.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+class LRUCache:
+  def __init__(self, max_size = 1024, ttl = None):
+    # inputs:
+    #   max_size: an integer, the maximum number of entries; the least
+    #             recently used entry is evicted when the cache is full
+    #   ttl: the number of seconds an entry stays valid (None: no expiry)
+    self.max_size = max_size
+    self.ttl = ttl
+    # self.entries: an OrderedDict that maps a key to a tuple of
+    # (expiry time, value), ordered from least to most recently used
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    # self.version: the version of the data the entries were computed from
+    # (see set_version)
+    self.version = None
+
+  def get(self, key, default = None):
+    # returns the value cached under key, or default if there is no such
+    # entry or it has expired
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] is not None and \
+         entry[0] < time.monotonic():
+        del self.entries[key]
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return(default)
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return(entry[1])
+
+  def put(self, key, value):
+    expiry = None if self.ttl is None else time.monotonic() + self.ttl
+    with self.lock:
+      self.entries[key] = (expiry, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last = False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def set_version(self, version):
+    # drop all entries if the data they were computed from has changed
+    with self.lock:
+      if version != self.version:
+        self.entries.clear()
+        self.version = version
+
+  def stats(self):
+    # returns a dictionary with the number of hits, misses and entries
+    with self.lock:
+      return(dict(
+        hits = self.hits, misses = self.misses, size = len(self.entries)
+      ))
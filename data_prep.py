@@ -1,13 +1,29 @@
 import os
 import json
 import pandas as pd
+import numpy as np
 import re
+import multiprocessing
+from queue import Empty
+import array
+from itertools import accumulate
+
+from cache import LRUCache
+from metrics import cache_metrics
+from helper_func import read_dict, save_dict, LazyAttributes, measure_time, \
+                        write_file_atomically
 
 # Data Preparation
-#  - fead JSON file as pd.DataFrame, store as TSV
+#  - fead JSON file as pd.DataFrame, store as TSV (and as a pickled cache
+#    of the parsed TSV, which is faster to load)
 #  - generate dictionary uid_to_rowidx
 #  - read testing query list (query_list) and annotations (query_relevance)
 #  - function definition: get_script_with_uid, get_episode_with_uid
+#  - replace the script data (e.g. after an index update) and save it: 
+#    set_script_data, save_script_data
+#  - class definition: ScriptIndex, PackedStrings, PositionLookup
+#  - the data is loaded when it is first used, not when data_prep is
+#    imported (see lazy_data)
 # Term Project, SI650, F20
 # Author: Yanyu Long, longyyu@umich.edu
 # Updated: Dec 14, 2020
@@ -17,73 +33,157 @@ json_file = json_dir + "friends_season_{:02d}.json"
 output_dir = "./data/"
 
 # Data preparation ------------------------------------------------------------
-def get_script_utterance(season_id):
-  # read script data from json files and store as pd.DataFrame object
-  # input - season_id: an integer
+SCRIPT_COLUMNS = ['u_id', 'speakers', 'transcript']
+# the number of seconds read_all_seasons waits for a season before checking
+# that the processes reading them are still running
+SEASON_POLL_SEC = 1
+tsv_file = f"{output_dir}script_id_speaker_10seasons.tsv"
+# the parsed TSV data, pickled with its column types (see load_script_data)
+cache_file = f"{output_dir}script_id_speaker_10seasons.pkl"
 
-  def get_utterance_count(season):
-    # a helper function that returns the number of utterances in a season
-    # this is used to specify number of rows in data frame df_all_transcript 
-    # to avoid appending rows, which will expedite the outer function
-    # input - season: json format data
-    num_utterances = 0
-    for episode in season['episodes']:
-      for scene in episode['scenes']:
-        for utterance in scene['utterances']:
-          if utterance['tokens']:
-            num_utterances += 1
-    return(num_utterances)
-    
-  season = json.load(open(json_file.format(season_id)))
-  df_all_transcript = pd.DataFrame(
-    index = range(get_utterance_count(season)), 
-    columns = ['u_id', 'speakers', 'transcript']
-  )
-  idx = 0
+def iter_utterances(season):
+  # yields a (u_id, speakers, transcript) record for each utterance of a 
+  # season, in script order
+  # input - season: json format data
   for episode in season['episodes']:
     for scene in episode['scenes']:
       for utterance in scene['utterances']:
         if utterance['tokens']:
-          df_all_transcript.iloc[idx] = dict(
-            u_id = utterance['utterance_id'],
-            speakers = ', '.join(utterance['speakers']),
-            transcript = utterance['transcript']
-          )
-          idx += 1
-  return(df_all_transcript)
-
-# if the TSV format data already exists on disk, then read from TSV
-# otherwise read from JSON format data and store as TSV
-if os.path.exists(f"{output_dir}script_id_speaker_10seasons.tsv"):
-  script_utterance = pd.read_csv(
-    f"{output_dir}script_id_speaker_10seasons.tsv",
-    sep = '\t', header = 0
-  )
-else:
-  script_utterance = pd.DataFrame(columns=['u_id', 'speakers', 'transcript'])
-  for season_id in range(1, 11):
-    script_utterance = script_utterance.append(
-      get_script_utterance(season_id), 
-      ignore_index = True
+          yield((
+            utterance['utterance_id'], 
+            ', '.join(utterance['speakers']),
+            utterance['transcript']
+          ))
+
+def get_script_utterance(season_id):
+  # read script data from json files and store as pd.DataFrame object
+  # input - season_id: an integer
+  with open(json_file.format(season_id)) as f:
+    season = json.load(f)
+  return(pd.DataFrame.from_records(
+    iter_utterances(season), columns = SCRIPT_COLUMNS
+  ))
+
+@measure_time
+def read_all_seasons(season_ids = range(1, 11)):
+  # read the seasons in parallel, one forked process per season, and 
+  # concatenate them in season order; the processes inherit 
+  # get_script_utterance instead of unpickling it (which would wait for the
+  # import of this module to finish), and send back their data frame 
+  # through a queue; raises a RuntimeError if a process exits without 
+  # sending its season (e.g. when it is killed), instead of waiting forever
+  context = multiprocessing.get_context("fork")
+  queue = context.Queue()
+  def read_season(i, season_id):
+    try:
+      queue.put((i, get_script_utterance(season_id)))
+    except Exception as e:
+      queue.put((i, e))
+  processes = [context.Process(target = read_season, args = (i, season_id))
+               for i, season_id in enumerate(season_ids)]
+  for process in processes:
+    process.start()
+  seasons = dict()
+  # the seasons whose process had exited without sending them at the last 
+  # check (the data may still be in the queue, so wait once more)
+  lost = set()
+  while len(seasons) < len(processes):
+    try:
+      i, season = queue.get(timeout = SEASON_POLL_SEC)
+      seasons[i] = season
+    except Empty:
+      exited = set(i for i, process in enumerate(processes)
+                   if i not in seasons and process.exitcode is not None)
+      if len(lost & exited) > 0:
+        for process in processes:
+          process.kill()
+        i = min(lost & exited)
+        raise RuntimeError(
+          "the process reading season {} exited with code {} without "
+          "sending it".format(season_ids[i], processes[i].exitcode)
+        )
+      lost = exited
+  for process in processes:
+    process.join()
+  for season in seasons.values():
+    if isinstance(season, Exception):
+      raise season
+  return(pd.concat([seasons[i] for i in range(len(processes))], 
+                   ignore_index = True))
+
+def load_script_data():
+  # returns the script data as a pd.DataFrame object with columns
+  # SCRIPT_COLUMNS: from the pickled cache if it was made from the current
+  # TSV file, otherwise from the TSV file (which is first created from the
+  # JSON format data if it does not exist), in which case the cache is 
+  # (re)written
+  if not os.path.exists(tsv_file):
+    df = read_all_seasons()
+    write_file_atomically(
+      tsv_file, lambda path: df.to_csv(path, sep = '\t', index = False)
     )
-  script_utterance.to_csv(
-    f"{output_dir}script_id_speaker_10seasons.tsv",
-    sep = '\t', index = False
+  cache = read_dict(cache_file)
+  if cache is not None and cache["source"] == get_tsv_source():
+    return(cache["data"])
+  df = pd.read_csv(tsv_file, sep = '\t', header = 0)
+  save_script_cache(df)
+  return(df)
+
+def get_tsv_source():
+  # identifies the current version of the TSV file (see load_script_data)
+  tsv_stat = os.stat(tsv_file)
+  return((tsv_stat.st_size, tsv_stat.st_mtime_ns))
+
+def save_script_cache(df):
+  # write the cache of the TSV file (see helper_func.write_file_atomically,
+  # a process starting at the same time never reads a partial file); the 
+  # data frame is pickled, which keeps the column types as they are and 
+  # loads faster than parsing the TSV file, without another dependency
+  source = get_tsv_source()
+  write_file_atomically(
+    cache_file, lambda path: save_dict(dict(source = source, data = df), path)
+  )
+
+def save_script_data():
+  # write the current script data (e.g. after inverted_index.update_index)
+  # to the TSV file and its cache, so that the next start loads it; the
+  # cache holds the data frame itself, so the data loaded is identical to
+  # the current data
+  df = lazy_data.get("script_utterance")
+  write_file_atomically(
+    tsv_file, lambda path: df.to_csv(path, sep = '\t', index = False)
   )
+  save_script_cache(df)
 
-# generate a dictionary that maps utterance ID to row index
-uid_to_rowidx = dict(zip(script_utterance.u_id, script_utterance.index))
+def set_script_data(df):
+  # replace the script data (e.g. after inverted_index.update_index) and
+  # the script data used to render search results; the other data computed
+  # from it is computed again when it is next used
+  # input - df: a pd.DataFrame object with columns SCRIPT_COLUMNS
+  global script_utterance, script_index
+  new_script_index = ScriptIndex(df)
+  with lazy_data.lock:
+    script_utterance, script_index = df, new_script_index
+    lazy_data.unload("uid_to_rowidx", "character_list")
+
+# function: load_uid_to_rowidx ------------------------------------------------
+def load_uid_to_rowidx():
+  # generate a dictionary that maps utterance ID to row index
+  script_utterance = lazy_data.get("script_utterance")
+  return(dict(zip(script_utterance.u_id, script_utterance.index)))
 
 # read in query list and query judgement data ---------------------------------
-with open("./data/friends-queries.txt") as f:
+def load_query_list():
+  with open("./data/friends-queries.txt") as f:
     query_list = [line.strip() for line in f]
-    f.close()
+  return(query_list)
 
-query_relevance = pd.read_csv(
-  "./data/friends-qrels.txt", 
-  sep = " ", header = None, 
-  names = ["query_id", "doc_id", "relevance"]
-)
+def load_query_relevance():
+  return(pd.read_csv(
+    "./data/friends-qrels.txt", 
+    sep = " ", header = None, 
+    names = ["query_id", "doc_id", "relevance"]
+  ))
 
 # function: pretty_cid --------------------------------------------------------
 def pretty_cid(cid):
@@ -119,7 +219,7 @@ def get_script_with_uid(df, u_id, plus_minus = 0, output_format = "terminal"):
     sym_red = "<span style='color:IndianRed'>"
     sym_normal = "</span>"
   
-  row_idx = uid_to_rowidx[u_id]
+  row_idx = lazy_data.get("uid_to_rowidx")[u_id]
   if plus_minus <= 0:
     df_target = df.iloc[row_idx]
     script = "{} ({}){}[{}] {}{}".format(
@@ -208,10 +308,246 @@ def get_episode_with_uid(df, uid):
 
   return(episode)
 
-# generate a list of characters sorted in descending order of 
-# total utterances across all ten seasons
-character_list = script_utterance.pivot_table(
-    index = "speakers", values = "u_id", aggfunc = "count"
-  ).sort_values(by = "u_id", ascending = False)\
-    .index.tolist()
-character_list.remove("#ALL#")
+# class PackedStrings ---------------------------------------------------------
+class PackedStrings:
+  # a read-only list of strings, stored as one UTF-8 encoded bytes object 
+  # and an array of the offsets of each string in it; unlike a list, it is
+  # two Python objects whatever the number of strings, so reading a string
+  # does not update the reference counts of objects shared with other 
+  # processes (which would copy their memory pages into the reading process)
+  def __init__(self, values):
+    # input - values: an iterable of strings (other values are stored as 
+    #                 str(value), e.g. "nan" for a missing value)
+    encoded = [str(value).encode("utf-8") for value in values]
+    self.data = b"".join(encoded)
+    # self.offsets: the i-th string is self.data[offsets[i]:offsets[i + 1]]
+    # (an array.array, whose items are quicker to read than a NumPy array's)
+    self.offsets = array.array("q", [0])
+    self.offsets.extend(accumulate(len(value) for value in encoded))
+
+  def __len__(self):
+    return(len(self.offsets) - 1)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+      if i < 0:
+        raise IndexError("PackedStrings index out of range")
+    # (self.offsets[i + 1] raises an IndexError if i is too large)
+    return(self.data[self.offsets[i]:self.offsets[i + 1]].decode())
+
+  def __iter__(self):
+    return(iter(self.get_range(0, len(self))))
+
+  def get_range(self, start, end):
+    # returns the list of the strings start, start + 1, ..., end - 1
+    data, offsets = self.data, self.offsets
+    return([data[offsets[i]:offsets[i + 1]].decode() 
+            for i in range(start, end)])
+
+# class PositionLookup --------------------------------------------------------
+class PositionLookup:
+  # a read-only dictionary that maps each string of a list to its position 
+  # in the list (the first one, if a string appears more than once), stored
+  # as the strings in sorted order (a fixed-width NumPy string array) and 
+  # the position of each; like PackedStrings, it is a few Python objects 
+  # whatever the number of strings, and a lookup is a binary search
+  def __init__(self, values):
+    # input - values: an iterable of strings
+    value_arr = np.array(list(values), dtype = str)
+    self.order = np.argsort(value_arr, kind = "stable")
+    self.sorted_values = value_arr[self.order]
+
+  def __len__(self):
+    return(len(self.sorted_values))
+
+  def __getitem__(self, value):
+    return(self.get_positions([value])[0])
+
+  def get(self, value, default = None):
+    try:
+      return(self[value])
+    except KeyError:
+      return(default)
+
+  def get_positions(self, values):
+    # returns a list of the positions of the given strings (looked up at 
+    # once), raises a KeyError if one of them is not in the list
+    values = np.array(values, dtype = str)
+    if len(self.sorted_values) == 0:
+      if len(values) > 0:
+        raise KeyError(str(values[0]))
+      return([])
+    i = np.minimum(np.searchsorted(self.sorted_values, values), 
+                   len(self.sorted_values) - 1)
+    found = self.sorted_values[i] == values
+    if not found.all():
+      raise KeyError(str(values[~found][0]))
+    return(self.order[i].tolist())
+
+# class ScriptIndex -----------------------------------------------------------
+class ScriptIndex:
+  # the script data in compact arrays (see PackedStrings), with the scene
+  # boundaries of each row precomputed, so that the context of search results
+  # is rendered without slicing or searching the data frame (the output is 
+  # identical to that of get_script_with_uid); it is built once and shared 
+  # by forked web server workers (see inverted_index.preload)
+  def __init__(self, df):
+    # input - df: a pd.DataFrame object with columns 
+    #             ["u_id", "speakers", "transcript"], in script order
+    u_ids = df.u_id.tolist()
+    self.row_count = len(u_ids)
+    # self.row_lookup: the row index of each utterance ID (see get_row_idx)
+    self.row_lookup = PositionLookup(u_ids)
+    # the scenes, numbered in order of appearance: self.row_scene maps each
+    # row to its scene number; the utterances are stored scene by scene in
+    # row order (i.e. in script order, as the rows of a scene are 
+    # contiguous, except for utterances appended to an existing scene by 
+    # inverted_index.update_index), self.row_position maps each row to its
+    # position, and the utterances of scene number i are at positions 
+    # self.scene_start[i]:self.scene_end[i]
+    cids = [u_id.rsplit("_u", 1)[0] for u_id in u_ids]
+    row_scene, scene_cids = pd.factorize(pd.Series(cids, dtype = object))
+    script_rows = np.argsort(row_scene, kind = "stable")
+    self.row_scene = array.array("q", row_scene)
+    self.row_position = array.array("q", np.argsort(script_rows))
+    scene_end = np.cumsum(np.bincount(row_scene, minlength = len(scene_cids)))
+    self.scene_end = array.array("q", scene_end)
+    self.scene_start = array.array("q", scene_end[:-1])
+    self.scene_start.insert(0, 0)
+    self.speakers = PackedStrings(df.speakers.iloc[script_rows])
+    self.transcripts = PackedStrings(df.transcript.iloc[script_rows])
+    scene_cids = scene_cids.tolist()
+    self.scene_cids = PackedStrings(scene_cids) # e.g. "s01_e01_c01"
+    # self.scene_labels: the scene ID of each scene in a nice format
+    self.scene_labels = PackedStrings([pretty_cid(cid) for cid in scene_cids])
+    # the episodes: self.episode_scenes maps an episode ID (e.g. "s01_e01")
+    # to the numbers of its scenes, which hold the rows of the episode
+    self.episode_scenes = dict()
+    for scene, cid in enumerate(scene_cids):
+      match = EPISODE_PATTERN.match(cid)
+      if match is not None:
+        self.episode_scenes.setdefault(match.group(0), []).append(scene)
+    # self.episode_cache: the HTML script of recently viewed episodes 
+    # (episodes never change, so the entries do not expire)
+    self.episode_cache = LRUCache(max_size = EPISODE_CACHE_SIZE)
+    # report its hits and misses at /metrics (the latest ScriptIndex object
+    # is the one used, see set_script_data)
+    cache_metrics.register("episode", self.episode_cache)
+
+  def get_row_idx(self, u_id):
+    # returns the row index of the utterance with the given ID, raises a 
+    # KeyError if there is none
+    return(self.get_row_idxs([u_id])[0])
+
+  def get_row_idxs(self, u_ids):
+    # returns a list of the row indexes of the utterances with the given IDs
+    # (looked up at once), raises a KeyError if one of them does not exist
+    return(self.row_lookup.get_positions(u_ids))
+
+  def render(self, u_id, plus_minus = 0, output_format = "terminal", 
+             row_idx = None):
+    # returns the formatted script of an utterance, see get_script_with_uid
+    # (the context is limited to the utterance's scene); row_idx is the row
+    # index of the utterance, if known
+    sym_newline, sym_red, sym_normal = OUTPUT_SYMBOLS[output_format]
+    if row_idx is None:
+      row_idx = self.get_row_idx(u_id)
+    position = self.row_position[row_idx]
+    if plus_minus <= 0:
+      return("{} ({}){}[{}] {}{}".format(
+        u_id, row_idx, sym_newline, self.speakers[position], 
+        self.transcripts[position], sym_newline
+      ))
+    scene = self.row_scene[row_idx]
+    if output_format == "terminal":
+      parts = [f"{u_id} ({row_idx})\n"]
+    else:
+      parts = ["<span style='background-color: WhiteSmoke;'>" + \
+               "<a href='/script/{}'>{}</a>".format(
+                 u_id, self.scene_labels[scene]
+               ) + "</span><br>"]
+    start = max(self.scene_start[scene], position - plus_minus)
+    end = min(self.scene_end[scene], position + plus_minus + 1)
+    for i, speaker, transcript in zip(
+      range(start, end), self.speakers.get_range(start, end), 
+      self.transcripts.get_range(start, end)
+    ):
+      if i == position: 
+        # highlight the target utterance in red
+        parts.append("{}[{}] {}{}{}".format(
+          sym_red, speaker, transcript, sym_normal, sym_newline
+        ))
+      else:
+        parts.append("[{}] {}{}".format(speaker, transcript, sym_newline))
+    return("".join(parts))
+
+  def render_many(self, u_ids, plus_minus = 0, output_format = "terminal"):
+    # returns a list of formatted scripts, one for each utterance ID (e.g.
+    # all results of a search results page)
+    return([self.render(u_id, plus_minus, output_format, row_idx)
+            for u_id, row_idx in zip(u_ids, self.get_row_idxs(u_ids))])
+
+  def render_episode(self, uid):
+    # returns the HTML formatted script for the entire episode of the given
+    # utterance ID (uid), see get_episode_with_uid
+    eid = EPISODE_PATTERN.findall(uid)[0]
+    episode = self.episode_cache.get(eid)
+    if episode is None:
+      episode = "<br>".join([
+        self.render_scene(scene) for scene in self.episode_scenes.get(eid, [])
+      ])
+      self.episode_cache.put(eid, episode)
+    return(episode)
+
+  def render_scene(self, scene):
+    # returns the HTML formatted script for the scene with the given number
+    parts = ["<br><span style='background-color: WhiteSmoke; "
+             "font-size: 18px;'>{}</span><br><br>".format(
+               "Scene {:2d}\n".format(int(
+                 re.compile("c(.*)").findall(self.scene_cids[scene])[0]
+               ))
+             )]
+    start, end = self.scene_start[scene], self.scene_end[scene]
+    for speaker, transcript in zip(self.speakers.get_range(start, end), 
+                                   self.transcripts.get_range(start, end)):
+      parts.append("[{}]  {}<br>".format(speaker, transcript))
+    return("".join(parts))
+
+EPISODE_PATTERN = re.compile("s[0-9]{2}_e[0-9]{2}")
+EPISODE_CACHE_SIZE = 256 # maximum number of cached episode scripts
+
+# the newline, highlight and end-of-highlight symbols of each output format
+OUTPUT_SYMBOLS = dict(
+  terminal = ("\n", "\x1b[1;31;47m", "\x1b[0m"),
+  html = ("<br>", "<span style='color:IndianRed'>", "</span>")
+)
+
+# function: load_character_list -----------------------------------------------
+def load_character_list():
+  # generate a list of characters sorted in descending order of 
+  # total utterances across all ten seasons (an utterance spoken by several
+  # characters, e.g. "Monica Geller, Rachel Green", counts for each of them)
+  character_list = lazy_data.get("script_utterance").speakers.dropna()\
+    .str.split(", ").explode().value_counts().index.tolist()
+  character_list.remove("#ALL#")
+  return(character_list)
+
+# lazily loaded data ----------------------------------------------------------
+# the data below is loaded (or computed) when it is first used, e.g. with
+# `from data_prep import script_utterance`, not when data_prep is imported
+# (see helper_func.LazyAttributes)
+#  - script_utterance: the script data
+#  - uid_to_rowidx: a dictionary that maps utterance ID to row index
+#  - query_list, query_relevance: the testing queries and their annotations
+#  - script_index: the script data used to render search results
+#  - character_list: the characters, most talkative first
+lazy_data = LazyAttributes(globals(), dict(
+  script_utterance = load_script_data,
+  uid_to_rowidx = load_uid_to_rowidx,
+  query_list = load_query_list,
+  query_relevance = load_query_relevance,
+  script_index = lambda: ScriptIndex(lazy_data.get("script_utterance")),
+  character_list = load_character_list
+))
+__getattr__ = lazy_data.get
@@ -0,0 +1,26 @@
+import os
+
+# Purpose: This is the configuration file of the gunicorn web server, which
+#          serves the web app with several worker processes: run 
+#          `gunicorn web_ui:app` from the project's root folder. The app, 
+#          the script data and the index are loaded once in the master 
+#          process (see inverted_index.preload) and shared by the forked workers.
+#          Set the environment variable FRIENDS_SHARDS to a number of shards
+#          to rank the queries of all workers on that many shard processes
+#          (see sharding.py).
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+bind = "127.0.0.1:8000"
+workers = os.cpu_count()
+# import web_ui in the master process rather than in each worker
+preload_app = True
+
+def on_starting(server):
+  # runs in the master process, before the workers are forked
+  from inverted_index import preload, use_shards
+  preload()
+  num_shards = int(os.environ.get("FRIENDS_SHARDS", "0"))
+  if num_shards > 0:
+    from sharding import start_shards
+    use_shards(start_shards(num_shards))
@@ -1,24 +1,38 @@
 import time
 import pickle
 import os
+import tempfile
+import threading
+import functools
+
+from metrics import phase_seconds
 
 # Purpose: This script defines helper functions that will be called 
 #          by other modules. 
 # Author: Yanyu Long
-# Updated: Dec 14, 2020
+# Updated: Oct 17, 2026
 
-# Define a decorator to measure the execution times of dedicated methods
+# Define a decorator to measure the execution times of dedicated methods, 
+# which are recorded in metrics.phase_seconds under the method's name (see
+# the /metrics route of the web app, or print_phase_times)
 def measure_time(f):
+  @functools.wraps(f)
   def timed(*args, **kw):
-    time_start = time.time()
-    result = f(*args, **kw)
-    time_end = time.time()
-    print("Executed {} in {:2.2f} sec. ".format(
-      f.__name__, time_end - time_start
-    ))
-    return result
+    time_start = time.perf_counter()
+    try:
+      return f(*args, **kw)
+    finally:
+      phase_seconds.observe(f.__name__, time.perf_counter() - time_start)
   return timed
 
+# Print the number of calls and the total execution time of each method
+# measured by measure_time (and of each lazily loaded variable)
+def print_phase_times():
+  for phase, (count, total) in sorted(phase_seconds.totals().items()):
+    print("Executed {} {} time(s) in {:2.2f} sec. ".format(
+      phase, count, total
+    ))
+
 @measure_time
 def read_dict(file_path):
   if os.path.exists(file_path):
@@ -33,3 +47,84 @@ def read_dict(file_path):
 def save_dict(obj, file_path):
   with open(file_path, 'wb') as f:
     pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+# Write a file through a temporary file, so that readers see the old or the
+# new file but never a partial one
+def write_file_atomically(file_path, write):
+  # inputs:
+  #   file_path: the path of the file
+  #   write: a function that writes the file to the path it is given
+  # the temporary file has a unique name in the same directory, so that 
+  # processes writing the same file at the same time (e.g. two servers 
+  # starting) do not write into each other's temporary file; the last one
+  # to finish wins
+  fd, tmp_path = tempfile.mkstemp(
+    dir = os.path.dirname(os.path.abspath(file_path)),
+    prefix = os.path.basename(file_path) + ".", suffix = ".tmp"
+  )
+  os.close(fd)
+  try:
+    # (mkstemp makes the file readable by its owner only)
+    os.chmod(tmp_path, 0o644)
+    write(tmp_path)
+    os.replace(tmp_path, file_path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+# Define a class that loads the data of a module on first use 
+class LazyAttributes:
+  # the module-level data of a module that is loaded when it is first used 
+  # rather than when the module is imported (the time it takes is recorded
+  # as the phase "load_<name>" in metrics.phase_seconds), e.g. in 
+  # data_prep.py:
+  #   lazy_data = LazyAttributes(globals(), dict(
+  #     script_utterance = load_script_data, ...
+  #   ))
+  #   __getattr__ = lazy_data.get
+  # then `from data_prep import script_utterance` (or data_prep.
+  # script_utterance) calls load_script_data() the first time, and stores its
+  # result as a module variable, which later imports find directly; inside
+  # the module, use lazy_data.get("script_utterance")
+  def __init__(self, module_globals, loaders):
+    # inputs:
+    #   module_globals: the dictionary returned by globals() in the module
+    #   loaders: a dictionary that maps the name of a module variable to a 
+    #            function without arguments that returns its value
+    self.module_globals = module_globals
+    self.loaders = loaders
+    # a reentrant lock, as a loader may use other lazily loaded variables
+    self.lock = threading.RLock()
+
+  def get(self, name):
+    # returns the value of the module variable name, loading it first if 
+    # needed (every variable is loaded once, even if several threads ask for
+    # it at the same time)
+    if name in self.module_globals:
+      return(self.module_globals[name])
+    if name not in self.loaders:
+      raise AttributeError("module {!r} has no attribute {!r}".format(
+        self.module_globals["__name__"], name
+      ))
+    with self.lock:
+      if name not in self.module_globals:
+        time_start = time.perf_counter()
+        self.module_globals[name] = self.loaders[name]()
+        phase_seconds.observe("load_" + name, 
+                              time.perf_counter() - time_start)
+    return(self.module_globals[name])
+
+  def load(self, *names):
+    # load the given module variables (default: all of them), e.g. before 
+    # forking worker processes
+    for name in (names if len(names) > 0 else self.loaders):
+      self.get(name)
+
+  def unload(self, *names):
+    # forget the loaded values of the given module variables (e.g. when the
+    # data they were computed from has changed), so they are loaded again
+    # when they are next used
+    with self.lock:
+      for name in names:
+        self.module_globals.pop(name, None)
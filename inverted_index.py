@@ -1,13 +1,25 @@
-from nltk import word_tokenize
-from nltk.stem import PorterStemmer
-porter = PorterStemmer()
 import pandas as pd
 import numpy as np
 import math
+import re
 import os
+import threading
+import gc
+import time
+import copy
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-from helper_func import measure_time, read_dict, save_dict
-from data_prep import script_utterance, get_script_with_uid
+from helper_func import measure_time, LazyAttributes
+from cache import LRUCache
+from metrics import stage_seconds, cache_metrics
+from tokenizer import Tokenizer
+from postings import PostingsStore, SegmentedStore, read_index, \
+                     write_index, build_speaker_index, update_speaker_index, \
+                     lookup, get_index_key, mark_index_used, prune_index_cache
+import data_prep
 
 # Purpose: This script defines class Indexes, which is used to tokenize 
 #          documents, generate inverted index, and rank documents given
@@ -16,34 +28,94 @@ from data_prep import script_utterance, get_script_with_uid
 # Author: Yanyu Long
 # Updated: Dec 16, 2020
 
+# a query wrapped in double quotes is a phrase query (e.g. "we were on a 
+# break"); a quoted query followed by ~N is a proximity query, which matches
+# documents where all terms occur within a window of N tokens 
+# (e.g. "joey food"~10)
+PHRASE_PATTERN = re.compile(r'^\s*"(.*)"\s*(?:~\s*([0-9]+))?\s*$', re.DOTALL)
+# the parameters of each ranker (see Indexes.ranker_map), used by the web app
+# and the benchmarks; the web app ranks the results with SEARCH_RANKER
+RANKER_PARAMS = dict(
+  bm25 = dict(k1 = 1.2, b = 0.75), bm25_v1 = dict(k1 = 1.2, b = 0.75),
+  piv = dict(b = 0.1), es = dict(s = 0.45), f2exp = dict(k = 0.1, b = 0.3),
+  tsl = dict(mu = 3500, lbda = 0.1)
+)
+SEARCH_RANKER = "f2exp"
+
+class QueryContext:
+  # the state of a single query; scoring functions read the query from a
+  # QueryContext object passed to them instead of from the Indexes object, 
+  # so concurrent queries against the same Indexes object do not interfere
+  def __init__(self, query, query_tokens, query_term_freq, mode = "terms",
+               phrase_tokens = None, window = None):
+    self.query = query # a string, the original query
+    self.query_tokens = query_tokens # a list of terms, stop words removed
+    # self.query_term_freq: a dictionary that maps a term to its frequency
+    # in the query
+    self.query_term_freq = query_term_freq
+    # self.mode: one of ["terms", "phrase", "proximity"]
+    self.mode = mode
+    # self.phrase_tokens: a list of terms, stop words included (phrase and
+    # proximity queries only)
+    self.phrase_tokens = phrase_tokens
+    self.window = window # an integer (proximity queries only)
+
+  def cache_key(self):
+    # returns a tuple that is equal for queries that normalize to the same
+    # terms and therefore have the same results
+    if self.mode == "terms":
+      return((self.mode, tuple(self.query_tokens)))
+    return((self.mode, tuple(self.phrase_tokens), self.window))
+
+
 class Indexes:
-  def __init__(self, documents, stop_words, doc_id = None, stem = False):
+  def __init__(self, documents, stop_words, doc_id = None, stem = False,
+               speakers = None, index_dir = "./data/index/", rebuild = False,
+               num_workers = 1):
     self.stop_list = stop_words # a list of stop words
     self.do_stem = stem # whether to stem the terms when tokenizing
+    # self.tokenizer: a Tokenizer object, used for documents and queries
+    self.tokenizer = Tokenizer(self.stop_list, self.do_stem)
+    # self.num_workers: the number of processes used to build the index
+    self.num_workers = num_workers
     self.documents = documents
+    # self.speakers: a list of strings, the speakers of each document (used
+    # to build the speaker index), or None
+    self.speakers = speakers
     self.doc_count = len(documents)
     self.doc_id = range(0, self.doc_count) if doc_id is None else doc_id
-    self.doc_length = dict(zip(self.doc_id, [len(doc) for doc in documents]))
-    self.avg_doc_length = np.mean(list(self.doc_length.values()))    
-    # self.doc_tokens: a dictionary that maps a document's ID to its tokens
-    self.doc_tokens = read_dict("./data/doc_tokens.pkl")
-    if self.doc_tokens is None:
-      self.tokenize_all_documents()
-    
-    # self.corpus_term_freq: a dictionary that maps a term to its frequency
-    # in the corpus (i.e. all documents)
-    self.corpus_term_freq = read_dict("./data/corpus_term_freq.pkl")
-    if self.corpus_term_freq is None:
-      self.compute_corpus_term_freq() # initialize corpus term frequency dict
-    
-    # self.term_to_freq_pos: a dictionary that maps a tuple of (doc_id, term)
-    # to a list of [term frequency (an integer), position (a integer list)]
-    self.term_to_freq_pos = read_dict("./data/term_to_freq_pos.pkl")
-    if self.term_to_freq_pos is None:
-      self.generate_inverted_index()    
-    # self.doc_freq: a dictionary that maps term to its document frequency
-    self.doc_freq = None
-    self.compute_doc_freq()
+    # self.doc_ord: a dictionary that maps a document's ID to its position
+    # in self.doc_id, used to break ties between equally scored documents
+    # (compact replaces the lists and the dictionary with equivalent 
+    # read-only objects)
+    self.doc_ord = dict(zip(self.doc_id, range(self.doc_count)))
+    # open the binary index (see postings.write_index) from the index cache
+    # index_dir, and build it first if it is not there: each combination of
+    # corpus, stop words and tokenizer settings has its own index directory
+    # (self.index_dir, see postings.get_index_key), so switching between 
+    # settings (e.g. stem = True and False) opens the index built earlier
+    # instead of rebuilding it; the least recently used indexes are deleted
+    # (see postings.prune_index_cache)
+    self.cache_dir = index_dir
+    self.index_dir = os.path.join(self.cache_dir, self.get_index_key())
+    index = None if rebuild else read_index(self.index_dir)
+    if index is None:
+      self.build_index()
+      index = read_index(self.index_dir)
+      prune_index_cache(self.cache_dir)
+    else:
+      mark_index_used(self.index_dir)
+    self.load_index(index)
+    # self.version: identifies the build of the index, changes whenever the 
+    # index is rebuilt
+    self.version = index["meta"].get("build_id")
+    self.init_scoring()
+
+  def init_scoring(self):
+    # self.score_bounds: a cache of the score bounds of each term, given a 
+    # ranker and its parameters (see get_score_bound)
+    self.score_bounds = dict()
+    self.score_bounds_lock = threading.Lock()
 
     # self.ranker_map: a dictionary that maps string to a ranking function
     self.ranker_map = dict(
@@ -54,6 +126,22 @@ class Indexes:
       f2exp = self.score_f2exp,
       tsl = self.score_tsl
     )
+    # self.batch_ranker_map: a dictionary that maps string to a batch scoring
+    # function, which scores a whole posting list at once
+    self.batch_ranker_map = dict(
+      bm25 = self.score_bm25_batch, 
+      bm25_v1 = self.score_bm25_v1_batch,
+      piv = self.score_piv_batch,
+      es = self.score_es_batch, 
+      f2exp = self.score_f2exp_batch,
+      tsl = self.score_tsl_batch
+    )
+
+  def get_index_key(self):
+    # returns the name of the directory of the index cache that holds the 
+    # index of the current documents and settings
+    return(get_index_key(self.documents, self.doc_id, self.speakers, 
+                         self.stop_list, stem = self.do_stem))
 
   def tokenize(self, document, remove_stop_words = False):
     # tokenize the given document
@@ -62,143 +150,766 @@ class Indexes:
     #   remove_stop_words - boolean, whether to remove stop words from tokens
     # output: list of strings, terms from the original document
     #         stemmed if self.do_stem is True
-    doc_tokens = word_tokenize(document.strip().lower())
-    if remove_stop_words:
-      doc_tokens = [term for term in doc_tokens if term not in self.stop_list]
-    if self.do_stem:
-      doc_tokens = [porter.stem(term) for term in doc_tokens]
-    else:
-      doc_tokens = [term for term in doc_tokens]
-    return(doc_tokens)
+    return(self.tokenizer.tokenize(document, remove_stop_words))
   
-  @measure_time
   def tokenize_all_documents(self):
-    doc_tokens_list = []
-    for doc in self.documents:
-      doc_tokens_list.append(self.tokenize(doc))
-    # update self.doc_tokens and save to disk
-    self.doc_tokens = dict(zip(self.doc_id, doc_tokens_list))
-    save_dict(self.doc_tokens, "./data/doc_tokens.pkl")
-  
-  @measure_time
-  def compute_corpus_term_freq(self):
-    self.corpus_term_freq = dict() 
-    for doc_id in self.doc_id:
-      for term in self.doc_tokens[doc_id]:
-        if term in self.stop_list:
-          continue
-        if term not in self.corpus_term_freq:
-          self.corpus_term_freq[term] = 0
-        self.corpus_term_freq[term] += 1
-    save_dict(self.corpus_term_freq, "./data/corpus_term_freq.pkl")
+    # returns a generator of token lists, one for each document
+    return(self.tokenizer.iter_tokenize(self.documents))
 
   @measure_time
-  def generate_inverted_index(self):
-    self.term_to_freq_pos = dict()
-    for idx, doc_id in enumerate(self.doc_id):
-      # print processing status every 2000 documents
-      if idx % 2000 == 0:
-        print("    Processing document # {:5d} (doc_id = {}) ...".\
-          format(idx, doc_id)
-        )
-      # update posting (self.term_to_freq_pos)
-      for pos, term in enumerate(self.doc_tokens[doc_id]):
-        if term in self.stop_list:
-          continue
-        # update document frequency and position for current term
-        if (doc_id, term) not in self.term_to_freq_pos:
-          self.term_to_freq_pos[(doc_id, term)] = [0, []] 
-        self.term_to_freq_pos[(doc_id, term)][0] += 1
-        self.term_to_freq_pos[(doc_id, term)][1].append(pos)
-    
-    # save self.term_to_freq_pos and self.doc_freq to disk
-    save_dict(self.term_to_freq_pos, "./data/term_to_freq_pos.pkl")
+  def build_index(self):
+    # tokenize all documents, generate the inverted index and save it to 
+    # self.index_dir
+    if self.num_workers > 1 and self.doc_count > 0:
+      store = self.build_store_parallel()
+    else:
+      store = PostingsStore.from_doc_tokens(
+        self.tokenize_all_documents(), self.tokenizer.stop_words
+      )
+    speaker_index = build_speaker_index(
+      [""] * self.doc_count if self.speakers is None else self.speakers
+    )
+    write_index(
+      self.index_dir, store, self.doc_id, 
+      doc_length = [len(doc) for doc in self.documents], 
+      speaker_index = speaker_index, stem = self.do_stem
+    )
 
   @measure_time
-  def compute_doc_freq(self):
-    # turn the posting into a data.frame
-    posting_df = pd.DataFrame.from_dict(
-      self.term_to_freq_pos, orient = 'index', 
-      columns = ["freq", "pos"]
+  def build_store_parallel(self, chunks_per_worker = 4):
+    # split the documents into contiguous chunks, tokenize and index each 
+    # chunk in a worker process (see build_shard), and merge the partial
+    # stores in document order; the result does not depend on the number of
+    # workers and is identical to the store built by a single process
+    chunk_size = math.ceil(
+      self.doc_count / (self.num_workers * chunks_per_worker)
     )
-    docid_term = list(zip(*posting_df.index))
-    posting_df['doc_id'] = docid_term[0]
-    posting_df['term'] = docid_term[1]
-    posting_df = posting_df.reset_index(drop = True)\
-      [["doc_id", "term", "freq", "pos"]]\
-      .sort_values(by = "doc_id")
-    
-    # create a dictionary base on posting_df
-    dictionary_df = posting_df.pivot_table(
-      index = 'term', values = ['doc_id', 'freq'],
-      aggfunc = {'doc_id': 'count', 'freq': np.sum}
-    ).reset_index()\
-    .rename(columns = {'doc_id': 'doc_freq', 'freq': 'total_freq'})
-    # update self.doc_freq
-    self.doc_freq = dict(
-      zip(dictionary_df['term'], dictionary_df['doc_freq'])
+    starts = list(range(0, self.doc_count, chunk_size))
+    # the workers are forked, so they inherit the loaded modules instead of
+    # importing this module (and opening the index) again
+    with ProcessPoolExecutor(
+      max_workers = self.num_workers, 
+      mp_context = multiprocessing.get_context("fork")
+    ) as executor:
+      shards = list(executor.map(
+        build_shard, 
+        [self.documents[start:(start + chunk_size)] for start in starts],
+        starts, repeat(self.tokenizer)
+      ))
+    return(SegmentedStore([(shard, None) for shard in shards]).merge())
+
+  def load_index(self, index):
+    # set up the index data from the output of postings.read_index
+    # self.store: a PostingsStore object, the inverted index, which holds the
+    # term dictionary and the frequencies and positions of each term in each
+    # document (see postings.py)
+    self.store = index["store"]
+    # self.doc_freq: a dictionary that maps term to its document frequency
+    self.doc_freq = dict(zip(self.store.terms, index["doc_freq"].tolist()))
+    # self.corpus_term_freq: a dictionary that maps a term to its frequency
+    # in the corpus (i.e. all documents)
+    self.corpus_term_freq = dict(zip(
+      self.store.terms, index["corpus_term_freq"].tolist()
+    ))
+    # per-document arrays (indexed by document ordinal): the document length
+    # and the document length divided by the average document length (and
+    # its square root), used by the scoring functions
+    self.set_doc_length(index["doc_length"])
+    # the speaker index: self.speaker_ids maps a speaker to its ID, and
+    # self.speaker_doc_ords[self.speaker_offsets[i]:self.speaker_offsets[i+1]]
+    # are the ordinals of the documents spoken by the speaker with ID i
+    self.set_speaker_index(index["speaker_index"])
+
+  def set_doc_length(self, doc_length_arr):
+    self.doc_length_arr = doc_length_arr
+    self.avg_doc_length = np.mean(self.doc_length_arr)
+    self.doc_length_norm = self.doc_length_arr / self.avg_doc_length
+    self.doc_length_norm_sqrt = np.sqrt(self.doc_length_norm)
+
+  def set_speaker_index(self, speaker_index):
+    speakers, self.speaker_offsets, self.speaker_doc_ords = speaker_index
+    self.speaker_ids = dict(zip(speakers, range(len(speakers))))
+
+  @measure_time
+  def update_documents(self, documents, doc_id, speakers = None, 
+                       max_segments = 8):
+    # add new documents, or replace the documents with the given IDs, 
+    # without rebuilding the index: the documents are indexed in a new
+    # segment (see postings.SegmentedStore), and the collection statistics
+    # are updated to what a full rebuild would give; a replaced document 
+    # keeps its ordinal, new documents are appended
+    # inputs:
+    #   documents, doc_id, speakers: lists of the same length, the text, ID
+    #                                and speakers of each document
+    #   max_segments: an integer, all segments are merged into one when 
+    #                 there are more
+    # output: a new Indexes object; self is not modified, so queries that are 
+    #         running against it are not affected
+    new = copy.copy(self)
+    new.documents = list(self.documents)
+    new.doc_id = list(self.doc_id)
+    new.doc_ord = dict(zip(new.doc_id, range(self.doc_count)))
+    new.speakers = [""] * self.doc_count if self.speakers is None else \
+                   list(self.speakers)
+    if speakers is None:
+      speakers = [""] * len(documents)
+    # the last version wins if a document ID is given more than once
+    updates = dict()
+    for doc, u_id, doc_speakers in zip(documents, doc_id, speakers):
+      updates[u_id] = (doc, "" if doc_speakers is None else doc_speakers)
+    replaced_ords = []
+    updated_ords = []
+    for u_id, (doc, doc_speakers) in updates.items():
+      doc_ord = new.doc_ord.get(u_id)
+      if doc_ord is None:
+        doc_ord = len(new.doc_id)
+        new.doc_id.append(u_id)
+        new.doc_ord[u_id] = doc_ord
+        new.documents.append(doc)
+        new.speakers.append(doc_speakers)
+      else:
+        replaced_ords.append(doc_ord)
+        new.documents[doc_ord] = doc
+        new.speakers[doc_ord] = doc_speakers
+      updated_ords.append(doc_ord)
+    updated_ords.sort()
+    new.doc_count = len(new.doc_id)
+
+    # update the collection statistics: remove the counts of the replaced 
+    # documents, then add the counts of the updated documents
+    new.doc_freq = dict(self.doc_freq)
+    new.corpus_term_freq = dict(self.corpus_term_freq)
+    for doc_ord in replaced_ords:
+      for term, tf in self.count_terms(self.documents[doc_ord]).items():
+        new.doc_freq[term] -= 1
+        new.corpus_term_freq[term] -= tf
+        if new.doc_freq[term] == 0:
+          del new.doc_freq[term], new.corpus_term_freq[term]
+    doc_tokens_list = [new.tokenize(new.documents[doc_ord]) 
+                       for doc_ord in updated_ords]
+    for doc_tokens in doc_tokens_list:
+      for term, tf in self.count_terms(doc_tokens).items():
+        new.doc_freq[term] = new.doc_freq.get(term, 0) + 1
+        new.corpus_term_freq[term] = new.corpus_term_freq.get(term, 0) + tf
+    doc_length_arr = np.zeros(new.doc_count, dtype = np.float64)
+    doc_length_arr[:self.doc_count] = self.doc_length_arr
+    doc_length_arr[updated_ords] = [len(new.documents[doc_ord]) 
+                                    for doc_ord in updated_ords]
+    new.set_doc_length(doc_length_arr)
+    new.set_speaker_index(update_speaker_index(
+      (list(self.speaker_ids), self.speaker_offsets, self.speaker_doc_ords),
+      {doc_ord: new.speakers[doc_ord] for doc_ord in updated_ords}
+    ))
+
+    # index the updated documents in a new segment, and mark the replaced
+    # documents as deleted in the existing segments
+    segments = self.store.segments \
+               if isinstance(self.store, SegmentedStore) else [(self.store, None)]
+    if len(replaced_ords) > 0:
+      segments = [(store, self.mark_deleted(deleted, replaced_ords, 
+                                            new.doc_count))
+                  for store, deleted in segments]
+    segments = segments + [(PostingsStore.from_doc_tokens(
+      doc_tokens_list, self.tokenizer.stop_words, doc_ords = updated_ords
+    ), None)]
+    new.store = SegmentedStore(segments)
+    if len(segments) > max_segments:
+      new.store = new.store.merge()
+
+    new.version = uuid.uuid4().hex
+    new.init_scoring()
+    return(new)
+
+  def count_terms(self, document):
+    # returns a dictionary that maps each indexed term of the document (a 
+    # string, or a list of tokens) to its frequency in the document
+    doc_tokens = self.tokenize(document) if isinstance(document, str) else \
+                 document
+    term_freq = dict()
+    for term in doc_tokens:
+      if not self.tokenizer.is_stop_word(term):
+        term_freq[term] = term_freq.get(term, 0) + 1
+    return(term_freq)
+
+  @staticmethod
+  def mark_deleted(deleted, doc_ords, doc_count):
+    # returns a copy of the deletion mask of a segment (see 
+    # postings.SegmentedStore) with doc_ords marked as deleted
+    new_deleted = np.zeros(doc_count, dtype = bool)
+    if deleted is not None:
+      new_deleted[:len(deleted)] = deleted
+    new_deleted[doc_ords] = True
+    return(new_deleted)
+
+  def merge_segments(self):
+    # returns a new Indexes object whose segments are merged into one 
+    # PostingsStore object (or self if there is only one segment)
+    if not isinstance(self.store, SegmentedStore):
+      return(self)
+    new = copy.copy(self)
+    new.store = self.store.merge()
+    new.init_scoring()
+    return(new)
+
+  def get_shard(self, start, end):
+    # returns a new Indexes object that only holds the postings of the 
+    # documents with ordinals start, start + 1, ..., end - 1 (one shard of 
+    # the index, see sharding.py), merged into one PostingsStore object; the
+    # collection statistics (doc_count, doc_freq, corpus_term_freq and the
+    # document lengths) are those of the whole index, so a document gets the
+    # same score from its shard as from the whole index
+    outside = np.concatenate([np.arange(0, start), 
+                              np.arange(end, self.doc_count)])
+    segments = self.store.segments \
+               if isinstance(self.store, SegmentedStore) else [(self.store, None)]
+    new = copy.copy(self)
+    new.store = SegmentedStore([
+      (store, self.mark_deleted(deleted, outside, self.doc_count))
+      for store, deleted in segments
+    ]).merge()
+    new.init_scoring()
+    return(new)
+
+  def compact(self):
+    # store the documents, their IDs and speakers in a few large objects 
+    # (see data_prep.PackedStrings and data_prep.PositionLookup, and a 
+    # pd.Categorical object for the speakers) instead of one Python object 
+    # per document, e.g. before the index is shared by forked web server 
+    # workers (see preload), whose reads would otherwise update the 
+    # reference counts of the shared objects; the index gives the same 
+    # results
+    self.documents = data_prep.PackedStrings(self.documents)
+    if not isinstance(self.doc_id, range):
+      self.doc_id = data_prep.PackedStrings(self.doc_id)
+      self.doc_ord = data_prep.PositionLookup(self.doc_id)
+    if self.speakers is not None:
+      self.speakers = pd.Categorical(self.speakers)
+
+  def save_index(self, index_dir = None):
+    # save the index (after merging its segments) to the index cache, so 
+    # that it is opened instead of rebuilt the next time an Indexes object 
+    # is created for the same documents (after update_documents, the updated
+    # documents have a new directory in the cache)
+    # input - index_dir: the directory to save the index to (default: the
+    #         directory of the current documents in self.cache_dir)
+    if index_dir is None:
+      index_dir = os.path.join(self.cache_dir, self.get_index_key())
+    write_index(
+      index_dir, self.merge_segments().store, self.doc_id, 
+      doc_length = self.doc_length_arr, 
+      speaker_index = (list(self.speaker_ids), self.speaker_offsets, 
+                       self.speaker_doc_ords),
+      stem = self.do_stem
     )
 
-  def score_bm25(self, term, doc_id, k1 = 1.25, b = 0.75, k3 = 500):
+  def get_speaker_doc_ords(self, speaker):
+    # returns a sorted integer array, the ordinals of the documents spoken by
+    # the given speaker (alone or together with other speakers)
+    speaker_id = self.speaker_ids.get(speaker)
+    if speaker_id is None:
+      return(self.speaker_doc_ords[0:0])
+    return(self.speaker_doc_ords[
+      self.speaker_offsets[speaker_id]:self.speaker_offsets[speaker_id + 1]
+    ])
+
+  def score_bm25(self, query_ctx, term, doc_id, k1 = 1.25, b = 0.75, 
+                 k3 = 500):
     df_term = self.doc_freq[term]
-    tf_term_doc = self.term_to_freq_pos[(doc_id, term)][0]
-    qtf_term_query = self.query_term_freq[term]
+    doc_ord = self.doc_ord[doc_id]
+    tf_term_doc = self.store.freq(term, doc_ord)
+    qtf_term_query = query_ctx.query_term_freq[term]
 
     score_idf = math.log((self.doc_count - df_term + 0.5) / (df_term + 0.5))
     score_tf = ((k1 + 1) * tf_term_doc / 
-                (k1 * (1 - b + b * self.doc_length[doc_id] / 
+                (k1 * (1 - b + b * self.doc_length_arr[doc_ord] / 
                 self.avg_doc_length) + tf_term_doc))
     score_qtf = ((k3 + 1) * qtf_term_query) / (k3 + qtf_term_query)
     return(score_idf * score_tf * score_qtf)
 
-  def score_bm25_v1(self, term, doc_id, k1 = 1.25, b = 0.75, k3 = 500):
+  def score_bm25_v1(self, query_ctx, term, doc_id, k1 = 1.25, b = 0.75, 
+                    k3 = 500):
     # based on BM25 but does not discriminate long documents
     df_term = self.doc_freq[term]
-    tf_term_doc = self.term_to_freq_pos[(doc_id, term)][0]
-    qtf_term_query = self.query_term_freq[term]
+    doc_ord = self.doc_ord[doc_id]
+    tf_term_doc = self.store.freq(term, doc_ord)
+    qtf_term_query = query_ctx.query_term_freq[term]
 
     score_idf = math.log((self.doc_count - df_term + 0.5) / (df_term + 0.5))
     score_tf = ((k1 + 1) * tf_term_doc / (k1 + tf_term_doc))
     score_qtf = ((k3 + 1) * qtf_term_query) / (k3 + qtf_term_query)
     return(score_idf * score_tf * score_qtf)
   
-  def score_piv(self, term, doc_id, b = 0.1):
+  def score_piv(self, query_ctx, term, doc_id, b = 0.1):
     score_idf = math.log((self.doc_count + 1) / (self.doc_freq[term]))
-    tf_term_doc = self.term_to_freq_pos[(doc_id, term)][0]
+    doc_ord = self.doc_ord[doc_id]
+    tf_term_doc = self.store.freq(term, doc_ord)
     score_tf = (1 + math.log(1 + math.log(tf_term_doc))) / \
-               (1 - b + b * self.doc_length[doc_id] / self.avg_doc_length)
-    score_qtf = self.query_term_freq[term]
+               (1 - b + b * self.doc_length_arr[doc_ord] / 
+                self.avg_doc_length)
+    score_qtf = query_ctx.query_term_freq[term]
     return(score_idf * score_tf * score_qtf)
   
-  def score_es(self, term, doc_id, s = 0.45):
+  def score_es(self, query_ctx, term, doc_id, s = 0.45):
     # a term-weighting function developed by a evolutionary learning approach
     # [Cummins & O’Riordan, 2007]
     score_idf = math.sqrt(
       (self.corpus_term_freq[term]**3 * self.doc_count) / \
       (self.doc_freq[term]**4)
     )
-    tf_term_doc = self.term_to_freq_pos[(doc_id, term)][0]
+    doc_ord = self.doc_ord[doc_id]
+    tf_term_doc = self.store.freq(term, doc_ord)
     score_tf = (tf_term_doc) / (tf_term_doc + s * math.sqrt(
-      self.doc_length[doc_id] / self.avg_doc_length))
-    score_qtf = self.query_term_freq[term]
+      self.doc_length_arr[doc_ord] / self.avg_doc_length))
+    score_qtf = query_ctx.query_term_freq[term]
     return(score_idf * score_tf * score_qtf)
   
-  def score_f2exp(self, term, doc_id, k = 0.35, b = 0.5):
+  def score_f2exp(self, query_ctx, term, doc_id, k = 0.35, b = 0.5):
     score_idf = (self.doc_count / self.doc_freq[term])**k
-    tf_term_doc = self.term_to_freq_pos[(doc_id, term)][0]
+    doc_ord = self.doc_ord[doc_id]
+    tf_term_doc = self.store.freq(term, doc_ord)
     score_tf = (tf_term_doc / (tf_term_doc + (1 - b) + \
-                b * self.doc_length[doc_id] / self.avg_doc_length))
-    score_qtf = self.query_term_freq[term]
+                b * self.doc_length_arr[doc_ord] / self.avg_doc_length))
+    score_qtf = query_ctx.query_term_freq[term]
     return(score_idf * score_tf * score_qtf)
 
-  def score_tsl(self, term, doc_id, mu = 3500, lbda = 0):
-    tf_term_doc = self.term_to_freq_pos[(doc_id, term)][0]
+  def score_tsl(self, query_ctx, term, doc_id, mu = 3500, lbda = 0):
+    doc_ord = self.doc_ord[doc_id]
+    tf_term_doc = self.store.freq(term, doc_ord)
     score_term1 = (tf_term_doc + \
         mu * self.corpus_term_freq[term] / len(self.corpus_term_freq)
-      ) / (self.doc_length[doc_id] + mu)
+      ) / (self.doc_length_arr[doc_ord] + mu)
     score_term2 = self.corpus_term_freq[term] / len(self.corpus_term_freq)
     return((1 - lbda) * score_term1 + lbda * score_term2)
   
+  # batch scoring functions: each function computes the same score as its 
+  # scalar counterpart above, for all documents of a posting list at once
+  # inputs:
+  #   query_ctx: a QueryContext object, the query being scored
+  #   term: a string, the query term
+  #   doc_ords: an integer array, the ordinals of the documents to be scored
+  #   tfs: a float array, the frequency of the term in each document
+  # output: a float array, the score of the term for each document
+
+  def score_bm25_batch(self, query_ctx, term, doc_ords, tfs, k1 = 1.25, 
+                       b = 0.75, k3 = 500):
+    df_term = self.doc_freq[term]
+    qtf_term_query = query_ctx.query_term_freq[term]
+
+    score_idf = math.log((self.doc_count - df_term + 0.5) / (df_term + 0.5))
+    score_tf = ((k1 + 1) * tfs / 
+                (k1 * (1 - b + b * self.doc_length_norm[doc_ords]) + tfs))
+    score_qtf = ((k3 + 1) * qtf_term_query) / (k3 + qtf_term_query)
+    return(score_idf * score_tf * score_qtf)
+
+  def score_bm25_v1_batch(self, query_ctx, term, doc_ords, tfs, k1 = 1.25,
+                          b = 0.75, k3 = 500):
+    df_term = self.doc_freq[term]
+    qtf_term_query = query_ctx.query_term_freq[term]
+
+    score_idf = math.log((self.doc_count - df_term + 0.5) / (df_term + 0.5))
+    score_tf = ((k1 + 1) * tfs / (k1 + tfs))
+    score_qtf = ((k3 + 1) * qtf_term_query) / (k3 + qtf_term_query)
+    return(score_idf * score_tf * score_qtf)
+
+  def score_piv_batch(self, query_ctx, term, doc_ords, tfs, b = 0.1):
+    score_idf = math.log((self.doc_count + 1) / (self.doc_freq[term]))
+    score_tf = (1 + np.log(1 + np.log(tfs))) / \
+               (1 - b + b * self.doc_length_norm[doc_ords])
+    score_qtf = query_ctx.query_term_freq[term]
+    return(score_idf * score_tf * score_qtf)
+
+  def score_es_batch(self, query_ctx, term, doc_ords, tfs, s = 0.45):
+    score_idf = math.sqrt(
+      (self.corpus_term_freq[term]**3 * self.doc_count) / \
+      (self.doc_freq[term]**4)
+    )
+    score_tf = tfs / (tfs + s * self.doc_length_norm_sqrt[doc_ords])
+    score_qtf = query_ctx.query_term_freq[term]
+    return(score_idf * score_tf * score_qtf)
+
+  def score_f2exp_batch(self, query_ctx, term, doc_ords, tfs, k = 0.35, 
+                        b = 0.5):
+    score_idf = (self.doc_count / self.doc_freq[term])**k
+    score_tf = (tfs / (tfs + (1 - b) + b * self.doc_length_norm[doc_ords]))
+    score_qtf = query_ctx.query_term_freq[term]
+    return(score_idf * score_tf * score_qtf)
+
+  def score_tsl_batch(self, query_ctx, term, doc_ords, tfs, mu = 3500, 
+                      lbda = 0):
+    score_term2 = self.corpus_term_freq[term] / len(self.corpus_term_freq)
+    score_term1 = (tfs + mu * score_term2) / \
+                  (self.doc_length_arr[doc_ords] + mu)
+    return((1 - lbda) * score_term1 + lbda * score_term2)
+
+  def get_query_context(self, query):
+    # tokenize the query and build the query term frequency dictionary; 
+    # quoted queries are parsed as phrase or proximity queries (see 
+    # PHRASE_PATTERN)
+    # output: a QueryContext object
+    mode, phrase_tokens, window = "terms", None, None
+    match = PHRASE_PATTERN.match(
+      query.replace("\u201c", '"').replace("\u201d", '"')
+    )
+    if match is not None:
+      query = match.group(1)
+      phrase_tokens = self.tokenize(query)
+      if match.group(2) is None:
+        mode = "phrase"
+      else:
+        mode, window = "proximity", int(match.group(2))
+    query_term_freq = dict()
+    query_tokens = self.tokenize(query, remove_stop_words = True)
+    for term in query_tokens:
+      if term not in query_term_freq:
+        query_term_freq[term] = 0
+      query_term_freq[term] += 1
+    return(QueryContext(
+      query, query_tokens, query_term_freq, mode, phrase_tokens, window
+    ))
+
+  def match_positions(self, query_ctx, doc_ords = None):
+    # find the documents that match a phrase or proximity query, using the
+    # term positions stored in the inverted index
+    # inputs:
+    #   query_ctx: a QueryContext object, whose mode is "phrase" or 
+    #              "proximity"
+    #   doc_ords: a sorted integer array, the ordinals of the documents to be
+    #             searched (None for all documents)
+    # output: a sorted integer array, the ordinals of the matching documents
+
+    # the indexed (i.e. non-stop-word) terms of the query and their offsets
+    # in the query, rarest term first so that the candidates shrink quickly
+    terms = [(term, offset) for offset, term in 
+             enumerate(query_ctx.phrase_tokens) 
+             if not self.tokenizer.is_stop_word(term)]
+    if len(terms) == 0 or any(term not in self.doc_freq for term, _ in terms):
+      return(np.zeros(0, dtype = np.int64))
+    terms.sort(key = lambda item: self.doc_freq[item[0]])
+    # candidates: the documents that contain every term
+    cand_ords = doc_ords
+    for term, _ in terms:
+      term_doc_ords = self.store.postings(term)[0]
+      if cand_ords is None:
+        cand_ords = term_doc_ords.astype(np.int64)
+      else:
+        cand_ords = cand_ords[lookup(term_doc_ords, cand_ords)[1]]
+      if len(cand_ords) == 0:
+        return(cand_ords)
+
+    if query_ctx.mode == "proximity":
+      # the positions of every term in all candidates (one lookup per term),
+      # and the shortest window of each candidate (see min_window_spans)
+      parts = [self.store.positions_in_docs(term, cand_ords) 
+               for term in dict.fromkeys(term for term, _ in terms)]
+      span_doc_ords, spans = min_window_spans(
+        np.concatenate([part[0] for part in parts]).astype(np.int64),
+        np.concatenate([part[1] for part in parts]).astype(np.int64),
+        np.repeat(np.arange(len(parts)), [len(part[0]) for part in parts]),
+        len(parts)
+      )
+      return(span_doc_ords[spans <= query_ctx.window])
+
+    # phrase: each occurrence of a term at position p is a possible start of
+    # the phrase at p - offset; intersect the possible starts of all terms
+    # (encoded as doc_ord * 2^32 + start + 2^16), which must be positions of
+    # the document (start >= 0)
+    starts = None
+    for term, offset in terms:
+      term_doc_ords, positions = self.store.positions_in_docs(term, cand_ords)
+      keys = (term_doc_ords.astype(np.int64) << 32) + \
+             (positions.astype(np.int64) - offset + 2**16)
+      starts = np.unique(keys) if starts is None else \
+               np.intersect1d(starts, keys, assume_unique = False)
+      if len(starts) == 0:
+        return(np.zeros(0, dtype = np.int64))
+    starts = starts[(starts & (2**32 - 1)) >= 2**16]
+    # the indexed terms of the phrase are at the right positions; a phrase 
+    # without stop words is therefore matched
+    if len(terms) == len(query_ctx.phrase_tokens):
+      return(np.unique(starts >> 32))
+    # the stop words of the phrase are not indexed, so compare the tokens of
+    # the documents whose indexed terms line up with the phrase (once per 
+    # document)
+    matched = []
+    phrase_length = len(query_ctx.phrase_tokens)
+    doc_ords, first = np.unique(starts >> 32, return_index = True)
+    for doc_ord, doc_starts in zip(doc_ords.tolist(), 
+                                   np.split(starts, first[1:])):
+      doc_tokens = self.tokenize(self.documents[doc_ord])
+      if any(doc_tokens[start:(start + phrase_length)] == 
+             query_ctx.phrase_tokens 
+             for start in ((doc_starts & (2**32 - 1)) - 2**16).tolist()):
+        matched.append(doc_ord)
+    return(np.array(matched, dtype = np.int64))
+
+  def score_candidates(self, query, ranker, doc_ords = None, batch = True,
+                       **kwargs):
+    # term-at-a-time ranking: only the documents that appear in the posting
+    # list of at least one query term are visited
+    # inputs: 
+    #   query, ranker, **kwargs: see rank_doc (query can also be a 
+    #                            QueryContext object)
+    #   doc_ords: a sorted integer array, the ordinals of the documents to be 
+    #             ranked (None for all documents)
+    #   batch: whether to score each posting list with a batch scoring 
+    #          function (True), or document by document with the scalar 
+    #          ranking function (False)
+    # output: a tuple of two arrays, the ordinals of the matching documents
+    #         (sorted) and their scores
+
+    query_ctx = query if isinstance(query, QueryContext) else \
+                self.get_query_context(query)
+    # accumulate the score of each term over its posting list
+    doc_score = np.zeros(self.doc_count, dtype = np.float64)
+    matched = []
+    for term in query_ctx.query_term_freq:
+      term_doc_ords, term_tfs = self.store.postings(term)
+      if doc_ords is not None:
+        # restrict the postings to the documents in doc_ords
+        hit = lookup(doc_ords, term_doc_ords)[1]
+        term_doc_ords, term_tfs = term_doc_ords[hit], term_tfs[hit]
+      if len(term_doc_ords) == 0:
+        continue
+      if batch:
+        doc_score[term_doc_ords] += self.batch_ranker_map[ranker](
+          query_ctx, term, term_doc_ords, term_tfs.astype(np.float64), **kwargs
+        )
+      else:
+        ranking_func = self.ranker_map[ranker]
+        for doc_ord in term_doc_ords.tolist():
+          doc_score[doc_ord] += ranking_func(
+            query_ctx, term, self.doc_id[doc_ord], **kwargs
+          )
+      matched.append(term_doc_ords)
+    if len(matched) == 0:
+      return(np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.float64))
+    matched = np.unique(np.concatenate(matched))
+    return(matched, doc_score[matched])
+
+  def get_score_bound(self, query_ctx, ranker, term, **kwargs):
+    # returns a tuple (max, min) of the scores that the term can contribute
+    # to any document, given the ranker and its parameters; the bounds are
+    # computed over the whole posting list once and cached in 
+    # self.score_bounds (the only state that searching writes to, guarded by
+    # self.score_bounds_lock)
+    key = (ranker, tuple(sorted(kwargs.items())), term, 
+           query_ctx.query_term_freq[term])
+    bound = self.score_bounds.get(key)
+    if bound is None:
+      term_doc_ords, term_tfs = self.store.postings(term)
+      scores = self.batch_ranker_map[ranker](
+        query_ctx, term, term_doc_ords, term_tfs.astype(np.float64), **kwargs
+      )
+      bound = (float(scores.max()), float(scores.min()))
+      with self.score_bounds_lock:
+        if len(self.score_bounds) >= 100000:
+          self.score_bounds.clear()
+        self.score_bounds[key] = bound
+    return(bound)
+
+  def score_top_k(self, query, ranker, num_results, doc_ords = None, **kwargs):
+    # top-k ranking with MaxScore dynamic pruning: the query terms are 
+    # processed in descending order of their score upper bound; once the
+    # remaining terms cannot lift a new document into the top results, their 
+    # posting lists are only probed for the current candidates, and 
+    # candidates that cannot reach the top results are dropped along the way
+    # inputs: 
+    #   query, ranker, doc_ords, **kwargs: see score_candidates
+    #   num_results: an integer, the number of documents to retrieve
+    # output: a tuple of two arrays, the ordinals of the top documents with
+    #         a positive score and their scores, sorted in the same order as
+    #         get_retrieval_results sorts the output of score_candidates
+
+    score_func = self.batch_ranker_map[ranker]
+    query_ctx = query if isinstance(query, QueryContext) else \
+                self.get_query_context(query)
+    # the time spent in each stage is recorded in metrics.stage_seconds
+    time_start = time.perf_counter()
+    # collect the posting lists of the query terms and their score bounds
+    postings = []
+    bounds = []
+    for term in query_ctx.query_term_freq:
+      term_doc_ords, term_tfs = self.store.postings(term)
+      if doc_ords is not None:
+        hit = lookup(doc_ords, term_doc_ords)[1]
+        term_doc_ords, term_tfs = term_doc_ords[hit], term_tfs[hit]
+      if len(term_doc_ords) == 0:
+        continue
+      postings.append((term, term_doc_ords, term_tfs.astype(np.float64)))
+      bounds.append(self.get_score_bound(query_ctx, ranker, term, **kwargs))
+    time_scoring = time.perf_counter()
+    stage_seconds.observe("candidates", time_scoring - time_start)
+    # rest_max[i] (rest_min[i]): the largest (smallest) total score that
+    # the terms processed from step i onwards can add to a document
+    term_order = sorted(range(len(postings)), key = lambda i: -bounds[i][0])
+    rest_max = np.cumsum(
+      [max(bounds[i][0], 0) for i in reversed(term_order)] 
+    )[::-1].tolist() + [0.0]
+    rest_min = np.cumsum(
+      [min(bounds[i][1], 0) for i in reversed(term_order)]
+    )[::-1].tolist() + [0.0]
+
+    def get_threshold(lower_bounds):
+      # a lower bound of the num_results-th highest final score (results need a
+      # positive score anyway), and a tolerance for rounding errors
+      threshold = 0.0
+      if len(lower_bounds) >= num_results:
+        kth = len(lower_bounds) - num_results
+        threshold = max(threshold, np.partition(lower_bounds, kth)[kth])
+      return(threshold - 1e-9 * max(1.0, abs(threshold)))
+
+    cand_ords = np.zeros(0, dtype = np.int64)
+    cand_scores = np.zeros(0, dtype = np.float64)
+    for step, i in enumerate(term_order):
+      term, term_doc_ords, term_tfs = postings[i]
+      threshold = get_threshold(cand_scores + rest_min[step])
+      if rest_max[step] < threshold:
+        # no new document can make it: only update the current candidates
+        idx, hit = lookup(term_doc_ords, cand_ords)
+        cand_scores[hit] += score_func(
+          query_ctx, term, cand_ords[hit], term_tfs[idx[hit]], **kwargs
+        )
+      else:
+        merged_ords = np.union1d(cand_ords, term_doc_ords)
+        merged_scores = np.zeros(len(merged_ords), dtype = np.float64)
+        merged_scores[np.searchsorted(merged_ords, cand_ords)] = cand_scores
+        merged_scores[np.searchsorted(merged_ords, term_doc_ords)] += \
+          score_func(query_ctx, term, term_doc_ords, term_tfs, **kwargs)
+        cand_ords, cand_scores = merged_ords, merged_scores
+      # drop the candidates that cannot reach the top results
+      threshold = get_threshold(cand_scores + rest_min[step + 1])
+      keep = cand_scores + rest_max[step + 1] >= threshold
+      cand_ords, cand_scores = cand_ords[keep], cand_scores[keep]
+
+    # recompute the scores of the remaining candidates term by term in the
+    # same order as score_candidates, so that the scores (and therefore 
+    # the order of tied documents) are identical to exhaustive ranking
+    cand_scores = np.zeros(len(cand_ords), dtype = np.float64)
+    for term, term_doc_ords, term_tfs in postings:
+      idx, hit = lookup(term_doc_ords, cand_ords)
+      cand_scores[hit] += score_func(
+        query_ctx, term, cand_ords[hit], term_tfs[idx[hit]], **kwargs
+      )
+    time_top_k = time.perf_counter()
+    stage_seconds.observe("scoring", time_top_k - time_scoring)
+    order = np.lexsort((cand_ords, -cand_scores))
+    order = order[cand_scores[order] > 0][:num_results]
+    stage_seconds.observe("top_k", time.perf_counter() - time_top_k)
+    return(cand_ords[order], cand_scores[order])
+
+  def rank_queries(self, queries, ranker, num_results = 10, doc_ords = None,
+                   batch_size = 256, candidate_cache = None, **kwargs):
+    # rank the documents for many queries in one pass: the posting list of
+    # each query term is read and scored once for all the queries that share
+    # the term (and its frequency in the query), and the term scores are
+    # summed per (query, document) pair, i.e. a sparse query-term x
+    # term-document product
+    # inputs:
+    #   queries: a list of strings (or QueryContext objects)
+    #   ranker, doc_ords, **kwargs: see score_candidates
+    #   num_results: an integer, the number of documents to retrieve for
+    #                each query (None for all matching documents)
+    #   batch_size: an integer, the number of queries whose scores are
+    #               summed at once
+    #   candidate_cache: None, or a dictionary that keeps the documents 
+    #                    matching each phrase and proximity query (see
+    #                    match_positions), so that calls with the same 
+    #                    doc_ords but different rankers or parameters do not
+    #                    match them again
+    # output: a list of tuples (doc_ords, scores), one for each query, the
+    #         documents with a positive score sorted in the same order as
+    #         get_retrieval_results sorts them
+
+    score_func = self.batch_ranker_map[ranker]
+    # queries that normalize to the same terms (see QueryContext.cache_key)
+    # are ranked once
+    parsed = dict()
+    query_ctxs = dict()
+    query_keys = []
+    for query in queries:
+      if isinstance(query, QueryContext):
+        query_ctx = query
+      else:
+        if query not in parsed:
+          parsed[query] = self.get_query_context(query)
+        query_ctx = parsed[query]
+      query_keys.append(query_ctx.cache_key())
+      query_ctxs.setdefault(query_keys[-1], query_ctx)
+    query_ctxs = list(query_ctxs.values())
+    # term_scores: a dictionary that maps (term, query term frequency) to the
+    # ordinals of the documents containing the term and their term scores
+    term_scores = dict()
+    def get_term_scores(query_ctx, term):
+      key = (term, query_ctx.query_term_freq[term])
+      if key not in term_scores:
+        term_doc_ords, term_tfs = self.store.postings(term)
+        if doc_ords is not None:
+          hit = lookup(doc_ords, term_doc_ords)[1]
+          term_doc_ords, term_tfs = term_doc_ords[hit], term_tfs[hit]
+        if len(term_doc_ords) == 0:
+          term_scores[key] = (np.zeros(0, dtype = np.int64),
+                              np.zeros(0, dtype = np.float64))
+        else:
+          term_scores[key] = (term_doc_ords.astype(np.int64), score_func(
+            query_ctx, term, term_doc_ords, term_tfs.astype(np.float64),
+            **kwargs
+          ))
+      return(term_scores[key])
+
+    results = []
+    for start in range(0, len(query_ctxs), batch_size):
+      batch = query_ctxs[start:(start + batch_size)]
+      # the (query, document) pair of each term score, encoded as
+      # query number * self.doc_count + document ordinal; the scores of a
+      # query are listed term by term in the same order as score_candidates
+      # adds them, so the sums are identical
+      pair_keys = [np.zeros(0, dtype = np.int64)]
+      pair_weights = [np.zeros(0, dtype = np.float64)]
+      for i, query_ctx in enumerate(batch):
+        query_doc_ords = None
+        if query_ctx.mode != "terms":
+          key = query_ctx.cache_key()
+          if candidate_cache is not None and key in candidate_cache:
+            query_doc_ords = candidate_cache[key]
+          else:
+            query_doc_ords = self.match_positions(query_ctx, doc_ords)
+            if candidate_cache is not None:
+              candidate_cache[key] = query_doc_ords
+        for term in query_ctx.query_term_freq:
+          term_doc_ords, scores = get_term_scores(query_ctx, term)
+          if query_doc_ords is not None:
+            hit = lookup(query_doc_ords, term_doc_ords)[1]
+            term_doc_ords, scores = term_doc_ords[hit], scores[hit]
+          pair_keys.append(i * self.doc_count + term_doc_ords)
+          pair_weights.append(scores)
+      pair_keys, inverse = np.unique(np.concatenate(pair_keys),
+                                     return_inverse = True)
+      pair_scores = np.bincount(
+        inverse.ravel(), weights = np.concatenate(pair_weights),
+        minlength = len(pair_keys)
+      )
+      pair_queries = pair_keys // self.doc_count
+      pair_ords = pair_keys % self.doc_count
+      # sort by query, then in descending order of score (ties are kept in
+      # document order), and keep only documents with a positive score
+      order = np.lexsort((pair_ords, -pair_scores, pair_queries))
+      order = order[pair_scores[order] > 0]
+      bounds = np.searchsorted(pair_queries[order], np.arange(len(batch) + 1))
+      for i in range(len(batch)):
+        selected = order[bounds[i]:bounds[i + 1]]
+        if num_results is not None:
+          selected = selected[:num_results]
+        results.append((pair_ords[selected], pair_scores[selected]))
+    results = dict(zip((query_ctx.cache_key() for query_ctx in query_ctxs),
+                       results))
+    return([results[key] for key in query_keys])
+
+  def to_doc_ords(self, doc_id_list):
+    # returns a sorted integer array, the ordinals of the given documents
+    return(np.unique(np.fromiter(
+      (self.doc_ord[doc_id] for doc_id in doc_id_list), dtype = np.int64
+    )))
+
   def rank_doc(self, query, ranker, doc_id_list = None, **kwargs):
     # inputs:
     #   query: a string
@@ -208,74 +919,364 @@ class Indexes:
     #   **kwargs: parameters to be passed into the ranking function
     # output: the scores for each document specified by the doc_id_list (or 
     #         all documents if doc_id_list is None)
-
-    ranking_func = self.ranker_map[ranker]
-    # tokenize the query and build the query term frequency dictionary
-    self.query_term_freq = dict()
-    query_tokens = self.tokenize(query, remove_stop_words = True)
-    for term in query_tokens:
-      if term not in self.query_term_freq:
-        self.query_term_freq[term] = 0
-      self.query_term_freq[term] += 1
-    # process doc_id_list and initialize an empty list doc_score
     if doc_id_list is None: 
       # if the user did not specify doc_id_list, will go through all documents
       doc_id_list = self.doc_id
-    doc_score = [0] * len(doc_id_list)
-    # rank each document in the doc_id_list given the query
-    for i, doc_id in enumerate(doc_id_list):
-      common_tokens = set(query_tokens) & set(self.doc_tokens[doc_id])
-      for term in common_tokens:
-        doc_score[i] += ranking_func(term, doc_id, **kwargs)
-    # delete attribute query_term_freq
-    delattr(self, "query_term_freq")
-    return(doc_score)
+      doc_ords = None
+    else:
+      doc_ords = self.to_doc_ords(doc_id_list)
+    matched, scores = self.score_candidates(query, ranker, doc_ords, **kwargs)
+    doc_score = dict(zip(matched.tolist(), scores.tolist()))
+    return([doc_score.get(self.doc_ord[doc_id], 0) for doc_id in doc_id_list])
 
 # function: get_retrieval_results ---------------------------------------------
 def get_retrieval_results(
-  query, ranker, filter_by_character = "", num_results = 10, **kwargs
+  query, ranker, filter_by_character = "", num_results = 10, pruning = True,
+  use_cache = True, **kwargs
 ):
+  # pruning: whether to retrieve the top num_results documents with MaxScore
+  #          dynamic pruning (Indexes.score_top_k) instead of scoring and 
+  #          sorting every matching document; both give the same results
+  # use_cache: whether to look up (and store) the results in result_cache
+
+  # the whole query runs against the index snapshot that is current when it
+  # starts, even if update_index replaces it in the meantime
+  snapshot = lazy_data.get("indexes")
+  # queries that normalize to the same terms share a cache entry; the cache
+  # is emptied whenever the index is rebuilt or updated
+  # (the time spent in each stage is recorded in metrics.stage_seconds: 
+  # "tokenize", "filter" (the character filter and phrase matching), then
+  # "candidates" (collecting the posting lists), "scoring" and "top_k")
+  with stage_seconds.time("tokenize"):
+    query_ctx = snapshot.get_query_context(query)
+  cache_key = (snapshot.version, query_ctx.cache_key(), ranker, 
+               tuple(sorted(kwargs.items())), filter_by_character, 
+               num_results)
+  if use_cache:
+    result_cache.set_version(snapshot.version)
+    result_list = result_cache.get(cache_key)
+    if result_list is not None:
+      return(list(result_list))
+
+  doc_ords, _ = rank_documents(
+    snapshot, query_ctx, ranker, filter_by_character, num_results, pruning,
+    **kwargs
+  )
+  result_list = [snapshot.doc_id[doc_ord] for doc_ord in doc_ords.tolist()]
+  if use_cache:
+    result_cache.put(cache_key, result_list)
+  return(list(result_list))
+
+# function: rank_documents ----------------------------------------------------
+def rank_documents(snapshot, query_ctx, ranker, filter_by_character = "",
+                   num_results = 10, pruning = True, **kwargs):
+  # the ranking step of get_retrieval_results
+  # inputs:
+  #   snapshot: the Indexes object to search
+  #   query_ctx: a QueryContext object (see Indexes.get_query_context)
+  #   ranker, filter_by_character, num_results, pruning, **kwargs: see 
+  #     get_retrieval_results
+  # output: a tuple of two arrays, the ordinals of the top num_results 
+  #         documents (all if num_results is None) with a positive score, 
+  #         and their scores, in ranked order
+
+  # the index is split into shards served by other processes (see 
+  # use_shards): rank the query on every shard and merge their results
+  pool = shards
+  if pool is not None and pool.version == snapshot.version:
+    return(pool.rank_documents(query_ctx, ranker, filter_by_character, 
+                               num_results, pruning, **kwargs))
+
   # filter documents to be queried
-  if filter_by_character == "":
-    query_doc_id = indexes.doc_id
+  with stage_seconds.time("filter"):
+    if filter_by_character == "":
+      query_doc_ords = None
+    else:
+      query_doc_ords = snapshot.get_speaker_doc_ords(filter_by_character)
+    # phrase and proximity queries: rank the matching documents only
+    if query_ctx.mode != "terms":
+      query_doc_ords = snapshot.match_positions(query_ctx, query_doc_ords)
+
+  # rank the documents (score_top_k records its own stages)
+  if pruning and num_results is not None:
+    doc_ords, doc_score = snapshot.score_top_k(
+      query = query_ctx, ranker = ranker, num_results = num_results, 
+      doc_ords = query_doc_ords, **kwargs
+    )
   else:
-    query_doc_id = script_utterance.loc[
-      script_utterance.speakers == filter_by_character, "u_id"
-    ].tolist()
+    with stage_seconds.time("scoring"):
+      doc_ords, doc_score = snapshot.score_candidates(
+        query = query_ctx, ranker = ranker, doc_ords = query_doc_ords, 
+        **kwargs
+      )
+    # organize the ranking results: sort in descending order of score (ties
+    # are kept in document order) and keep only documents with a positive 
+    # score
+    with stage_seconds.time("top_k"):
+      order = np.lexsort((doc_ords, -doc_score))
+      order = order[doc_score[order] > 0]
+      if num_results is not None:
+        order = order[:num_results]
+      doc_ords, doc_score = doc_ords[order], doc_score[order]
+  return(doc_ords, doc_score)
+
+# function: get_ranked_page ---------------------------------------------------
+def get_ranked_page(query, ranker, filter_by_character = "", offset = 0, 
+                    page_size = 20, depth = None, **kwargs):
+  # one page of the results of a query, for clients that page through them
+  # (see the /api/search route in web_ui.py): the first page ranks the top 
+  # `depth` documents once and keeps the ranked list in ranking_cache, so 
+  # the later pages are slices of it instead of new rankings (if the list 
+  # has expired, the query is ranked again, with the same results as long 
+  # as the index has not changed)
+  # inputs:
+  #   query, ranker, filter_by_character, **kwargs: see get_retrieval_results
+  #   offset: an integer, the rank (from 0) of the first result of the page
+  #   page_size: an integer, the number of results per page
+  #   depth: an integer, the number of top documents a client can page 
+  #          through (None: RANKING_DEPTH)
+  # output: a tuple of four items, the version of the index the results 
+  #         come from (see Indexes.version), a list of document IDs and a 
+  #         list of their scores (the page), and the number of results in 
+  #         the ranked list (at most depth)
+  if depth is None:
+    depth = RANKING_DEPTH
+  snapshot = lazy_data.get("indexes")
+  with stage_seconds.time("tokenize"):
+    query_ctx = snapshot.get_query_context(query)
+  cache_key = (snapshot.version, query_ctx.cache_key(), ranker, 
+               tuple(sorted(kwargs.items())), filter_by_character, depth)
+  ranking_cache.set_version(snapshot.version)
+  ranked = ranking_cache.get(cache_key)
+  if ranked is None:
+    doc_ords, doc_score = rank_documents(
+      snapshot, query_ctx, ranker, filter_by_character, depth, **kwargs
+    )
+    ranked = ([snapshot.doc_id[doc_ord] for doc_ord in doc_ords.tolist()],
+              doc_score.tolist())
+    ranking_cache.put(cache_key, ranked)
+  doc_ids, scores = ranked
+  return(snapshot.version, doc_ids[offset:(offset + page_size)], 
+         scores[offset:(offset + page_size)], len(doc_ids))
 
-  # rank the documents
-  doc_score =  indexes.rank_doc(
-    query = query, ranker = ranker, doc_id_list = query_doc_id, **kwargs
+# function: get_batch_retrieval_results ---------------------------------------
+def get_batch_retrieval_results(
+  queries, ranker, filter_by_character = "", num_results = 10, **kwargs
+):
+  # the results of get_retrieval_results for each query in the list queries,
+  # computed in one pass with Indexes.rank_queries (for offline jobs such as
+  # ranker evaluation and log replay, so the result cache is not used)
+  # output: a list of lists of document IDs, one for each query
+  snapshot = lazy_data.get("indexes")
+  if filter_by_character == "":
+    query_doc_ords = None
+  else:
+    query_doc_ords = snapshot.get_speaker_doc_ords(filter_by_character)
+  results = snapshot.rank_queries(
+    queries, ranker, num_results = num_results, doc_ords = query_doc_ords,
+    **kwargs
   )
+  return([[snapshot.doc_id[doc_ord] for doc_ord in doc_ords.tolist()]
+          for doc_ords, _ in results])
 
-  # organize the ranking results
-  doc_score_df = pd.DataFrame(dict(doc_id = query_doc_id, score = doc_score))\
-    .sort_values(by = "score", ascending = False)\
-    .reset_index(drop = True)
-  # keep only the documents with a positive score
-  doc_score_df = doc_score_df.loc[doc_score_df.score > 0]
-  if num_results is not None:
-    doc_score_df = doc_score_df.loc[0:(num_results - 1)]
-  return(doc_score_df.doc_id.tolist())
+# function: build_shard -------------------------------------------------------
+def build_shard(documents, first_ord, tokenizer):
+  # worker function of Indexes.build_store_parallel: tokenize and index the
+  # documents with ordinals first_ord, first_ord + 1, ...
+  # output: a PostingsStore object
+  return(PostingsStore.from_doc_tokens(
+    tokenizer.iter_tokenize(documents), tokenizer.stop_words, 
+    doc_ords = range(first_ord, first_ord + len(documents))
+  ))
+
+# function: update_index ------------------------------------------------------
+def update_index(documents, doc_id, speakers = None):
+  # add or replace documents (see Indexes.update_documents) and make the 
+  # updated index the one searched by get_retrieval_results; updates are 
+  # applied one at a time, and queries that are already running keep using
+  # the index they started with
+  # the script data used to render the results (see data_prep.
+  # set_script_data) is updated with the index, its rows are the documents 
+  # of the index, in the same order
+  # output: the updated Indexes object
+  global indexes
+  with index_update_lock:
+    updated = lazy_data.get("indexes").update_documents(
+      documents, doc_id, speakers
+    )
+    data_prep.set_script_data(pd.DataFrame(
+      dict(u_id = updated.doc_id, speakers = updated.speakers, 
+           transcript = updated.documents),
+      columns = data_prep.SCRIPT_COLUMNS
+    ))
+    lazy_data.unload("documents", "doc_id", "speakers")
+    indexes = updated
+  return(indexes)
+
+# function: save_updates ------------------------------------------------------
+def save_updates():
+  # save the documents added or replaced by update_index (to the script 
+  # data files, see data_prep.save_script_data) and the updated index (to 
+  # the index cache, under the key of the updated documents), so that the 
+  # next start loads the updated documents and opens the updated index 
+  # instead of rebuilding it
+  with index_update_lock:
+    data_prep.save_script_data()
+    lazy_data.get("indexes").save_index()
+
+# function: use_shards --------------------------------------------------------
+def use_shards(pool):
+  # rank the queries of get_retrieval_results and get_ranked_page on the 
+  # shards of a sharding.ShardPool object instead of in this process (None:
+  # stop using shards); the shards are only used while they serve the same
+  # version of the index as this process (i.e. until update_index)
+  global shards
+  shards = pool
+
+# function: preload -----------------------------------------------------------
+@measure_time
+def preload():
+  # load everything the web app uses (the index, the script data used to
+  # show the results, and the suggestions of the search box) up front; 
+  # under a pre-forking web server (e.g. gunicorn, see gunicorn.conf.py), 
+  # call this in the master process before the workers are forked, so the
+  # data is loaded once and the workers share its memory pages instead of 
+  # each loading a private copy on its first request
+  data_prep.lazy_data.load("script_index", "character_list")
+  lazy_data.load("indexes")
+  # the suggestions of the search box (autocomplete imports this module)
+  import autocomplete
+  autocomplete.lazy_data.load("suggesters")
+  # keep the loaded data in a few large objects, and drop the data frame 
+  # and the lists it was built from, which the web app does not use (they
+  # are loaded again if something does)
+  with index_update_lock:
+    lazy_data.get("indexes").compact()
+  lazy_data.unload("documents", "doc_id", "speakers")
+  data_prep.lazy_data.unload("script_utterance", "uid_to_rowidx")
+  # keep the garbage collector of each worker away from the loaded objects:
+  # a collection writes to every object it examines, which would copy the 
+  # shared pages into the worker
+  gc.collect()
+  gc.freeze()
+
+# function: min_window_span ---------------------------------------------------
+def min_window_span(position_lists):
+  # returns the length (in tokens) of the shortest window that contains at
+  # least one position from each list, or infinity if a list is empty
+  # input - position_lists: a list of lists of integers (token positions)
+  if any(len(positions) == 0 for positions in position_lists):
+    return(math.inf)
+  events = sorted((pos, i) for i, positions in enumerate(position_lists)
+                           for pos in positions)
+  counts = [0] * len(position_lists)
+  num_covered = 0
+  left = 0
+  span = math.inf
+  for pos, i in events:
+    counts[i] += 1
+    if counts[i] == 1:
+      num_covered += 1
+    # shrink the window from the left while it still covers every list
+    while num_covered == len(position_lists):
+      span = min(span, pos - events[left][0] + 1)
+      counts[events[left][1]] -= 1
+      if counts[events[left][1]] == 0:
+        num_covered -= 1
+      left += 1
+  return(span)
+
+# function: min_window_spans --------------------------------------------------
+def min_window_spans(doc_ords, positions, list_ids, num_lists):
+  # computes min_window_span for many documents at once: the occurrences of
+  # the lists of every document are sorted by position, and for each 
+  # occurrence, the window that ends there starts at the latest preceding
+  # occurrence of the list that occurred least recently
+  # inputs:
+  #   doc_ords, positions, list_ids: integer arrays of the same length, 
+  #     listing the positions of each list (numbered 0, 1, ..., num_lists - 1)
+  #     in each document
+  #   num_lists: an integer, the number of lists
+  # output: two arrays, the sorted ordinals of the documents, and the 
+  #         length of the shortest window of each (np.inf if a list is empty)
+  order = np.lexsort((positions, doc_ords))
+  doc_ords, positions, list_ids = \
+    doc_ords[order], positions[order], list_ids[order]
+  if len(doc_ords) == 0:
+    return(doc_ords, np.zeros(0))
+  doc_starts = np.flatnonzero(np.r_[True, doc_ords[1:] != doc_ords[:-1]])
+  idx = np.arange(len(doc_ords))
+  window_start = np.full(len(doc_ords), np.inf)
+  for list_id in range(num_lists):
+    # the latest occurrence of the list at or before each occurrence, if it
+    # is in the same document
+    latest = np.maximum.accumulate(np.where(list_ids == list_id, idx, -1))
+    found = (latest >= 0) & (doc_ords[np.maximum(latest, 0)] == doc_ords)
+    window_start = np.minimum(
+      window_start, np.where(found, positions[np.maximum(latest, 0)], -np.inf)
+    )
+  spans = positions - window_start + 1
+  return(doc_ords[doc_starts], np.minimum.reduceat(spans, doc_starts))
+
+# function: load_stop_words ---------------------------------------------------
+def load_stop_words():
+  # import stop words
+  with open('./data/stopwords.txt', 'r',
+            encoding = "UTF-8") as f:
+    stop_words = [line.strip() for line in f]
+  return(stop_words)
+
+# function: load_indexes ------------------------------------------------------
+def load_indexes():
+  # build inverted index (or open the one saved by an earlier run)
+  return(Indexes(
+    documents = lazy_data.get("documents"), 
+    doc_id = lazy_data.get("doc_id"), 
+    stop_words = lazy_data.get("stop_words"),
+    stem = False,
+    speakers = lazy_data.get("speakers")
+  ))
 
 # -----------------------------------------------------------------------------
-# import stop words
-with open('./data/stopwords.txt', 'r',
-          encoding = "UTF-8") as f:
-  stop_words = [line.strip() for line in f]
-  f.close()
-
-# set up documents and doc_id
-documents = script_utterance.transcript.tolist()
-doc_id = script_utterance.u_id.tolist()
-
-# build inverted index
-indexes = Indexes(
-  documents = documents, 
-  doc_id = doc_id, 
-  stop_words = stop_words,
-  stem = False
-)
+# the data below is loaded when it is first used (e.g. by 
+# get_retrieval_results, or `from inverted_index import indexes`), not when
+# inverted_index is imported (see helper_func.LazyAttributes)
+#  - stop_words: the list of stop words
+#  - documents, doc_id, speakers: the transcript, utterance ID and speakers
+#    of each utterance in the script data
+#  - indexes: the Indexes object searched by get_retrieval_results (replaced
+#    by update_index)
+lazy_data = LazyAttributes(globals(), dict(
+  stop_words = load_stop_words,
+  documents = lambda: data_prep.script_utterance.transcript.tolist(),
+  doc_id = lambda: data_prep.script_utterance.u_id.tolist(),
+  speakers = lambda: data_prep.script_utterance.speakers.tolist(),
+  indexes = load_indexes
+))
+__getattr__ = lazy_data.get
+
+# serializes the calls to update_index
+index_update_lock = threading.Lock()
+
+# the sharding.ShardPool object that ranks the queries, or None to rank 
+# them in this process (see use_shards)
+shards = None
+
+# cache the results of popular queries (see get_retrieval_results)
+RESULT_CACHE_SIZE = 4096 # maximum number of cached queries
+RESULT_CACHE_TTL = 3600 # seconds before a cached result expires
+result_cache = LRUCache(max_size = RESULT_CACHE_SIZE, ttl = RESULT_CACHE_TTL)
+
+# keep the ranked lists of the queries being paged through (see 
+# get_ranked_page)
+RANKING_DEPTH = 1000 # number of top documents a client can page through
+RANKING_CACHE_SIZE = 1024 # maximum number of cached ranked lists
+RANKING_CACHE_TTL = 600 # seconds before a cached ranked list expires
+ranking_cache = LRUCache(max_size = RANKING_CACHE_SIZE, 
+                         ttl = RANKING_CACHE_TTL)
+# report their hits and misses at /metrics
+cache_metrics.register("result", result_cache)
+cache_metrics.register("ranking", ranking_cache)
 
 if __name__ == "__main__":
   result_list = get_retrieval_results(
@@ -287,4 +1288,4 @@ if __name__ == "__main__":
   )
   print(result_list)
   # for u_id in result_list:
-  #    print(get_script_with_uid(script_utterance, u_id))
+  #    print(data_prep.get_script_with_uid(data_prep.script_utterance, u_id))
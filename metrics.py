@@ -0,0 +1,227 @@
+from contextvars import ContextVar
+from bisect import bisect_left
+import threading
+import time
+
+# Purpose: This script defines class StageMetrics, which records how long
+#          each stage of a search request (and each phase of loading and
+#          building the data) takes in histograms, and renders them in the
+#          Prometheus text format (see the /metrics route in web_ui.py).
+#          Recording a duration takes about a microsecond. The durations of
+#          the current request can also be collected in a trace (see
+#          start_trace), which web_ui.py returns in a Server-Timing header.
+#          Class CacheMetrics reports the hits, misses and entries of the
+#          caches of the search engine (see cache.LRUCache).
+#          Each process keeps its own metrics (e.g. each gunicorn worker).
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+# the upper bounds (in sec) of the histogram buckets of request stages and
+# of the load and build phases
+STAGE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                 5.0, 10.0)
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                 120.0, 300.0, 600.0)
+
+# the stages of the current request and their durations (a dictionary), or
+# None if the durations are not being traced (see start_trace)
+current_trace = ContextVar("current_trace", default = None)
+
+class Histogram:
+  def __init__(self, buckets):
+    # input - buckets: a sorted tuple of the upper bounds of the buckets
+    self.buckets = buckets
+    # self.counts[i]: the number of values in bucket i, i.e. larger than
+    # buckets[i - 1] and not larger than buckets[i]; the last bucket holds
+    # the values larger than all bounds
+    self.counts = [0] * (len(buckets) + 1)
+    self.total = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    i = bisect_left(self.buckets, value)
+    with self.lock:
+      self.counts[i] += 1
+      self.total += value
+
+  def snapshot(self):
+    # returns a tuple of the cumulative count of each bucket (as Prometheus
+    # reports them, the last one is the number of values), and the sum of
+    # the values
+    with self.lock:
+      counts, total = list(self.counts), self.total
+    cumulative = []
+    count = 0
+    for bucket_count in counts:
+      count += bucket_count
+      cumulative.append(count)
+    return(cumulative, total)
+
+class Timer:
+  # a context manager that records the time spent in its block, e.g.
+  #   with stage_seconds.time("tokenize"):
+  #     ...
+  __slots__ = ("metrics", "stage", "time_start")
+
+  def __init__(self, metrics, stage):
+    self.metrics = metrics
+    self.stage = stage
+
+  def __enter__(self):
+    self.time_start = time.perf_counter()
+    return(self)
+
+  def __exit__(self, *exc_info):
+    self.metrics.observe(self.stage, time.perf_counter() - self.time_start)
+    return(False)
+
+class StageMetrics:
+  def __init__(self, name, description, buckets = STAGE_BUCKETS,
+               label = "stage"):
+    # inputs:
+    #   name: the name of the Prometheus metric (a histogram)
+    #   description: its help text
+    #   buckets: the upper bounds (in sec) of the histogram buckets
+    #   label: the name of the label that tells the stages apart
+    self.name = name
+    self.description = description
+    self.buckets = buckets
+    self.label = label
+    # self.histograms: a dictionary that maps a stage to its Histogram
+    self.histograms = dict()
+    self.lock = threading.Lock()
+
+  def observe(self, stage, seconds):
+    # record that the stage took the given number of seconds
+    histogram = self.histograms.get(stage)
+    if histogram is None:
+      with self.lock:
+        histogram = self.histograms.setdefault(stage,
+                                               Histogram(self.buckets))
+    histogram.observe(seconds)
+    trace = current_trace.get()
+    if trace is not None:
+      trace[stage] = trace.get(stage, 0.0) + seconds
+
+  def time(self, stage):
+    # returns a context manager that records the time spent in its block
+    return(Timer(self, stage))
+
+  def totals(self):
+    # returns a dictionary that maps each stage to a tuple (number of times
+    # recorded, total seconds)
+    totals = dict()
+    for stage, histogram in list(self.histograms.items()):
+      cumulative, total = histogram.snapshot()
+      totals[stage] = (cumulative[-1], total)
+    return(totals)
+
+  def render(self):
+    # returns the histograms in the Prometheus text exposition format
+    lines = [f"# HELP {self.name} {self.description}",
+             f"# TYPE {self.name} histogram"]
+    for stage, histogram in sorted(self.histograms.items()):
+      cumulative, total = histogram.snapshot()
+      stage_label = '{}="{}"'.format(self.label, escape_label(stage))
+      for bound, count in zip(
+        ["{:g}".format(bound) for bound in self.buckets] + ["+Inf"],
+        cumulative
+      ):
+        lines.append(f'{self.name}_bucket{{{stage_label},le="{bound}"}} '
+                     f'{count}')
+      lines.append(f"{self.name}_sum{{{stage_label}}} {total!r}")
+      lines.append(f"{self.name}_count{{{stage_label}}} {cumulative[-1]}")
+    return("\n".join(lines) + "\n")
+
+class CacheMetrics:
+  # the hit and miss counters and the number of entries of named caches 
+  # (cache.LRUCache objects), read from the caches when they are rendered
+  def __init__(self):
+    # self.caches: a dictionary that maps a name to a cache
+    self.caches = dict()
+    self.lock = threading.Lock()
+
+  def register(self, name, cache):
+    # report the counters of the cache under the given name (in place of 
+    # the cache registered under that name before, if any)
+    with self.lock:
+      self.caches[name] = cache
+
+  def render(self):
+    # returns the counters in the Prometheus text exposition format
+    with self.lock:
+      caches = sorted(self.caches.items())
+    cache_stats = [(name, cache.stats()) for name, cache in caches]
+    lines = []
+    for name, key, metric_type, description in [
+      ("friends_cache_hits_total", "hits", "counter", 
+       "Lookups that found a valid entry in each cache."),
+      ("friends_cache_misses_total", "misses", "counter", 
+       "Lookups that found no valid entry in each cache."),
+      ("friends_cache_entries", "size", "gauge", 
+       "Number of entries in each cache.")
+    ]:
+      lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+      for cache_name, stats in cache_stats:
+        lines.append('{}{{cache="{}"}} {}'.format(
+          name, escape_label(cache_name), stats[key]
+        ))
+    return("\n".join(lines) + "\n")
+
+# function: escape_label ------------------------------------------------------
+def escape_label(value):
+  # escape a label value for the Prometheus text format
+  return(str(value).replace("\\", "\\\\").replace("\n", "\\n")
+         .replace('"', '\\"'))
+
+# function: start_trace -------------------------------------------------------
+def start_trace():
+  # start collecting the durations recorded by the current thread (e.g.
+  # while it serves a request), returns a token to pass to end_trace
+  return(current_trace.set(dict()))
+
+# function: get_trace ---------------------------------------------------------
+def get_trace():
+  # returns the durations recorded since start_trace so far (see end_trace),
+  # or None if no trace has been started
+  return(current_trace.get())
+
+# function: end_trace ---------------------------------------------------------
+def end_trace(token):
+  # stop collecting durations, returns a dictionary that maps each stage
+  # recorded since start_trace to its total duration (in sec)
+  trace = current_trace.get()
+  current_trace.reset(token)
+  return(trace)
+
+# function: format_server_timing ----------------------------------------------
+def format_server_timing(trace):
+  # returns the value of a Server-Timing HTTP header (shown by the browser's
+  # developer tools) for the trace (see end_trace), in milliseconds
+  return(", ".join(["{};dur={:.3f}".format(stage, seconds * 1000)
+                    for stage, seconds in trace.items()]))
+
+# function: render_all --------------------------------------------------------
+def render_all():
+  # returns all metrics of this process in the Prometheus text format
+  return("".join([metrics.render() for metrics in [
+    request_seconds, stage_seconds, phase_seconds, cache_metrics
+  ]]))
+
+# the metrics of this process
+request_seconds = StageMetrics(
+  "friends_request_seconds", "Time spent serving each web app route.",
+  label = "endpoint"
+)
+stage_seconds = StageMetrics(
+  "friends_search_stage_seconds",
+  "Time spent in each stage of a search request."
+)
+phase_seconds = StageMetrics(
+  "friends_phase_seconds",
+  "Time spent in each phase of loading and building the data.",
+  buckets = PHASE_BUCKETS, label = "phase"
+)
+# the caches of the search engine (registered by the modules that own them)
+cache_metrics = CacheMetrics()
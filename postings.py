@@ -0,0 +1,581 @@
+import numpy as np
+import hashlib
+import errno
+import shutil
+import json
+import uuid
+import os
+import tempfile
+import time
+
+from helper_func import measure_time
+
+# Purpose: This script defines class PostingsStore, a compact, array-backed
+#          inverted index. Terms are mapped to integer IDs, and the postings
+#          of all terms are stored in contiguous NumPy arrays (CSR layout):
+#            - offsets[t]:offsets[t + 1] is the slice of doc_ords and freqs
+#              that holds the postings of the term with ID t
+#            - doc_ords: document ordinals (positions in Indexes.doc_id),
+#              sorted within each posting list
+#            - freqs: term frequency of the term in each document
+#            - pos_offsets[p]:pos_offsets[p + 1] is the slice of positions
+#              that holds the token positions of posting p
+#          It also defines functions write_index and read_index, which save 
+#          and open the binary index directory (see write_index for the 
+#          layout). The arrays are opened as memory maps, so opening an index
+#          is almost free and processes that open the same index share the
+#          same pages of the page cache.
+#          Class SegmentedStore combines several PostingsStore objects (the
+#          segments added by incremental updates) into one searchable store.
+#          The index directories are kept in a cache directory, one for each
+#          combination of corpus, stop words and tokenizer settings (see 
+#          get_index_key), so indexes built with different settings do not
+#          overwrite each other.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+class PostingsStore:
+  def __init__(self, terms, offsets, doc_ords, freqs, pos_offsets, positions):
+    self.terms = list(terms) # a list of terms, sorted, indexed by term ID
+    # self.term_ids: a dictionary that maps a term to its integer ID
+    self.term_ids = dict(zip(self.terms, range(len(self.terms))))
+    self.offsets = offsets
+    self.doc_ords = doc_ords
+    self.freqs = freqs
+    self.pos_offsets = pos_offsets
+    self.positions = positions
+
+  @classmethod
+  @measure_time
+  def from_doc_tokens(cls, doc_tokens_list, stop_words, doc_ords = None):
+    # build the store from tokenized documents
+    # inputs:
+    #   doc_tokens_list: an iterable of token lists, in document order (the
+    #                    i-th list is the document with ordinal i)
+    #   stop_words: a collection of terms that are not indexed
+    #   doc_ords: a sorted list of the ordinals of the documents in 
+    #             doc_tokens_list (None: 0, 1, 2, ...)
+    stop_words = set(stop_words)
+    # term_postings: a dictionary that maps a term to a list of
+    # [doc_ords (list), freqs (list), positions (list of lists)]
+    term_postings = dict()
+    for i, doc_tokens in enumerate(doc_tokens_list):
+      # print processing status every 2000 documents
+      if i % 2000 == 0:
+        print("    Processing document # {:5d} ...".format(i))
+      doc_ord = i if doc_ords is None else doc_ords[i]
+      doc_positions = dict()
+      for pos, term in enumerate(doc_tokens):
+        if term in stop_words:
+          continue
+        if term not in doc_positions:
+          doc_positions[term] = []
+        doc_positions[term].append(pos)
+      for term, pos_list in doc_positions.items():
+        if term not in term_postings:
+          term_postings[term] = [[], [], []]
+        term_postings[term][0].append(doc_ord)
+        term_postings[term][1].append(len(pos_list))
+        term_postings[term][2].append(pos_list)
+
+    terms = sorted(term_postings)
+    doc_freq = [len(term_postings[term][0]) for term in terms]
+    offsets = np.zeros(len(terms) + 1, dtype = np.int64)
+    np.cumsum(doc_freq, out = offsets[1:])
+    doc_ords = np.fromiter(
+      (d for term in terms for d in term_postings[term][0]),
+      dtype = np.int32, count = offsets[-1]
+    )
+    freqs = np.fromiter(
+      (f for term in terms for f in term_postings[term][1]),
+      dtype = np.int32, count = offsets[-1]
+    )
+    pos_offsets = np.zeros(len(freqs) + 1, dtype = np.int64)
+    np.cumsum(freqs, out = pos_offsets[1:])
+    positions = np.fromiter(
+      (p for term in terms
+         for pos_list in term_postings[term][2] for p in pos_list),
+      dtype = np.int32, count = pos_offsets[-1]
+    )
+    return(cls(terms, offsets, doc_ords, freqs, pos_offsets, positions))
+
+  @property
+  def num_postings(self):
+    return(len(self.doc_ords))
+
+  @property
+  def nbytes(self):
+    return(sum(arr.nbytes for arr in (
+      self.offsets, self.doc_ords, self.freqs, self.pos_offsets,
+      self.positions
+    )))
+
+  def doc_freq(self):
+    # returns an integer array, the document frequency of each term
+    return(np.diff(self.offsets))
+
+  def corpus_term_freq(self):
+    # returns an integer array, the total frequency of each term in the 
+    # corpus (i.e. all documents)
+    if len(self.terms) == 0:
+      return(np.zeros(0, dtype = np.int64))
+    return(np.add.reduceat(
+      self.freqs.astype(np.int64), self.offsets[:-1].astype(np.intp)
+    ))
+
+  def term_id(self, term):
+    # returns the ID of the given term, or None if the term is not indexed
+    return(self.term_ids.get(term))
+
+  def postings(self, term):
+    # returns two arrays (views, not copies): the ordinals of the documents
+    # containing the term, and the term's frequency in each of them
+    term_id = self.term_ids.get(term)
+    if term_id is None:
+      return(self.doc_ords[0:0], self.freqs[0:0])
+    start, end = self.offsets[term_id], self.offsets[term_id + 1]
+    return(self.doc_ords[start:end], self.freqs[start:end])
+
+  def freq(self, term, doc_ord):
+    # returns the frequency of the term in the document with ordinal doc_ord
+    term_id = self.term_ids.get(term)
+    if term_id is None:
+      return(0)
+    start, end = self.offsets[term_id], self.offsets[term_id + 1]
+    idx = start + np.searchsorted(self.doc_ords[start:end], doc_ord)
+    if idx < end and self.doc_ords[idx] == doc_ord:
+      return(int(self.freqs[idx]))
+    return(0)
+
+  def positions_of(self, posting_idx):
+    # returns the token positions stored for posting number posting_idx
+    return(self.positions[
+      self.pos_offsets[posting_idx]:self.pos_offsets[posting_idx + 1]
+    ])
+
+  def positions_in_docs(self, term, doc_ords):
+    # returns two arrays of the same length, listing every occurrence of the
+    # term in the given documents: the document ordinal and the position
+    # input - doc_ords: a sorted array (or list) of document ordinals
+    doc_ords = np.asarray(doc_ords, dtype = np.int64)
+    term_id = self.term_ids.get(term)
+    if term_id is None:
+      return(doc_ords[0:0], self.positions[0:0])
+    start, end = self.offsets[term_id], self.offsets[term_id + 1]
+    idx, hit = lookup(self.doc_ords[start:end], doc_ords)
+    posting_idx = start + idx[hit]
+    pos_start = self.pos_offsets[posting_idx]
+    counts = self.pos_offsets[posting_idx + 1] - pos_start
+    owner = np.repeat(np.arange(len(posting_idx)), counts)
+    return(doc_ords[hit][owner], 
+           gather_ragged(self.positions, pos_start, counts))
+
+
+class SegmentedStore:
+  # a read-only view of several PostingsStore objects (segments) as one 
+  # store; each segment holds the postings of a disjoint set of documents 
+  # at the time it was built, and a document that has been re-indexed in a
+  # later segment is marked as deleted in the earlier ones
+  # (see Indexes.update_documents)
+  def __init__(self, segments):
+    # input - segments: a list of tuples (store, deleted), where store is a
+    #   PostingsStore object and deleted is None or a boolean array indexed
+    #   by document ordinal (True: ignore the postings of the document)
+    self.segments = segments
+
+  @property
+  def num_postings(self):
+    return(sum(store.num_postings for store, _ in self.segments))
+
+  @property
+  def nbytes(self):
+    return(sum(store.nbytes for store, _ in self.segments))
+
+  def postings(self, term):
+    # see PostingsStore.postings (returns copies if the term occurs in more
+    # than one segment)
+    parts = [part for part in self.iter_segments(
+      lambda store: store.postings(term)
+    ) if len(part[0]) > 0]
+    if len(parts) == 0:
+      return(np.zeros(0, dtype = np.int32), np.zeros(0, dtype = np.int32))
+    if len(parts) == 1:
+      return(parts[0])
+    doc_ords = np.concatenate([part[0] for part in parts])
+    freqs = np.concatenate([part[1] for part in parts])
+    order = np.argsort(doc_ords, kind = "stable")
+    return(doc_ords[order], freqs[order])
+
+  def freq(self, term, doc_ord):
+    # see PostingsStore.freq
+    for store, deleted in self.segments:
+      if deleted is not None and doc_ord < len(deleted) and deleted[doc_ord]:
+        continue
+      tf = store.freq(term, doc_ord)
+      if tf > 0:
+        return(tf)
+    return(0)
+
+  def positions_in_docs(self, term, doc_ords):
+    # see PostingsStore.positions_in_docs
+    parts = list(self.iter_segments(
+      lambda store: store.positions_in_docs(term, doc_ords)
+    ))
+    if len(parts) == 1:
+      return(parts[0])
+    term_doc_ords = np.concatenate([part[0] for part in parts])
+    positions = np.concatenate([part[1] for part in parts])
+    order = np.lexsort((positions, term_doc_ords))
+    return(term_doc_ords[order], positions[order])
+
+  def iter_segments(self, get_arrays):
+    # yields get_arrays(store) for each segment, a tuple of arrays whose 
+    # first array holds document ordinals, without the deleted documents
+    for store, deleted in self.segments:
+      arrays = get_arrays(store)
+      if deleted is not None and len(arrays[0]) > 0:
+        keep = ~deleted[arrays[0]]
+        arrays = tuple(arr[keep] for arr in arrays)
+      yield(arrays)
+
+  @measure_time
+  def merge(self):
+    # returns a PostingsStore object that holds the postings of all segments
+    # except the deleted ones; it is identical to the store built from 
+    # scratch with PostingsStore.from_doc_tokens
+    terms = sorted(set().union(*(store.terms for store, _ in self.segments)))
+    term_ids = dict(zip(terms, range(len(terms))))
+    # flatten the postings of each segment into parallel arrays
+    parts = []
+    for store, deleted in self.segments:
+      seg_term_ids = np.fromiter(
+        (term_ids[term] for term in store.terms), dtype = np.int64, 
+        count = len(store.terms)
+      )
+      doc_ords = np.asarray(store.doc_ords)
+      keep = np.ones(len(doc_ords), dtype = bool) if deleted is None else \
+             ~deleted[doc_ords]
+      pos_start = np.asarray(store.pos_offsets[:-1])[keep]
+      counts = np.diff(store.pos_offsets)[keep]
+      parts.append((
+        np.repeat(seg_term_ids, np.diff(store.offsets))[keep], 
+        doc_ords[keep], np.asarray(store.freqs)[keep], counts, 
+        gather_ragged(store.positions, pos_start, counts)
+      ))
+    posting_terms, doc_ords, freqs, counts, positions = (
+      np.concatenate([part[i] for part in parts]) for i in range(5)
+    )
+    # sort the postings by term, then by document, and drop the terms that 
+    # only occurred in deleted documents
+    order = np.lexsort((doc_ords, posting_terms))
+    doc_freq = np.bincount(posting_terms, minlength = len(terms))
+    used = np.flatnonzero(doc_freq)
+    offsets = np.zeros(len(used) + 1, dtype = np.int64)
+    np.cumsum(doc_freq[used], out = offsets[1:])
+    pos_offsets = np.zeros(len(order) + 1, dtype = np.int64)
+    np.cumsum(counts[order], out = pos_offsets[1:])
+    positions = gather_ragged(
+      positions, (np.cumsum(counts) - counts)[order], counts[order]
+    )
+    return(PostingsStore(
+      [terms[i] for i in used.tolist()], offsets, 
+      doc_ords[order].astype(np.int32), freqs[order].astype(np.int32),
+      pos_offsets, positions.astype(np.int32)
+    ))
+
+
+# function: gather_ragged -----------------------------------------------------
+def gather_ragged(values, starts, counts):
+  # returns the concatenation of values[starts[i]:(starts[i] + counts[i])]
+  # for each i, gathered in one step
+  counts = np.asarray(counts, dtype = np.int64)
+  owner = np.repeat(np.arange(len(counts)), counts)
+  within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+  return(values[np.asarray(starts, dtype = np.int64)[owner] + within])
+
+# function: lookup ------------------------------------------------------------
+def lookup(sorted_ords, query_ords):
+  # find query_ords in the sorted array sorted_ords
+  # output: a tuple (idx, hit), where hit is a boolean array indicating 
+  #         whether each element of query_ords is in sorted_ords, and 
+  #         sorted_ords[idx[hit]] == query_ords[hit]
+  idx = np.searchsorted(sorted_ords, query_ords)
+  idx[idx == len(sorted_ords)] = 0
+  hit = sorted_ords[idx] == query_ords if len(sorted_ords) > 0 else \
+        np.zeros(len(query_ords), dtype = bool)
+  return(idx, hit)
+
+# the version of the binary index format, increase it whenever the layout
+# of the index directory changes
+INDEX_FORMAT_VERSION = 2
+INDEX_ARRAYS = ["offsets", "doc_ords", "freqs", "pos_offsets", "positions",
+                "doc_freq", "corpus_term_freq", "doc_length",
+                "speaker_offsets", "speaker_doc_ords"]
+INDEX_LINES = ["vocabulary.txt", "doc_ids.txt", "speakers.txt"]
+# the number of most recently used indexes kept in the index cache (see 
+# prune_index_cache)
+INDEX_CACHE_SIZE = 4
+# the number of seconds after which a temporary directory of write_index is
+# considered left behind by a process that died, and deleted (see 
+# prune_index_cache)
+TMP_DIR_MAX_AGE = 24 * 3600
+
+# function: build_speaker_index -----------------------------------------------
+def build_speaker_index(doc_speakers):
+  # build a speaker -> document ordinals index (CSR layout, same as the
+  # postings in PostingsStore); a document spoken by several speakers 
+  # (e.g. "Monica Geller, Rachel Green") is indexed under each of them
+  # input - doc_speakers: a list of strings, the speakers of each document
+  # output: a tuple (speakers, offsets, doc_ords), where speakers is a sorted
+  #         list of names, and doc_ords[offsets[i]:offsets[i + 1]] are the
+  #         sorted ordinals of the documents spoken by speakers[i]
+  speaker_docs = dict()
+  for doc_ord, speakers in enumerate(doc_speakers):
+    if not isinstance(speakers, str): # missing speakers
+      continue
+    for speaker in set(speakers.split(", ")):
+      if speaker not in speaker_docs:
+        speaker_docs[speaker] = []
+      speaker_docs[speaker].append(doc_ord)
+  speakers = sorted(speaker_docs)
+  offsets = np.zeros(len(speakers) + 1, dtype = np.int64)
+  np.cumsum([len(speaker_docs[name]) for name in speakers], out = offsets[1:])
+  doc_ords = np.fromiter(
+    (d for name in speakers for d in speaker_docs[name]),
+    dtype = np.int32, count = offsets[-1]
+  )
+  return(speakers, offsets, doc_ords)
+
+# function: update_speaker_index ----------------------------------------------
+def update_speaker_index(speaker_index, doc_speakers):
+  # returns a copy of speaker_index (see build_speaker_index), in which the 
+  # given documents are (re-)indexed under their new speakers
+  # input - doc_speakers: a dictionary that maps a document ordinal to its
+  #         speakers (a string, or None if the speakers are missing)
+  speakers, offsets, doc_ords = speaker_index
+  new_speakers = {speaker for value in doc_speakers.values() 
+                          if isinstance(value, str) 
+                          for speaker in value.split(", ")}
+  names = sorted(set(speakers) | new_speakers)
+  name_ids = dict(zip(names, range(len(names))))
+  # (speaker ID, document ordinal) pairs: the existing pairs of the other 
+  # documents, and the pairs of the given documents
+  old_ids = np.array([name_ids[name] for name in speakers], dtype = np.int64)
+  pair_ids = [old_ids[np.repeat(np.arange(len(speakers)), np.diff(offsets))]]
+  pair_ords = [np.asarray(doc_ords, dtype = np.int64)]
+  keep = ~np.isin(pair_ords[0], list(doc_speakers))
+  pair_ids[0], pair_ords[0] = pair_ids[0][keep], pair_ords[0][keep]
+  for doc_ord, value in doc_speakers.items():
+    if not isinstance(value, str):
+      continue
+    for speaker in set(value.split(", ")):
+      pair_ids.append([name_ids[speaker]])
+      pair_ords.append([doc_ord])
+  pair_ids = np.concatenate(pair_ids).astype(np.int64)
+  pair_ords = np.concatenate(pair_ords).astype(np.int64)
+  # speakers without documents are dropped, as in build_speaker_index
+  order = np.lexsort((pair_ords, pair_ids))
+  counts = np.bincount(pair_ids, minlength = len(names))
+  used = np.flatnonzero(counts)
+  offsets = np.zeros(len(used) + 1, dtype = np.int64)
+  np.cumsum(counts[used], out = offsets[1:])
+  return([names[i] for i in used.tolist()], offsets, 
+         pair_ords[order].astype(np.int32))
+
+# function: hash_strings ------------------------------------------------------
+def hash_strings(strings):
+  # returns the SHA-256 hex digest of a list of strings (and their order)
+  digest = hashlib.sha256(str(len(strings)).encode("UTF-8"))
+  digest.update("\0".join(str(x) for x in strings).encode("UTF-8"))
+  return(digest.hexdigest())
+
+# function: get_index_key -----------------------------------------------------
+def get_index_key(documents, doc_id, speakers, stop_words, **settings):
+  # returns the name of the directory of the index cache that holds the 
+  # index of the given data, e.g. "v2-stem0-1a2b3c4d-5e6f7a8b9c0d1e2f": the
+  # index format version, the tokenizer settings, a hash of the stop words
+  # and a fingerprint of the corpus (the documents, their IDs and their 
+  # speakers), so an index is only opened for the data it was built from
+  # inputs:
+  #   documents, doc_id, speakers: lists of the text, ID and speakers of 
+  #                                each document (speakers can be None)
+  #   stop_words: a collection of terms that are not indexed
+  #   **settings: tokenizer settings (e.g. stem)
+  if speakers is None:
+    speakers = [""] * len(documents)
+  corpus = hashlib.sha256("".join(
+    hash_strings(strings) for strings in [documents, doc_id, speakers]
+  ).encode("UTF-8")).hexdigest()
+  return("-".join(
+    ["v{}".format(INDEX_FORMAT_VERSION)] + 
+    ["{}{}".format(name, int(value) if isinstance(value, bool) else value)
+     for name, value in sorted(settings.items())] + 
+    [hash_strings(sorted(set(stop_words)))[:8], corpus[:16]]
+  ))
+
+# function: mark_index_used ---------------------------------------------------
+def mark_index_used(index_dir):
+  # record that the index in index_dir was opened (see prune_index_cache)
+  try:
+    os.utime(os.path.join(index_dir, "meta.json"))
+  except OSError:
+    pass
+
+# function: prune_index_cache -------------------------------------------------
+def prune_index_cache(cache_dir, keep = INDEX_CACHE_SIZE):
+  # delete all but the `keep` most recently used indexes in the index cache
+  # cache_dir (processes that have an index open keep reading the deleted
+  # files until they close them), and the temporary directories of 
+  # write_index older than TMP_DIR_MAX_AGE
+  # output: a list of the names of the deleted index directories
+  entries = []
+  for name in os.listdir(cache_dir):
+    path = os.path.join(cache_dir, name)
+    meta_path = os.path.join(path, "meta.json")
+    if name.endswith(".tmp"):
+      try:
+        if time.time() - os.path.getmtime(path) > TMP_DIR_MAX_AGE:
+          shutil.rmtree(path, ignore_errors = True)
+      except OSError:
+        pass
+    elif os.path.exists(meta_path):
+      entries.append((os.path.getmtime(meta_path), name))
+  entries.sort(reverse = True)
+  deleted = [name for _, name in entries[keep:]]
+  for name in deleted:
+    shutil.rmtree(os.path.join(cache_dir, name), ignore_errors = True)
+  return(deleted)
+
+# function: write_index -------------------------------------------------------
+@measure_time
+def write_index(index_dir, store, doc_id, doc_length, speaker_index, 
+                **settings):
+  # save the index to index_dir, which will contain
+  #   - meta.json: format version, build ID, counts and tokenizer settings
+  #   - vocabulary.txt: one term per line, in the order of term IDs
+  #   - doc_ids.txt: one document ID per line, in the order of ordinals
+  #   - speakers.txt: one speaker per line, in the order of speaker IDs
+  #   - one .npy file for each array in INDEX_ARRAYS
+  # inputs:
+  #   store: a PostingsStore object
+  #   doc_id: a list of document IDs, indexed by document ordinal
+  #   doc_length: an array of document lengths, indexed by document ordinal
+  #   speaker_index: the output of build_speaker_index
+  #   **settings: tokenizer settings (e.g. stem) to be recorded in meta.json
+  # the index is written to a new directory with a unique name next to 
+  # index_dir (so processes writing the same index at the same time, e.g. 
+  # build_index.py and a starting server, do not write into each other's 
+  # directory) and moved into place at the end (see replace_index_dir), so
+  # a reader never sees a partially written index
+  index_dir = index_dir.rstrip("/")
+  parent_dir = os.path.dirname(os.path.abspath(index_dir))
+  os.makedirs(parent_dir, exist_ok = True)
+  tmp_dir = tempfile.mkdtemp(
+    dir = parent_dir, prefix = os.path.basename(index_dir) + ".", 
+    suffix = ".tmp"
+  )
+  # (mkdtemp makes the directory readable by its owner only)
+  os.chmod(tmp_dir, 0o755)
+  try:
+    write_index_files(tmp_dir, store, doc_id, doc_length, speaker_index, 
+                      settings)
+  except BaseException:
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+    raise
+  replace_index_dir(tmp_dir, index_dir)
+
+def write_index_files(tmp_dir, store, doc_id, doc_length, speaker_index, 
+                      settings):
+  # write the files of the index to tmp_dir (see write_index)
+  arrays = dict(
+    offsets = store.offsets, doc_ords = store.doc_ords, freqs = store.freqs,
+    pos_offsets = store.pos_offsets, positions = store.positions,
+    doc_freq = store.doc_freq(), corpus_term_freq = store.corpus_term_freq(),
+    doc_length = np.asarray(doc_length, dtype = np.float64),
+    speaker_offsets = speaker_index[1], speaker_doc_ords = speaker_index[2]
+  )
+  for name in INDEX_ARRAYS:
+    np.save(os.path.join(tmp_dir, f"{name}.npy"), arrays[name])
+  for file_name, lines in zip(INDEX_LINES, 
+                              [store.terms, doc_id, speaker_index[0]]):
+    with open(os.path.join(tmp_dir, file_name), 'w', encoding = "UTF-8") as f:
+      f.write("\n".join(str(line) for line in lines))
+  meta = dict(
+    format_version = INDEX_FORMAT_VERSION,
+    build_id = uuid.uuid4().hex,
+    doc_count = len(doc_id),
+    num_terms = len(store.terms),
+    num_postings = store.num_postings,
+    settings = settings
+  )
+  with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+    json.dump(meta, f, indent = 2)
+
+# function: replace_index_dir -------------------------------------------------
+def replace_index_dir(tmp_dir, index_dir):
+  # move the index written to tmp_dir to index_dir: an index that is already
+  # there is first renamed aside (to a unique name, and deleted after), so
+  # index_dir is only missing between two renames; if another process moves
+  # its index into place in the meantime, that complete index is kept and
+  # tmp_dir is deleted
+  old_dir = None
+  if os.path.exists(index_dir):
+    old_dir = tempfile.mkdtemp(
+      dir = os.path.dirname(tmp_dir), 
+      prefix = os.path.basename(index_dir) + ".", suffix = ".tmp"
+    )
+    try:
+      os.replace(index_dir, old_dir)
+    except FileNotFoundError:
+      # another process has renamed it aside
+      pass
+  try:
+    os.rename(tmp_dir, index_dir)
+  except OSError as e:
+    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+      raise
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+  if old_dir is not None:
+    shutil.rmtree(old_dir, ignore_errors = True)
+
+# function: read_index --------------------------------------------------------
+@measure_time
+def read_index(index_dir):
+  # open the index saved in index_dir by write_index
+  # output: None if index_dir does not exist or was written in another format
+  #         version, otherwise a dictionary with keys
+  #           - meta: the content of meta.json
+  #           - store: a PostingsStore object backed by memory-mapped arrays
+  #           - doc_id: a list of document IDs
+  #           - speaker_index: a tuple (speakers, offsets, doc_ords), see
+  #             build_speaker_index
+  #           - doc_freq, corpus_term_freq, doc_length: memory-mapped arrays
+  meta_path = os.path.join(index_dir, "meta.json")
+  if not os.path.exists(meta_path):
+    print(f"Cannot find {index_dir}!")
+    return(None)
+  with open(meta_path) as f:
+    meta = json.load(f)
+  if meta.get("format_version") != INDEX_FORMAT_VERSION:
+    print(f"{index_dir} was written in an outdated format!")
+    return(None)
+  arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), 
+                          mmap_mode = "r") for name in INDEX_ARRAYS}
+  lines = dict()
+  for file_name in INDEX_LINES:
+    with open(os.path.join(index_dir, file_name), encoding = "UTF-8") as f:
+      content = f.read()
+      lines[file_name] = content.split("\n") if content else []
+  store = PostingsStore(
+    lines["vocabulary.txt"], arrays["offsets"], arrays["doc_ords"], 
+    arrays["freqs"], arrays["pos_offsets"], arrays["positions"]
+  )
+  return(dict(
+    meta = meta, store = store, doc_id = lines["doc_ids.txt"],
+    speaker_index = (lines["speakers.txt"], arrays["speaker_offsets"], 
+                     arrays["speaker_doc_ords"]),
+    doc_freq = arrays["doc_freq"], 
+    corpus_term_freq = arrays["corpus_term_freq"],
+    doc_length = arrays["doc_length"]
+  ))
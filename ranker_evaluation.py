@@ -1,8 +1,14 @@
 import pandas as pd
 import numpy as np
 import math
+import os
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
 
-from data_prep import query_list, query_relevance, uid_to_rowidx
+from helper_func import LazyAttributes
+import data_prep
 
 # Purpose: This script defines functions that are used to evaluate a 
 #          information retrieval model's performance. 
@@ -45,22 +51,144 @@ def calc_ndcg(rel_retrieved, rel_ideal):
   idcg = calc_dcg(rel_ideal)
   return(dcg / idcg)
 
+class Qrels:
+  # the query judgement data, indexed once into sorted NumPy arrays, so that
+  # the results of all queries are evaluated in a few grouped operations
+  # (the per-query functions above give the same numbers, one query at a 
+  # time)
+  def __init__(self, query_relevance, num_queries):
+    # inputs:
+    #   query_relevance: a pd.DataFrame object with columns 
+    #                    ["query_id", "doc_id", "relevance"]
+    #   num_queries: the number of queries, whose IDs are 0, 1, 2, ...
+    self.num_queries = num_queries
+    query_ids = query_relevance.query_id.to_numpy(dtype = np.int64)
+    doc_ids = query_relevance.doc_id.to_numpy(dtype = np.int64)
+    relevance = query_relevance.relevance.to_numpy(dtype = np.float64)
+    # self.keys: the sorted (query ID, document ID) pairs of the judgements,
+    # encoded as query_id * self.stride + doc_id, and self.relevance: the
+    # relevance score of each pair
+    self.stride = int(doc_ids.max()) + 1 if len(doc_ids) > 0 else 1
+    keys = query_ids * self.stride + doc_ids
+    order = np.argsort(keys, kind = "stable")
+    self.keys, self.relevance = keys[order], relevance[order]
+    # the ideal ranking of each query: self.ideal_relevance holds the
+    # relevance scores of each query sorted in descending order, and 
+    # self.ideal_rank the rank of each score within its query
+    order = np.lexsort((-relevance, query_ids))
+    self.ideal_query_ids = query_ids[order]
+    self.ideal_relevance = relevance[order]
+    self.ideal_rank = get_group_rank(self.ideal_query_ids)
+    # self.num_relevant: the number of relevant documents of each query
+    self.num_relevant = np.bincount(
+      query_ids[relevance > 0], minlength = num_queries
+    )
+
+  def get_relevance(self, query_ids, doc_ids):
+    # returns the relevance score of each (query, document) pair, 0 for the
+    # pairs that were not annotated
+    keys = query_ids * self.stride + doc_ids
+    idx = np.searchsorted(self.keys, keys)
+    idx[idx == len(self.keys)] = 0
+    hit = (doc_ids < self.stride) & (self.keys[idx] == keys) \
+          if len(self.keys) > 0 else np.zeros(len(keys), dtype = bool)
+    return(np.where(hit, self.relevance[idx], 0.0))
+
+  def evaluate(self, query_ids, doc_ids, num_result = None):
+    # evaluate ranked results of all queries at once
+    # inputs: 
+    #   query_ids, doc_ids: arrays of the same length, the retrieved 
+    #                       documents of each query, in ranked order
+    #   num_result: the cut-off k of the ideal ranking (NDCG@k), and of 
+    #               precision and recall (None: the number of documents
+    #               retrieved for query 0, as evaluate_query_result infers)
+    # output: a pd.DataFrame object with columns 
+    #         ["query_id", "ap", "ndcg", "precision", "recall"]
+    query_ids = np.asarray(query_ids, dtype = np.int64)
+    doc_ids = np.asarray(doc_ids, dtype = np.int64)
+    # group the results by query, keeping the ranked order of each query
+    order = np.argsort(query_ids, kind = "stable")
+    query_ids, doc_ids = query_ids[order], doc_ids[order]
+    rank = get_group_rank(query_ids)
+    if num_result is None:
+      num_result = int(np.sum(query_ids == 0))
+    relevance = self.get_relevance(query_ids, doc_ids)
+    is_relevant = relevance > 0
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+      # AP: the mean precision at the rank of each relevant document
+      # num_rel_above: the number of relevant documents ranked at or above
+      # each document of its query
+      cum_relevant = np.cumsum(is_relevant)
+      group_start = np.arange(len(rank)) - rank
+      num_rel_above = cum_relevant - cum_relevant[group_start] + \
+                      is_relevant[group_start]
+      ap = np.bincount(
+        query_ids[is_relevant], minlength = self.num_queries,
+        weights = num_rel_above[is_relevant] / (rank[is_relevant] + 1)
+      ) / np.bincount(query_ids[is_relevant], minlength = self.num_queries)
+      # NDCG: DCG of the retrieved documents over DCG of the ideal ranking
+      dcg = np.bincount(
+        query_ids, weights = relevance / get_discount(rank), 
+        minlength = self.num_queries
+      )
+      in_ideal = self.ideal_rank < num_result
+      idcg = np.bincount(
+        self.ideal_query_ids[in_ideal], minlength = self.num_queries,
+        weights = self.ideal_relevance[in_ideal] / 
+                  get_discount(self.ideal_rank[in_ideal])
+      )
+      ndcg = dcg / idcg
+      # precision and recall of the top num_result documents
+      top_relevant = is_relevant & (rank < num_result)
+      num_hits = np.bincount(query_ids[top_relevant], 
+                             minlength = self.num_queries)
+      precision = num_hits / num_result
+      recall = num_hits / self.num_relevant
+    return(pd.DataFrame(dict(
+      query_id = range(self.num_queries), ap = ap, ndcg = ndcg,
+      precision = precision, recall = recall
+    )))
+
+def get_group_rank(group_ids):
+  # returns the position of each element within its group, given an array
+  # in which the elements of each group are contiguous
+  if len(group_ids) == 0:
+    return(np.zeros(0, dtype = np.int64))
+  starts = np.flatnonzero(np.append(True, group_ids[1:] != group_ids[:-1]))
+  counts = np.diff(np.append(starts, len(group_ids)))
+  return(np.arange(len(group_ids)) - np.repeat(starts, counts))
+
+def get_discount(rank):
+  # the discount of the DCG at each (0-based) rank, see calc_dcg: the first
+  # document is not discounted, the others are divided by log2(rank + 1)
+  return(np.where(
+    rank == 0, 1.0, np.log(np.maximum(rank, 1) + 1) / np.log(2)
+  ))
+
 def evaluate_query_result(query_result):
-  # evaluate the ranker's performance using AP and NDCG
+  # evaluate the ranker's performance using AP and NDCG (and precision and
+  # recall at the number of documents retrieved for each query)
   # inputs: query_result, a pd.DataFrame object with two columns: 
-  #         ["query_id", "doc_id"]
-  # output: a pd.DataFrame object with columns ["query_id", "ap", "ndcg"]
+  #         ["query_id", "doc_id"], the documents retrieved for each query in
+  #         ranked order
+  # output: a pd.DataFrame object with columns 
+  #         ["query_id", "ap", "ndcg", "precision", "recall"]
+  return(lazy_data.get("qrels").evaluate(
+    query_result.query_id.to_numpy(), query_result.doc_id.to_numpy()
+  ))
 
-  # infer the number of documents retrieved for each query
+def evaluate_query_result_per_query(query_result):
+  # the same as evaluate_query_result (AP and NDCG only), computed query by 
+  # query with calc_avg_precision and calc_ndcg
+  query_list = data_prep.query_list
+  query_relevance = data_prep.query_relevance
   num_result = len(query_result.loc[query_result.query_id == 0])
-  # merge with query_relevance for get relevance score
   query_result = query_result.merge(
     query_relevance, how = "left", on = ["query_id", "doc_id"]
   )
-  # fill missing values (query-doc pairs that were not annotated) with zero
   query_result = query_result.fillna({'relevance': 0})
-  # evaluate query results using AP and NDCG
-  evaluation_result = pd.DataFrame(dict(
+  return(pd.DataFrame(dict(
     query_id = range(len(query_list)),
     ap = [calc_avg_precision(
       query_result.loc[query_result.query_id == q_id, "relevance"])
@@ -75,13 +203,131 @@ def evaluate_query_result(query_result):
       ].sort_values(ascending = False).head(num_result)
       ) for q_id in range(len(query_list))
     ]
+  )))
+
+# the query judgement data, indexed once (see Qrels) when it is first used
+lazy_data = LazyAttributes(globals(), dict(
+  qrels = lambda: Qrels(data_prep.query_relevance, len(data_prep.query_list))
+))
+__getattr__ = lazy_data.get
+
+# parameter sweeps ------------------------------------------------------------
+# the state shared by the worker processes of run_sweep: it is set up once 
+# before the workers are forked, so they inherit it (the index arrays are 
+# memory-mapped and shared copy-on-write) instead of receiving it with every
+# grid point
+sweep_state = dict()
+
+SWEEP_COLUMNS = ["ranker", "params", "ap", "ndcg"]
+
+def make_grid(ranker, **param_values):
+  # returns a list of (ranker, params) tuples, one for each combination of
+  # the given parameter values (the last parameter varies fastest)
+  # e.g. make_grid("bm25", k1 = [1.0, 1.2], b = [0.75])
+  names = list(param_values)
+  return([(ranker, dict(zip(names, values))) 
+          for values in product(*param_values.values())])
+
+def format_params(params):
+  # returns a string such as "k1=1.2, b=0.75", which identifies a grid point
+  # in the results table
+  return(', '.join(["{}={}".format(key, val) for key, val in params.items()]))
+
+def evaluate_grid_point(ranker, params):
+  # rank the test queries with the given ranker and parameters, and return
+  # a dictionary with the mean AP and NDCG (see SWEEP_COLUMNS); the queries
+  # are tokenized and phrase queries are matched once per sweep (see
+  # run_sweep), not once per grid point
+  indexes = sweep_state["indexes"]
+  results = indexes.rank_queries(
+    sweep_state["query_ctxs"], ranker, 
+    num_results = sweep_state["num_results"],
+    candidate_cache = sweep_state["candidate_cache"], **params
+  )
+  ranker_eval = lazy_data.get("qrels").evaluate(
+    np.repeat(np.arange(len(results)), 
+              [len(doc_ords) for doc_ords, _ in results]),
+    sweep_state["doc_rowidx"][np.concatenate(
+      [np.zeros(0, dtype = np.int64)] + [doc_ords for doc_ords, _ in results]
+    )]
+  )
+  return(dict(
+    ranker = ranker, params = format_params(params),
+    ap = ranker_eval.ap.mean(), ndcg = ranker_eval.ndcg.mean()
   ))
-  # evaluation_result = evaluation_result.append(dict(
-  #   query_id = None, 
-  #   ap = evaluation_result.ap.mean(),
-  #   ndcg = evaluation_result.ndcg.mean()
-  # ), ignore_index = True)
-  return(evaluation_result)
+
+def run_sweep(grid, output_path, num_workers = os.cpu_count(), 
+              num_results = 10):
+  # evaluate every grid point on the test queries, spreading the grid points
+  # across num_workers processes, and append one row per grid point to the
+  # CSV file output_path as soon as it is done; grid points that are 
+  # already in output_path (e.g. from a sweep that was killed) are skipped
+  # inputs:
+  #   grid: a list of (ranker, params) tuples (see make_grid)
+  #   num_results: the number of documents retrieved for each query
+  # output: a pd.DataFrame object with columns SWEEP_COLUMNS, the content of
+  #         output_path
+  from inverted_index import indexes
+  # keep the complete rows of an earlier run: rows are written whole, so
+  # anything after the last line break is a row that was cut off when the
+  # run was killed
+  done = set()
+  if os.path.exists(output_path):
+    with open(output_path, newline = '') as f:
+      content = f.read()
+    content = content[:(content.rfind("\n") + 1)]
+    with open(output_path, 'w', newline = '') as f:
+      f.write(content)
+    if content == "":
+      os.remove(output_path)
+    else:
+      finished = pd.read_csv(output_path)
+      done = set(zip(finished.ranker, finished.params))
+  todo = [(ranker, params) for ranker, params in grid 
+          if (ranker, format_params(params)) not in done]
+  print(f"{len(grid) - len(todo)} of {len(grid)} grid points already done.")
+
+  # parameter-independent work: tokenize the queries and match the phrase
+  # and proximity queries once
+  query_ctxs = [indexes.get_query_context(query) 
+                for query in data_prep.query_list]
+  candidate_cache = dict()
+  for query_ctx in query_ctxs:
+    if query_ctx.mode != "terms":
+      candidate_cache[query_ctx.cache_key()] = \
+        indexes.match_positions(query_ctx)
+  # load the query judgement data before the workers are forked, so they 
+  # share it
+  lazy_data.load()
+  sweep_state.update(
+    indexes = indexes, query_ctxs = query_ctxs, 
+    candidate_cache = candidate_cache, num_results = num_results,
+    # the row index of each document (see uid_to_rowidx), by ordinal
+    doc_rowidx = np.array([data_prep.uid_to_rowidx[u_id] 
+                           for u_id in indexes.doc_id], dtype = np.int64)
+  )
+
+  write_header = not os.path.exists(output_path)
+  with open(output_path, 'a', newline = '') as f:
+    writer = csv.DictWriter(f, fieldnames = SWEEP_COLUMNS)
+    if write_header:
+      writer.writeheader()
+    def write_row(row):
+      writer.writerow(row)
+      f.flush()
+    if num_workers <= 1:
+      for ranker, params in todo:
+        write_row(evaluate_grid_point(ranker, params))
+    else:
+      with ProcessPoolExecutor(
+        max_workers = num_workers, 
+        mp_context = multiprocessing.get_context("fork")
+      ) as executor:
+        futures = [executor.submit(evaluate_grid_point, ranker, params)
+                   for ranker, params in todo]
+        for future in as_completed(futures):
+          write_row(future.result())
+  return(pd.read_csv(output_path))
 
 
 if __name__ == "__main__":
@@ -93,167 +339,46 @@ if __name__ == "__main__":
     get_retrieval_results as get_retrieval_results_metapy
   from data_prep import script_utterance, query_list
   ranker =  metapy.index.OkapiBM25(k1 = 1.2, b = 0.75, k3 = 500)  
-  # retrieve documents
-  query_result = pd.DataFrame()
-  for q_id, query in enumerate(query_list):
-    query_result = query_result.append(
-      pd.DataFrame(dict(
-        query_id = q_id, 
-        doc_id = get_retrieval_results_metapy(
-          query, ranker, inv_idx, script_utterance, 
-          num_results = NUM_RESULT,
-          return_type = "row_idx"
-        )
-      )), 
-      ignore_index = True
-    )
+  # retrieve documents (one record per retrieved document)
+  query_result = pd.DataFrame.from_records(
+    [(q_id, doc_id) for q_id, query in enumerate(query_list)
+     for doc_id in get_retrieval_results_metapy(
+       query, ranker, inv_idx, script_utterance, 
+       num_results = NUM_RESULT,
+       return_type = "row_idx"
+     )],
+    columns = ["query_id", "doc_id"]
+  )
   # evaluate ranker performance
   baseline_eval = evaluate_query_result(query_result)
   
-  baseline_eval = baseline_eval.append(pd.DataFrame.from_records(
-    dict(baseline_eval[["ap", "ndcg"]].mean()), index = pd.Index(["Mean"])
-  ))
+  baseline_eval = pd.concat([baseline_eval, pd.DataFrame(
+    [baseline_eval[["ap", "ndcg"]].mean()], index = pd.Index(["Mean"])
+  )])
   print(baseline_eval)
 
   # evaluate other ranking functions ---------------------------
-  from inverted_index import get_retrieval_results
-  from itertools import chain
-
-  def evaluate_ranker(ranker, **kwargs):
-    # given ranker name and parameters (specified by **kwargs),
-    # evaluate the ranker's performance on each testing query using AP and 
-    # NDCG, and returns a data frame containing the evaluation results
-    
-    # retrieve documents
-    query_result = pd.DataFrame()
-    for q_id, query in enumerate(query_list):
-      query_result = query_result.append(
-        pd.DataFrame(dict(
-          query_id = q_id, 
-          doc_id = get_retrieval_results(
-            query = query, ranker = ranker, num_results = NUM_RESULT, **kwargs
-          )
-        )), 
-        ignore_index = True
-      )
-    # transform utterance ID into document row index
-    query_result['doc_id'] = query_result['doc_id'].apply(
-      lambda x: uid_to_rowidx[x]
-    )
-    # evaluate ranker performance
-    ranker_eval = evaluate_query_result(query_result)
-    ranker_eval_avg = dict(ranker_eval[["ap", "ndcg"]].mean())
-    # add ranker and parameters to the dictionary
-    params = ', '.join([
-      "{}={}".format(key, val) for key, val in kwargs.items()
-    ])
-    ranker_eval_avg.update(dict(ranker = ranker, params = params))
-    return(pd.DataFrame.from_records(ranker_eval_avg, index = pd.Index([0])))
-  
-  # bm25 -------------------------------------------------------------------
-  k1_val = np.arange(0.4, 2.0, 0.2).tolist()
-  b_val = np.arange(0.6, 0.9, 0.05).tolist()
-  rankers = pd.DataFrame(dict(
-    ranker = "bm25",
-    k1 = list(chain.from_iterable(
-      [[val] * len(b_val) for val in k1_val]
-    )),
-    b = b_val * len(k1_val)
-  ))
-  rankers_eval = pd.concat(
-    list(rankers.apply(
-      lambda row: evaluate_ranker(
-        ranker = row["ranker"], k1 = row["k1"], b = row["b"]
-      ), axis = 1
-    )), 
-    ignore_index = True
-  )[["ranker", "params", "ap", "ndcg"]]
-  print(rankers_eval.sort_values(by = "ap", ascending = False).head(10))
-
-  # bm25_v1 ---------------------------------------------------------------
-  k1_val = np.arange(0.4, 2.0, 0.2).tolist()
-  b_val = np.arange(0.6, 0.9, 0.05).tolist()
-  rankers = pd.DataFrame(dict(
-    ranker = "bm25_v1",
-    k1 = list(chain.from_iterable(
-      [[val] * len(b_val) for val in k1_val]
-    )),
-    b = b_val * len(k1_val)
-  ))
-  rankers_eval = pd.concat(
-    list(rankers.apply(
-      lambda row: evaluate_ranker(
-        ranker = row["ranker"], k1 = row["k1"], b = row["b"]
-      ), axis = 1
-    )), 
-    ignore_index = True
-  )[["ranker", "params", "ap", "ndcg"]]
-  print(rankers_eval.sort_values(by = "ap", ascending = False).head(10))
-
-  # pivoted length ------------------------------------------------------
-  rankers = pd.DataFrame(dict(
-    ranker = "piv", b = np.arange(0.05, 1.00, 0.05).tolist()
-  ))
-  rankers_eval = pd.concat(
-    list(rankers.apply(
-      lambda row: evaluate_ranker(
-        ranker = row["ranker"], b = row["b"]
-      ), axis = 1
-    )), 
-    ignore_index = True
-  )[["ranker", "params", "ap", "ndcg"]]
-  print(rankers_eval.sort_values(by = "ap", ascending = False).head(10))
-
-  # tsl ---------------------------------------------------------------
-  mu_val = np.arange(500, 8000, 500).tolist()
-  lbda_val = np.arange(0, 1.1, 0.1).tolist()
-  rankers = pd.DataFrame(dict(
-    ranker = "tsl", 
-    mu = list(chain.from_iterable(
-      [[val] * len(lbda_val) for val in mu_val]
-    )),
-    lbda = lbda_val * len(mu_val)
-  ))
-  rankers_eval = pd.concat(
-    list(rankers.apply(
-      lambda row: evaluate_ranker(
-        ranker = row["ranker"], mu = row["mu"], lbda = row["lbda"]
-      ), axis = 1
-    )), 
-    ignore_index = True
-  )[["ranker", "params", "ap", "ndcg"]]
-  print(rankers_eval.sort_values(by = "ap", ascending = False).head(10))
-
-  # es ------------------------------------------------------------------
-  rankers = pd.DataFrame(dict(
-    ranker = "es", s = np.arange(0.05, 1.00, 0.05).tolist()
-  ))
-  rankers_eval = pd.concat(
-    list(rankers.apply(
-      lambda row: evaluate_ranker(
-        ranker = row["ranker"], s = row["s"]
-      ), axis = 1
-    )), 
-    ignore_index = True
-  )[["ranker", "params", "ap", "ndcg"]]
-  print(rankers_eval.sort_values(by = "ap", ascending = False).head(10))
-
-  # f2exp ---------------------------------------------------------------
-  k_val = np.arange(0.05, 0.75, 0.05).tolist()
-  b_val = np.arange(0, 1.1, 0.1).tolist()
-  rankers = pd.DataFrame(dict(
-    ranker = "f2exp", 
-    k = list(chain.from_iterable(
-      [[val] * len(b_val) for val in k_val]
-    )),
-    b = b_val * len(k_val)
-  ))
-  rankers_eval = pd.concat(
-    list(rankers.apply(
-      lambda row: evaluate_ranker(
-        ranker = row["ranker"], k = row["k"], b = row["b"]
-      ), axis = 1
-    )), 
-    ignore_index = True
-  )[["ranker", "params", "ap", "ndcg"]]
-  print(rankers_eval.sort_values(by = "ap", ascending = False).head(10))
+  grid = make_grid(
+    "bm25", k1 = np.arange(0.4, 2.0, 0.2).tolist(), 
+    b = np.arange(0.6, 0.9, 0.05).tolist()
+  ) + make_grid(
+    "bm25_v1", k1 = np.arange(0.4, 2.0, 0.2).tolist(), 
+    b = np.arange(0.6, 0.9, 0.05).tolist()
+  ) + make_grid(
+    "piv", b = np.arange(0.05, 1.00, 0.05).tolist()
+  ) + make_grid(
+    "tsl", mu = np.arange(500, 8000, 500).tolist(), 
+    lbda = np.arange(0, 1.1, 0.1).tolist()
+  ) + make_grid(
+    "es", s = np.arange(0.05, 1.00, 0.05).tolist()
+  ) + make_grid(
+    "f2exp", k = np.arange(0.05, 0.75, 0.05).tolist(), 
+    b = np.arange(0, 1.1, 0.1).tolist()
+  )
+  # the results are appended to ./data/ranker_sweep.csv as they come in;
+  # rerunning the script resumes an interrupted sweep
+  rankers_eval = run_sweep(grid, "./data/ranker_sweep.csv", 
+                           num_results = NUM_RESULT)
+  for ranker in ["bm25", "bm25_v1", "piv", "tsl", "es", "f2exp"]:
+    print(rankers_eval.loc[rankers_eval.ranker == ranker]\
+          .sort_values(by = "ap", ascending = False).head(10))
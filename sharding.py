@@ -0,0 +1,272 @@
+import argparse
+import multiprocessing
+import os
+import secrets
+import threading
+import weakref
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+import inverted_index
+from metrics import stage_seconds
+
+# Purpose: This script splits the index into shards, each holding the
+#          postings of a contiguous range of documents and served by its own
+#          process, so that a query is ranked on several cores at once (the
+#          scoring in one process is limited to one core by the GIL). Class
+#          ShardPool sends each query to every shard and merges the top
+#          results of the shards (scatter-gather). The shards keep the
+#          collection statistics of the whole index, so the results and
+#          their scores are identical to those of a single process.
+#          The shards talk to the pool over sockets (see
+#          multiprocessing.connection), so they can run on this machine (see
+#          start_shards) or on others (run `python -m sharding --help` on
+#          each machine, then connect_shards); pass the pool to
+#          inverted_index.use_shards to search with it.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+class ShardPool:
+  def __init__(self, addresses, authkey, version = None, processes = None):
+    # inputs:
+    #   addresses: a list of the (host, port) addresses of the shards
+    #   authkey: a bytes object, the key shared with the shards (requests
+    #            are pickled, so only trusted clients may connect)
+    #   version: the version of the index the shards serve (see
+    #            Indexes.version)
+    #   processes: a list of the shard processes started by start_shards
+    #              (None: the shards were started elsewhere)
+    self.addresses = addresses
+    self.authkey = authkey
+    self.version = version
+    self.processes = [] if processes is None else processes
+    self.reset()
+    # a forked process (e.g. a gunicorn worker) opens its own connections
+    # (see reset_pools_after_fork)
+    live_pools.add(self)
+
+  def reset(self):
+    # self.connections: a connection to each shard, opened when it is first
+    # used; self.locks: a lock for each connection, held from sending a
+    # request over it until its reply is received
+    for conn in getattr(self, "connections", []):
+      if conn is not None:
+        conn.close()
+    self.connections = [None] * len(self.addresses)
+    self.locks = [threading.Lock() for _ in self.addresses]
+
+  def get_connection(self, i):
+    if self.connections[i] is None:
+      self.connections[i] = Client(self.addresses[i], authkey = self.authkey)
+    return(self.connections[i])
+
+  def close_connection(self, i):
+    if self.connections[i] is not None:
+      self.connections[i].close()
+      self.connections[i] = None
+
+  def request(self, message):
+    # send the message to every shard first, then collect their replies, so
+    # that the shards work on it at the same time (the locks are always
+    # taken in shard order, so concurrent requests cannot deadlock)
+    # output: a list of the result of each shard, in shard order
+    pending = []
+    try:
+      for i in range(len(self.addresses)):
+        self.locks[i].acquire()
+        pending.append(i)
+        self.get_connection(i).send(message)
+      replies = [self.connections[i].recv() for i in pending]
+    except BaseException:
+      # a request that failed half way leaves unread replies behind
+      for i in pending:
+        self.close_connection(i)
+      raise
+    finally:
+      for i in pending:
+        self.locks[i].release()
+    for i, (status, result) in enumerate(replies):
+      if status != "ok":
+        raise RuntimeError("shard {} failed: {}".format(i, result))
+    return([result for _, result in replies])
+
+  def get_info(self):
+    # returns a list of dictionaries, the version of the index each shard
+    # serves and its range of document ordinals (waits for the shards that
+    # are still starting)
+    return(self.request(("info",)))
+
+  def rank_documents(self, query_ctx, ranker, filter_by_character = "",
+                     num_results = 10, pruning = True, **kwargs):
+    # see inverted_index.rank_documents: each shard ranks its documents, and
+    # the top num_results documents of their results are the top
+    # num_results documents of the whole index (the time spent waiting for
+    # the shards and merging their results is recorded in
+    # metrics.stage_seconds as "shards" and "merge")
+    with stage_seconds.time("shards"):
+      results = self.request(("rank", query_ctx, ranker, filter_by_character,
+                              num_results, pruning, kwargs))
+    with stage_seconds.time("merge"):
+      doc_ords = np.concatenate([doc_ords for doc_ords, _ in results])
+      doc_score = np.concatenate([doc_score for _, doc_score in results])
+      order = np.lexsort((doc_ords, -doc_score))
+      if num_results is not None:
+        order = order[:num_results]
+    return(doc_ords[order], doc_score[order])
+
+  def close(self):
+    # close the connections, and stop the shard processes started by
+    # start_shards
+    for i in range(len(self.addresses)):
+      self.close_connection(i)
+    for process in self.processes:
+      process.terminate()
+      process.join()
+
+# the ShardPool objects of this process that are still referenced (a pool 
+# that is no longer used, e.g. after inverted_index.use_shards replaced it,
+# is dropped from it once it is garbage collected)
+live_pools = weakref.WeakSet()
+
+# function: reset_pools_after_fork --------------------------------------------
+def reset_pools_after_fork():
+  # in a forked process, drop the connections inherited from the parent, so
+  # that each pool opens its own (registered once, when this module is 
+  # imported)
+  for pool in list(live_pools):
+    pool.reset()
+
+os.register_at_fork(after_in_child = reset_pools_after_fork)
+
+# function: get_shard_ranges --------------------------------------------------
+def get_shard_ranges(doc_count, num_shards):
+  # returns a list of tuples (start, end), the range of document ordinals
+  # of each of num_shards shards of about the same size
+  bounds = [doc_count * i // num_shards for i in range(num_shards + 1)]
+  return(list(zip(bounds[:-1], bounds[1:])))
+
+# function: serve_shard -------------------------------------------------------
+def serve_shard(listener, snapshot, start, end):
+  # build the shard of an index that holds the documents with ordinals
+  # start, start + 1, ..., end - 1, and answer the requests of the ShardPool
+  # objects that connect to it, one thread per connection; runs until the
+  # process is stopped
+  # inputs:
+  #   listener: a multiprocessing.connection.Listener object
+  #   snapshot: an Indexes object, the whole index
+  #   start, end: integers, the range of document ordinals of the shard
+  # a forked shard ranks its queries itself
+  inverted_index.use_shards(None)
+  shard = snapshot.get_shard(start, end)
+  info = dict(version = snapshot.version, start = start, end = end)
+  while True:
+    try:
+      conn = listener.accept()
+    except (OSError, EOFError, multiprocessing.AuthenticationError):
+      # e.g. a client with the wrong key
+      continue
+    threading.Thread(target = serve_connection, args = (conn, shard, info),
+                     daemon = True).start()
+
+# function: serve_connection --------------------------------------------------
+def serve_connection(conn, shard, info):
+  # answer the requests sent over one connection (see ShardPool.request)
+  # until it is closed
+  with conn:
+    while True:
+      try:
+        message = conn.recv()
+      except (OSError, EOFError):
+        return
+      try:
+        if message[0] == "rank":
+          query_ctx, ranker, filter_by_character, num_results, pruning, \
+            kwargs = message[1:]
+          result = inverted_index.rank_documents(
+            shard, query_ctx, ranker, filter_by_character, num_results,
+            pruning, **kwargs
+          )
+        elif message[0] == "info":
+          result = info
+        else:
+          raise ValueError("unknown request {!r}".format(message[0]))
+        reply = ("ok", result)
+      except Exception as e:
+        reply = ("error", "{}: {}".format(type(e).__name__, e))
+      try:
+        conn.send(reply)
+      except (OSError, EOFError):
+        return
+
+# function: start_shards ------------------------------------------------------
+def start_shards(num_shards = None, host = "127.0.0.1"):
+  # split the current index (see inverted_index.indexes) into num_shards
+  # shards (default: the number of CPUs), each served by a new process on
+  # this machine; the processes are forked, so they share the loaded data
+  # (call inverted_index.preload first) and only hold their own postings
+  # output: a ShardPool object, returned once every shard is ready
+  num_shards = os.cpu_count() if num_shards is None else num_shards
+  snapshot = inverted_index.lazy_data.get("indexes")
+  authkey = secrets.token_bytes(32)
+  context = multiprocessing.get_context("fork")
+  addresses = []
+  processes = []
+  for start, end in get_shard_ranges(snapshot.doc_count, num_shards):
+    # listen on a free port; the shard process inherits the socket
+    listener = Listener((host, 0), authkey = authkey)
+    process = context.Process(target = serve_shard,
+                              args = (listener, snapshot, start, end),
+                              daemon = True)
+    process.start()
+    addresses.append(listener.address)
+    processes.append(process)
+    listener.close()
+  pool = ShardPool(addresses, authkey, snapshot.version, processes)
+  pool.get_info()
+  return(pool)
+
+# function: connect_shards ----------------------------------------------------
+def connect_shards(addresses, authkey):
+  # connect to the shards of an index started with the command line below
+  # (e.g. on other machines), given their addresses and key
+  # output: a ShardPool object
+  pool = ShardPool(addresses, authkey)
+  info = pool.get_info()
+  versions = set(shard_info["version"] for shard_info in info)
+  if len(versions) != 1:
+    raise ValueError("the shards serve different versions of the index")
+  ranges = sorted((shard_info["start"], shard_info["end"])
+                  for shard_info in info)
+  if any(ranges[i][1] != ranges[i + 1][0] for i in range(len(ranges) - 1)):
+    raise ValueError("the shards do not cover the index: {}".format(ranges))
+  pool.version = versions.pop()
+  return(pool)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description = "Serve one shard of the index. The key shared with the "
+                  "clients is read from the environment variable "
+                  "FRIENDS_SHARD_KEY."
+  )
+  parser.add_argument("--shard", type = int, required = True,
+                      help = "number of the shard (0, 1, ...)")
+  parser.add_argument("--num-shards", type = int, required = True,
+                      help = "number of shards the index is split into")
+  parser.add_argument("--host", default = "127.0.0.1",
+                      help = "address to listen on (default: 127.0.0.1)")
+  parser.add_argument("--port", type = int, required = True,
+                      help = "port to listen on")
+  args = parser.parse_args()
+  authkey = os.environ.get("FRIENDS_SHARD_KEY")
+  if not authkey:
+    parser.error("the environment variable FRIENDS_SHARD_KEY is not set")
+  snapshot = inverted_index.lazy_data.get("indexes")
+  start, end = get_shard_ranges(snapshot.doc_count, args.num_shards)[
+    args.shard
+  ]
+  listener = Listener((args.host, args.port), authkey = authkey.encode())
+  print("serving documents {}..{} on {}:{}".format(
+    start, end - 1, args.host, args.port
+  ))
+  serve_shard(listener, snapshot, start, end)
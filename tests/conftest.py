@@ -0,0 +1,99 @@
+import os
+import pandas as pd
+import pytest
+
+import data_prep
+import inverted_index
+import ranker_evaluation
+import autocomplete
+
+# Purpose: This script defines the pytest fixtures of the tests: a small
+#          sample of the script data (tests/data/script-sample.tsv, with its
+#          queries and query judgements), which is installed as the data of
+#          the modules in place of the full corpus, so the tests run without
+#          the FRIENDS corpus. Run `python -m pytest` from the project's root
+#          folder.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+STOP_WORDS_FILE = os.path.join(os.path.dirname(__file__), "..", "data",
+                               "stopwords.txt")
+
+# the module variables replaced by the sample data, and the ones computed
+# from it (which are loaded again from the sample when they are used, see
+# helper_func.LazyAttributes)
+DERIVED_DATA = {
+  data_prep: ["uid_to_rowidx", "script_index", "character_list"],
+  ranker_evaluation: ["qrels"],
+  autocomplete: ["suggesters"]
+}
+
+
+@pytest.fixture(scope = "session")
+def script_utterance():
+  return(pd.read_csv(os.path.join(TEST_DATA_DIR, "script-sample.tsv"),
+                     sep = "\t", header = 0))
+
+
+@pytest.fixture(scope = "session")
+def stop_words():
+  with open(STOP_WORDS_FILE, encoding = "UTF-8") as f:
+    return([line.strip() for line in f])
+
+
+@pytest.fixture(scope = "session")
+def queries():
+  with open(os.path.join(TEST_DATA_DIR, "script-sample-queries.txt")) as f:
+    return([line.strip() for line in f])
+
+
+@pytest.fixture(scope = "session")
+def ranker_params():
+  return(inverted_index.RANKER_PARAMS)
+
+
+@pytest.fixture
+def sample_data(script_utterance, stop_words, queries, tmp_path):
+  # install the sample as the data of data_prep and inverted_index, with
+  # its index built in a temporary directory, and restore the modules after
+  # the test
+  # output: the Indexes object of the sample
+  df = script_utterance.copy()
+  values = {
+    data_prep: dict(
+      script_utterance = df, query_list = queries,
+      query_relevance = pd.read_csv(
+        os.path.join(TEST_DATA_DIR, "script-sample-qrels.txt"), sep = " ",
+        header = None, names = ["query_id", "doc_id", "relevance"]
+      )
+    ),
+    inverted_index: dict(
+      stop_words = stop_words, documents = df.transcript.tolist(),
+      doc_id = df.u_id.tolist(), speakers = df.speakers.tolist()
+    )
+  }
+  values[inverted_index]["indexes"] = inverted_index.Indexes(
+    values[inverted_index]["documents"], stop_words,
+    values[inverted_index]["doc_id"],
+    speakers = values[inverted_index]["speakers"],
+    index_dir = str(tmp_path / "index")
+  )
+  names = {module: list(module_values) for module, module_values
+           in values.items()}
+  for module, module_names in DERIVED_DATA.items():
+    names[module] = names.get(module, []) + module_names
+  saved = {module: {name: vars(module)[name] for name in module_names
+                    if name in vars(module)}
+           for module, module_names in names.items()}
+  for module, module_names in names.items():
+    for name in module_names:
+      vars(module).pop(name, None)
+    for name, value in values.get(module, dict()).items():
+      setattr(module, name, value)
+  yield(inverted_index.indexes)
+  for module, module_names in names.items():
+    for name in module_names:
+      vars(module).pop(name, None)
+    for name, value in saved[module].items():
+      setattr(module, name, value)
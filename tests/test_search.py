@@ -0,0 +1,632 @@
+import os
+import subprocess
+import sys
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_prep
+import inverted_index
+from inverted_index import Indexes, get_retrieval_results, \
+                           get_batch_retrieval_results, get_ranked_page, \
+                           rank_documents, min_window_span, min_window_spans
+from ranker_evaluation import evaluate_query_result, \
+                              evaluate_query_result_per_query
+
+# Purpose: This script tests that the fast paths of the search engine give
+#          the same results as the straightforward implementations they
+#          replace, on the sample data (see conftest.py), and how they
+#          handle edge inputs (queries with no term to rank, unknown 
+#          characters, stale cursors). The time taken by each is measured
+#          by benchmark.py on the full corpus.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+CHARACTERS = ["", "Joey Tribbiani", "Rachel Green"]
+
+
+def test_batch_scoring_matches_scalar(sample_data, queries, ranker_params):
+  for ranker, params in ranker_params.items():
+    for query in queries:
+      ords_b, scores_b = sample_data.score_candidates(
+        query, ranker, batch = True, **params
+      )
+      ords_s, scores_s = sample_data.score_candidates(
+        query, ranker, batch = False, **params
+      )
+      assert np.array_equal(ords_b, ords_s)
+      assert np.allclose(scores_b, scores_s, rtol = 1e-12, atol = 0)
+
+
+def test_pruning_matches_exhaustive(sample_data, queries, ranker_params):
+  for ranker, params in ranker_params.items():
+    for character in CHARACTERS:
+      for query in queries:
+        results = [get_retrieval_results(
+          query, ranker, filter_by_character = character, num_results = 5,
+          pruning = pruning, use_cache = False, **params
+        ) for pruning in [True, False]]
+        assert results[0] == results[1], (ranker, character, query)
+
+
+def test_batch_queries_match_single(sample_data, queries, ranker_params):
+  # queries repeated as in a replayed query log
+  queries = list(queries) * 3
+  for ranker, params in ranker_params.items():
+    for character in CHARACTERS:
+      expected = [get_retrieval_results(
+        query, ranker, filter_by_character = character, num_results = 5,
+        pruning = False, use_cache = False, **params
+      ) for query in queries]
+      assert get_batch_retrieval_results(
+        queries, ranker, filter_by_character = character, num_results = 5,
+        **params
+      ) == expected
+
+
+def test_evaluation_matches_per_query(sample_data, queries, ranker_params):
+  for ranker, params in ranker_params.items():
+    result_lists = get_batch_retrieval_results(
+      queries, ranker, num_results = 5, **params
+    )
+    query_result = pd.DataFrame(dict(
+      query_id = [q_id for q_id, result_list in enumerate(result_lists)
+                       for _ in result_list],
+      doc_id = [data_prep.uid_to_rowidx[u_id] for result_list in result_lists
+                                              for u_id in result_list]
+    ))
+    vectorized = evaluate_query_result(query_result)
+    per_query = evaluate_query_result_per_query(query_result)
+    for metric in ["ap", "ndcg"]:
+      assert np.allclose(vectorized[metric], per_query[metric], rtol = 1e-12,
+                         atol = 0, equal_nan = True), (ranker, metric)
+
+
+def test_position_matching_matches_tokens(sample_data):
+  # phrase and proximity queries made of consecutive and nearby words of
+  # the sample (with and without stop words) match the same documents as
+  # scanning the tokens of every document (a query of stop words only 
+  # matches no document)
+  doc_tokens = [sample_data.tokenize(document)
+                for document in sample_data.documents]
+  rng = np.random.default_rng(0)
+  queries = ['"we were on a break"', '"joey food"~10', '"on a"', '"guy"~1']
+  for _ in range(100):
+    tokens = doc_tokens[rng.integers(len(doc_tokens))]
+    start = rng.integers(len(tokens))
+    # (words only, as other tokens can need NLTK's Punkt tokenizer)
+    words = [word for word in tokens[start:(start + rng.integers(1, 5))]
+             if word.isalpha()]
+    if len(words) == 0:
+      continue
+    queries.append('"{}"'.format(" ".join(words)))
+    queries.append('"{}"~{}'.format(" ".join(words[::-1]),
+                                    rng.integers(1, 8)))
+  for query in queries:
+    query_ctx = sample_data.get_query_context(query)
+    phrase = query_ctx.phrase_tokens
+    terms = [term for term in dict.fromkeys(phrase)
+             if not sample_data.tokenizer.is_stop_word(term)]
+    if len(terms) == 0:
+      expected = []
+    elif query_ctx.mode == "phrase":
+      expected = [doc_ord for doc_ord, tokens in enumerate(doc_tokens)
+                  if any(tokens[i:(i + len(phrase))] == phrase
+                         for i in range(len(tokens)))]
+    else:
+      expected = [doc_ord for doc_ord, tokens in enumerate(doc_tokens)
+                  if min_window_span(
+                    [[i for i, token in enumerate(tokens) if token == term]
+                     for term in terms]
+                  ) <= query_ctx.window]
+    assert sample_data.match_positions(query_ctx).tolist() == expected, \
+           query
+
+
+def test_min_window_spans_match_scalar():
+  rng = np.random.default_rng(0)
+  num_lists = 3
+  doc_ords = rng.integers(0, 20, size = 200)
+  positions = rng.integers(0, 30, size = 200)
+  list_ids = rng.integers(0, num_lists, size = 200)
+  span_doc_ords, spans = min_window_spans(doc_ords, positions, list_ids,
+                                          num_lists)
+  assert span_doc_ords.tolist() == sorted(set(doc_ords.tolist()))
+  for doc_ord, span in zip(span_doc_ords.tolist(), spans.tolist()):
+    assert span == min_window_span([
+      positions[(doc_ords == doc_ord) & (list_ids == list_id)].tolist()
+      for list_id in range(num_lists)
+    ])
+
+
+def test_concurrent_queries(sample_data, queries, ranker_params):
+  # threads issue different queries against the shared index at the same
+  # time (each thread starts at a different offset of the task list), and
+  # every result must equal the result of sequential execution
+  tasks = [(query, ranker, character) for ranker in ranker_params
+           for query in queries for character in CHARACTERS]
+  def run_task(task):
+    query, ranker, character = task
+    return(get_retrieval_results(
+      query, ranker, filter_by_character = character, num_results = 10,
+      use_cache = False, **ranker_params[ranker]
+    ))
+  expected = [run_task(task) for task in tasks]
+  def run_thread(thread_id):
+    num_errors = 0
+    for round_id in range(3):
+      offset = (thread_id * 7 + round_id) % len(tasks)
+      for i in list(range(offset, len(tasks))) + list(range(offset)):
+        num_errors += run_task(tasks[i]) != expected[i]
+    return(num_errors)
+  with ThreadPoolExecutor(max_workers = 8) as executor:
+    assert sum(executor.map(run_thread, range(8))) == 0
+
+
+def test_edge_case_queries(sample_data, ranker_params):
+  # queries without any term of the vocabulary left to rank, and filters by
+  # unknown characters, match no document (on every path, including the 
+  # phrase matching) instead of failing
+  version = sample_data.version
+  edge_cases = [
+    ("", ""), ("   ", ""), ("the and of", ""), ('"the of"', ""),
+    ("guy", "Nobody Atall"), ('"guy quokkazz"', ""), ('"guy quokkazz"~5', ""),
+    ('"quokkazz"', "Joey Tribbiani")
+  ]
+  assert get_retrieval_results("guy", "f2exp", use_cache = False, 
+                               **ranker_params["f2exp"]) != []
+  for ranker, params in ranker_params.items():
+    for query, character in edge_cases:
+      for pruning in [True, False]:
+        assert get_retrieval_results(
+          query, ranker, filter_by_character = character, pruning = pruning,
+          use_cache = False, **params
+        ) == []
+      assert get_ranked_page(query, ranker, filter_by_character = character,
+                             **params) == (version, [], [], 0)
+    assert get_batch_retrieval_results(
+      [query for query, character in edge_cases if character == ""], ranker,
+      **params
+    ) == [[]] * 6
+
+  import web_ui
+  client = web_ui.app.test_client()
+  assert client.get("/api/search", query_string = dict(q = " ")
+                    ).status_code == 400
+  response = client.get("/api/search", query_string = dict(q = "the and of"))
+  assert response.status_code == 200
+  assert response.get_json()["results"] == []
+  assert response.get_json()["next_cursor"] is None
+  response = client.get("/api/search", query_string = dict(
+    q = "guy", character = "Nobody Atall"
+  ))
+  assert response.get_json()["total"] == 0
+  assert client.get("/search_results/q=the and of").status_code == 200
+
+def test_incremental_update_matches_rebuild(script_utterance, stop_words,
+                                            queries, ranker_params,
+                                            tmp_path):
+  # index all but the last num_new documents, then add them and replace
+  # every 6th other document: the updated index must give the same scores
+  # as an index built from scratch, and be identical to it once merged
+  documents = script_utterance.transcript.tolist()
+  doc_id = script_utterance.u_id.tolist()
+  speakers = script_utterance.speakers.tolist()
+  num_new = 10
+  new_documents = list(documents)
+  replaced = list(range(0, len(documents) - num_new, 6))
+  for doc_ord in replaced:
+    new_documents[doc_ord] = documents[doc_ord + 1]
+  expected = Indexes(new_documents, stop_words, doc_id, speakers = speakers,
+                     index_dir = str(tmp_path / "full"))
+  updated = Indexes(documents[:-num_new], stop_words, doc_id[:-num_new],
+                    speakers = speakers[:-num_new],
+                    index_dir = str(tmp_path / "base"))
+  changed = replaced + list(range(len(documents) - num_new, len(documents)))
+  updated = updated.update_documents(
+    [new_documents[i] for i in changed], [doc_id[i] for i in changed],
+    [speakers[i] for i in changed]
+  )
+  for ranker, params in ranker_params.items():
+    for query in queries:
+      ords_u, scores_u = updated.score_candidates(query, ranker, **params)
+      ords_e, scores_e = expected.score_candidates(query, ranker, **params)
+      assert np.array_equal(ords_u, ords_e)
+      assert np.allclose(scores_u, scores_e, rtol = 1e-12, atol = 0)
+  merged = updated.merge_segments().store
+  for name in ["offsets", "doc_ords", "freqs", "pos_offsets", "positions"]:
+    assert np.array_equal(getattr(merged, name), getattr(expected.store, name))
+
+
+def test_search_after_update(sample_data, stop_words, tmp_path, monkeypatch):
+  # the web app finds and renders the utterances added or replaced by
+  # update_index (one added to an existing scene, one in a new scene), and
+  # save_updates saves them so that the next start loads the same data and
+  # opens the updated index
+  import web_ui
+  monkeypatch.setattr(data_prep, "tsv_file", str(tmp_path / "script.tsv"))
+  monkeypatch.setattr(data_prep, "cache_file", str(tmp_path / "script.pkl"))
+  updated = inverted_index.update_index(
+    ["The zeppelin has landed.", "Quokka, everybody.", "Xylophone lessons."],
+    ["s01_e01_c01_u099", "s01_e01_c01_u001", "s03_e01_c01_u001"],
+    ["Joey Tribbiani", "Monica Geller", None]
+  )
+  client = web_ui.app.test_client()
+  for query, u_id in [("zeppelin", "s01_e01_c01_u099"),
+                      ("quokka", "s01_e01_c01_u001"),
+                      ("xylophone", "s03_e01_c01_u001")]:
+    response = client.get(f"/search_results/q={query}")
+    assert response.status_code == 200
+    assert query in response.get_data(as_text = True).lower()
+    response = client.get("/api/search", query_string = dict(q = query))
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [result["u_id"] for result in results] == [u_id]
+    assert query in results[0]["snippet"].lower()
+    assert client.get(f"/script/{u_id}").status_code == 200
+  assert "nothing to tell" not in \
+    client.get("/script/s01_e01_c01_u001").get_data(as_text = True).lower()
+  inverted_index.save_updates()
+  df = data_prep.load_script_data()
+  assert df.equals(data_prep.script_utterance)
+  index_dirs = sorted(os.listdir(tmp_path / "index"))
+  reopened = Indexes(df.transcript.tolist(), stop_words, df.u_id.tolist(),
+                     speakers = df.speakers.tolist(), index_dir = str(
+                       tmp_path / "index"
+                     ))
+  assert sorted(os.listdir(tmp_path / "index")) == index_dirs
+  assert reopened.index_dir == os.path.join(tmp_path / "index",
+                                            updated.get_index_key())
+  assert np.array_equal(reopened.store.positions,
+                        updated.merge_segments().store.positions)
+
+
+def test_compact_index_matches(script_utterance, stop_words, queries,
+                               ranker_params, tmp_path):
+  # the compact index (see Indexes.compact) gives the same scores, with the
+  # batch and the scalar scoring functions, and the same updated index
+  def make_indexes():
+    return(Indexes(script_utterance.transcript.tolist(), stop_words,
+                   script_utterance.u_id.tolist(),
+                   speakers = script_utterance.speakers.tolist(),
+                   index_dir = str(tmp_path)))
+  expected, compact = make_indexes(), make_indexes()
+  compact.compact()
+  assert list(compact.documents) == expected.documents
+  assert compact.get_index_key() == expected.get_index_key()
+  for ranker, params in ranker_params.items():
+    for batch in [True, False]:
+      for query in queries:
+        ords_c, scores_c = compact.score_candidates(query, ranker,
+                                                    batch = batch, **params)
+        ords_e, scores_e = expected.score_candidates(query, ranker,
+                                                     batch = batch, **params)
+        assert np.array_equal(ords_c, ords_e)
+        assert np.array_equal(scores_c, scores_e)
+  update = (["Quokka, everybody."], ["s01_e01_c01_u001"], ["Monica Geller"])
+  assert compact.update_documents(*update).get_index_key() == \
+         expected.update_documents(*update).get_index_key()
+
+
+def test_parallel_build_matches_serial(script_utterance, stop_words,
+                                       tmp_path):
+  # every build writes the same files (except meta.json, which holds a
+  # random build ID), whatever the number of worker processes
+  index_files = []
+  for num_workers in [1, 3]:
+    index_dir = Indexes(
+      script_utterance.transcript.tolist(), stop_words,
+      script_utterance.u_id.tolist(),
+      speakers = script_utterance.speakers.tolist(),
+      index_dir = str(tmp_path / f"workers_{num_workers}"),
+      num_workers = num_workers
+    ).index_dir
+    files = dict()
+    for file_name in sorted(os.listdir(index_dir)):
+      if file_name != "meta.json":
+        with open(os.path.join(index_dir, file_name), 'rb') as f:
+          files[file_name] = f.read()
+    index_files.append(files)
+  assert index_files[0] == index_files[1]
+
+
+def test_index_cache(script_utterance, stop_words, tmp_path):
+  # each setting is built once in its own directory of the index cache, then
+  # opened from it; changed documents or stop words get another directory
+  from postings import get_index_key
+  documents = script_utterance.transcript.tolist()
+  doc_id = script_utterance.u_id.tolist()
+  speakers = script_utterance.speakers.tolist()
+  versions = []
+  for stem in [False, True, False, True]:
+    versions.append(Indexes(documents, stop_words, doc_id, speakers = speakers,
+                            stem = stem, index_dir = str(tmp_path)).version)
+  assert len(os.listdir(tmp_path)) == 2
+  assert versions[:2] == versions[2:]
+  key = get_index_key(documents, doc_id, speakers, stop_words, stem = False)
+  changed = list(documents)
+  changed[0] += " again"
+  assert get_index_key(changed, doc_id, speakers, stop_words,
+                       stem = False) != key
+  assert get_index_key(documents, doc_id, speakers, stop_words[1:],
+                       stem = False) != key
+
+
+def test_concurrent_index_writes(sample_data, tmp_path):
+  # processes (here, threads) writing the same index directory at the same
+  # time each write their own temporary directory: the index is complete 
+  # at the end, and no temporary directory is left behind
+  from postings import write_index, read_index
+  index_dir = str(tmp_path / "cache" / sample_data.get_index_key())
+  def write(_):
+    for _ in range(5):
+      write_index(
+        index_dir, sample_data.store, sample_data.doc_id,
+        doc_length = sample_data.doc_length_arr,
+        speaker_index = (list(sample_data.speaker_ids),
+                         sample_data.speaker_offsets,
+                         sample_data.speaker_doc_ords)
+      )
+  with ThreadPoolExecutor(max_workers = 4) as executor:
+    list(executor.map(write, range(4)))
+  assert os.listdir(tmp_path / "cache") == [sample_data.get_index_key()]
+  index = read_index(index_dir)
+  assert np.array_equal(index["store"].positions, sample_data.store.positions)
+
+
+def test_tokenizer_matches_word_tokenize(script_utterance, stop_words):
+  # the regex fast path (and the stem cache) give the same terms as
+  # word_tokenize and porter.stem called on every document and token
+  nltk = pytest.importorskip("nltk")
+  try:
+    nltk.word_tokenize("Punkt?")
+  except LookupError:
+    pytest.skip("NLTK's Punkt tokenizer is not installed")
+  from nltk.stem import PorterStemmer
+  from tokenizer import Tokenizer
+  porter = PorterStemmer()
+  documents = script_utterance.transcript.tolist() + [
+    "Hey... wait -- what?", "We're gonna need a bigger boat!", "cannot",
+    "Ross's \"pivot\" (the couch)", "I'M FINE!!", "$10, 5% off, e-mail me"
+  ]
+  for do_stem in [False, True]:
+    tokenizer = Tokenizer(stop_words, do_stem)
+    for document in documents:
+      expected = [term for term in nltk.word_tokenize(document.lower())
+                  if term not in stop_words]
+      if do_stem:
+        expected = [porter.stem(term) for term in expected]
+      assert tokenizer.tokenize(document, True) == expected, document
+
+
+def test_snippets_match_get_script_with_uid(sample_data, script_utterance):
+  u_ids = script_utterance.u_id.tolist()
+  for plus_minus in [0, 1, 2]:
+    for output_format in ["html", "terminal"]:
+      assert data_prep.script_index.render_many(
+        u_ids, plus_minus, output_format
+      ) == [data_prep.get_script_with_uid(
+        data_prep.script_utterance, u_id, plus_minus, output_format
+      ) for u_id in u_ids]
+
+
+def test_episodes_match_get_episode_with_uid(sample_data, script_utterance):
+  for u_id in script_utterance.u_id.tolist():
+    expected = data_prep.get_episode_with_uid(data_prep.script_utterance,
+                                              u_id)
+    # uncached, then cached
+    assert data_prep.script_index.render_episode(u_id) == expected
+    assert data_prep.script_index.render_episode(u_id) == expected
+
+
+def test_paging_matches_reranking(sample_data, queries):
+  # slicing the ranked list kept by get_ranked_page gives the same pages as
+  # ranking the query again for each page
+  page_size = 3
+  for character in CHARACTERS:
+    for query in queries:
+      for page in range(5):
+        _, doc_ids, _, total = get_ranked_page(
+          query, "f2exp", character, offset = page * page_size,
+          page_size = page_size, k = 0.1, b = 0.3
+        )
+        assert doc_ids == get_retrieval_results(
+          query, "f2exp", filter_by_character = character,
+          num_results = (page + 1) * page_size, use_cache = False,
+          k = 0.1, b = 0.3
+        )[(page * page_size):]
+        assert total == len(get_retrieval_results(
+          query, "f2exp", filter_by_character = character,
+          num_results = None, use_cache = False, k = 0.1, b = 0.3
+        ))
+
+
+def test_stale_cursor_is_rejected(sample_data, monkeypatch):
+  # after update_index, the cursor of a page of the old index gets a 410 
+  # response, without ranking the query again
+  import web_ui
+  client = web_ui.app.test_client()
+  response = client.get("/api/search", query_string = dict(q = "guy",
+                                                            page_size = 1))
+  cursor = response.get_json()["next_cursor"]
+  assert cursor is not None
+  assert client.get("/api/search", query_string = dict(
+    cursor = cursor, page_size = 1
+  )).status_code == 200
+  inverted_index.update_index(["Quokka, everybody."], ["s01_e01_c01_u001"])
+  def rank_again(*args, **kwargs):
+    raise AssertionError("the query was ranked again")
+  monkeypatch.setattr(web_ui, "get_ranked_page", rank_again)
+  assert client.get("/api/search", query_string = dict(
+    cursor = cursor, page_size = 1
+  )).status_code == 410
+  # so does the cursor of a version that never existed, and a token that is
+  # not a cursor gets a 400 response
+  assert client.get("/api/search", query_string = dict(
+    cursor = web_ui.encode_cursor(dict(q = "guy", c = "", o = 1, 
+                                       v = "no-such-version"))
+  )).status_code == 410
+  assert client.get("/api/search", query_string = dict(
+    cursor = "not-a-cursor"
+  )).status_code == 400
+
+
+def test_cache_metrics(sample_data):
+  # /metrics reports the hits and misses of the result cache
+  import web_ui
+  from metrics import cache_metrics
+  inverted_index.result_cache.clear()
+  hits, misses = [inverted_index.result_cache.stats()[key]
+                  for key in ["hits", "misses"]]
+  client = web_ui.app.test_client()
+  for _ in range(3):
+    assert client.get("/search_results/q=coffee").status_code == 200
+  text = client.get("/metrics").get_data(as_text = True)
+  assert 'friends_cache_hits_total{{cache="result"}} {}'.format(hits + 2) \
+         in text.splitlines()
+  assert 'friends_cache_misses_total{{cache="result"}} {}'.format(
+    misses + 1
+  ) in text.splitlines()
+  assert "# TYPE friends_cache_misses_total counter" in text.splitlines()
+  assert {"result", "ranking", "episode"} <= set(cache_metrics.caches)
+
+
+def test_request_trace(sample_data, monkeypatch):
+  # a traced request gets the time of each stage in a Server-Timing header,
+  # and the trace of a request is closed even if its view raises
+  import web_ui
+  from metrics import get_trace
+  client = web_ui.app.test_client()
+  response = client.get("/search_results/q=coffee", 
+                        headers = {"X-Trace": "1"})
+  stages = [item.split(";")[0] for item 
+            in response.headers["Server-Timing"].split(", ")]
+  assert {"tokenize", "snippets", "template", "total"} <= set(stages)
+  assert get_trace() is None
+  def fail():
+    raise RuntimeError("view failed")
+  monkeypatch.setitem(web_ui.app.view_functions, "metrics", fail)
+  monkeypatch.setitem(web_ui.app.config, "PROPAGATE_EXCEPTIONS", True)
+  with pytest.raises(RuntimeError):
+    client.get("/metrics")
+  assert get_trace() is None
+
+def test_sharded_ranking_matches_local(sample_data, queries, ranker_params):
+  # the shards (see sharding.py) give the same documents and scores as
+  # ranking in this process
+  from sharding import start_shards
+  pool = start_shards(3)
+  try:
+    for ranker, params in ranker_params.items():
+      for character in CHARACTERS:
+        for num_results, pruning in [(5, True), (None, False)]:
+          for query in queries:
+            query_ctx = sample_data.get_query_context(query)
+            local = rank_documents(sample_data, query_ctx, ranker, character,
+                                   num_results, pruning, **params)
+            sharded = pool.rank_documents(query_ctx, ranker, character,
+                                          num_results, pruning, **params)
+            assert np.array_equal(local[0], sharded[0])
+            assert np.array_equal(local[1], sharded[1])
+  finally:
+    pool.close()
+
+
+def test_suggestions(sample_data):
+  # the prefix indexes keep as many completions as /api/suggest can return
+  # (the sample has more than 10 terms starting with "s"), and the words of
+  # the documents added by update_index are suggested
+  import web_ui
+  import autocomplete
+  _, terms = autocomplete.get_suggesters()
+  num_terms = sum(term.startswith("s") for term in terms.strings)
+  assert num_terms > 10
+  assert len(terms.complete("s")) == min(num_terms, web_ui.SUGGEST_MAX_LIMIT)
+  client = web_ui.app.test_client()
+  def suggest(query, limit):
+    response = client.get("/api/suggest",
+                          query_string = dict(q = query, limit = limit))
+    assert response.status_code == 200
+    return(response.get_json()["suggestions"])
+  assert len(suggest("s", web_ui.SUGGEST_MAX_LIMIT)) > 10
+  assert suggest("zep", 5) == []
+  inverted_index.update_index(["The zeppelin has landed."],
+                              ["s01_e01_c01_u099"])
+  assert suggest("zep", 5) == ["zeppelin"]
+
+
+def test_read_all_seasons(monkeypatch):
+  # the seasons are read by forked processes and concatenated in season 
+  # order; a process that dies without sending its season raises an error
+  # instead of blocking the import
+  def get_script_utterance(season_id):
+    if season_id == 3:
+      os._exit(1)
+    return(pd.DataFrame(dict(u_id = [f"s{season_id:02d}_e01_c01_u001"],
+                             speakers = ["Joey Tribbiani"],
+                             transcript = ["How you doin'?"])))
+  monkeypatch.setattr(data_prep, "get_script_utterance", get_script_utterance)
+  monkeypatch.setattr(data_prep, "SEASON_POLL_SEC", 0.1)
+  assert data_prep.read_all_seasons([2, 1]).u_id.tolist() == \
+         ["s02_e01_c01_u001", "s01_e01_c01_u001"]
+  with pytest.raises(RuntimeError, match = "season 3"):
+    data_prep.read_all_seasons([1, 3])
+
+
+def test_write_file_atomically(tmp_path):
+  # the file is replaced whole, and a failed write leaves the old file and
+  # no temporary file behind
+  from helper_func import write_file_atomically
+  file_path = str(tmp_path / "data.txt")
+  def write(text):
+    def write_text(path):
+      with open(path, "w") as f:
+        f.write(text)
+    return(write_text)
+  write_file_atomically(file_path, write("old"))
+  def fail(path):
+    write("partial")(path)
+    raise OSError("disk full")
+  with pytest.raises(OSError):
+    write_file_atomically(file_path, fail)
+  assert os.listdir(tmp_path) == ["data.txt"]
+  with open(file_path) as f:
+    assert f.read() == "old"
+
+
+def test_shard_pools_reset_after_fork():
+  # a forked process resets the connections of the pools in use, and pools
+  # that are no longer referenced are not kept alive by the fork hook
+  import gc
+  import multiprocessing
+  from sharding import ShardPool, live_pools
+  class Connection:
+    def close(self):
+      pass
+  pool = ShardPool([("127.0.0.1", 1)], b"key")
+  old_pool = ShardPool([("127.0.0.1", 2)], b"key")
+  old_pool_ref = weakref.ref(old_pool)
+  del old_pool
+  gc.collect()
+  assert old_pool_ref() is None
+  assert list(live_pools) == [pool]
+  pool.connections[0] = Connection()
+  process = multiprocessing.get_context("fork").Process(
+    target = lambda: os._exit(0 if pool.connections == [None] else 1)
+  )
+  process.start()
+  process.join()
+  assert process.exitcode == 0
+  assert isinstance(pool.connections[0], Connection)
+
+
+def test_import_loads_no_data():
+  # importing the modules loads no data (it is loaded when it is first
+  # used, see helper_func.LazyAttributes)
+  code = "import data_prep, inverted_index, ranker_evaluation, web_ui; " + \
+         "assert 'script_utterance' not in vars(data_prep); " + \
+         "assert 'indexes' not in vars(inverted_index)"
+  subprocess.run([sys.executable, "-c", code], check = True,
+                 cwd = os.path.join(os.path.dirname(__file__), ".."))
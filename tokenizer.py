@@ -0,0 +1,87 @@
+from functools import lru_cache
+import re
+
+# Purpose: This script defines class Tokenizer, which turns documents and
+#          queries into terms. It gives the same tokens as NLTK's
+#          word_tokenize (optionally stemmed with the Porter stemmer), but
+#          skips word_tokenize for documents simple enough to be split with
+#          one precompiled regular expression, filters stop words with a set,
+#          and caches the stem of each distinct token. NLTK is imported
+#          when it is first needed, as importing it is slow.
+# Author: Yanyu Long
+# Updated: Oct 17, 2026
+
+# a "simple" document: words of letters and digits separated by single
+# spaces (or a comma and a space), with contraction suffixes ('s, n't, ...)
+# and an optional final . ! or ?; word_tokenize splits such a document into
+# exactly the matches of SIMPLE_TOKEN_PATTERN
+SIMPLE_WORD = r"[a-z0-9]+(?:n't|'(?:s|m|d|ll|re|ve))?"
+SIMPLE_DOC_PATTERN = re.compile(
+  rf"{SIMPLE_WORD}(?:,? {SIMPLE_WORD})*[.!?]?"
+)
+SIMPLE_TOKEN_PATTERN = re.compile(
+  r"[a-z0-9]+?(?=n't)|n't|'(?:s|m|d|ll|re|ve)|[a-z0-9]+|[,.!?]"
+)
+# words that word_tokenize splits further (e.g. "gonna" -> "gon", "na"),
+# documents containing them take the slow path
+SPLIT_WORDS = frozenset(["cannot", "gimme", "gonna", "gotta", "lemme",
+                         "wanna"])
+
+STEM_CACHE_SIZE = 65536 # maximum number of cached stems
+
+@lru_cache(maxsize = None)
+def get_stemmer():
+  # returns NLTK's Porter stemmer (created once)
+  from nltk.stem import PorterStemmer
+  return(PorterStemmer())
+
+@lru_cache(maxsize = STEM_CACHE_SIZE)
+def stem(term):
+  # returns the Porter stem of the term; the vocabulary of the corpus is
+  # small, so most calls are answered from the cache
+  return(get_stemmer().stem(term))
+
+class Tokenizer:
+  def __init__(self, stop_words, stem = False):
+    # inputs:
+    #   stop_words: a collection of terms that are not indexed
+    #   stem: boolean, whether to stem the terms with the Porter stemmer
+    self.stop_words = frozenset(stop_words)
+    self.do_stem = stem
+
+  def split(self, document):
+    # returns the tokens of the document, as word_tokenize gives them
+    document = document.strip().lower()
+    if document == "":
+      return([])
+    if SIMPLE_DOC_PATTERN.fullmatch(document) is not None:
+      tokens = SIMPLE_TOKEN_PATTERN.findall(document)
+      if SPLIT_WORDS.isdisjoint(tokens):
+        return(tokens)
+    from nltk import word_tokenize
+    return(word_tokenize(document))
+
+  def tokenize(self, document, remove_stop_words = False):
+    # tokenize the given document
+    # inputs:
+    #   document - string, the original document
+    #   remove_stop_words - boolean, whether to remove stop words from tokens
+    # output: list of strings, terms from the original document
+    #         stemmed if self.do_stem is True
+    doc_tokens = self.split(document)
+    if remove_stop_words:
+      doc_tokens = [term for term in doc_tokens
+                    if term not in self.stop_words]
+    if self.do_stem:
+      doc_tokens = [stem(term) for term in doc_tokens]
+    return(doc_tokens)
+
+  def iter_tokenize(self, documents, remove_stop_words = False):
+    # yields the terms of each document in turn (see tokenize), so that a
+    # consumer such as PostingsStore.from_doc_tokens never holds the tokens
+    # of the whole corpus at once
+    for document in documents:
+      yield(self.tokenize(document, remove_stop_words))
+
+  def is_stop_word(self, term):
+    return(term in self.stop_words)
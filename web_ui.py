@@ -1,4 +1,5 @@
-from flask import Flask, render_template, redirect, url_for, request, abort
+from flask import Flask, render_template, redirect, url_for, request, abort, \
+                  g, Response, jsonify
 from flask_bootstrap import Bootstrap
 from flask_wtf import FlaskForm
 from wtforms import SelectField, StringField, SubmitField
@@ -6,36 +7,93 @@ from wtforms.validators import DataRequired
 from datetime import datetime
 import re
 import os
+import time
+import json
+import base64
+import binascii
 
 # from metapy import metapy
 # from config_metapy import config_file, inv_idx, \
 #   get_retrieval_results as get_retrieval_results_metapy
-from data_prep import script_utterance, get_script_with_uid, \
-                      get_episode_with_uid, character_list
-from inverted_index import indexes, get_retrieval_results
+import data_prep
+import inverted_index
+from inverted_index import get_retrieval_results, get_ranked_page, preload
+from inverted_index import RANKER_PARAMS, SEARCH_RANKER
+from autocomplete import get_suggestions, MAX_SUGGESTIONS
+from metrics import request_seconds, stage_seconds, start_trace, get_trace, \
+                    end_trace, format_server_timing, render_all
 
 # Purpose: This script builds up the user interface of the web app. 
+#          The script data and the index are loaded by preload (see 
+#          inverted_index.py), or else on the first request that needs them.
+#          The time spent serving each request, and in each of its stages,
+#          is reported at /metrics (see metrics.py); a request with an
+#          X-Trace header (or a trace parameter) also gets the time of each
+#          stage in a Server-Timing header. /api/search returns the 
+#          results as JSON, one page at a time, and /api/suggest the 
+#          completions of a partial query (shown under the search box).
 # Author: Yanyu Long
-# Updated: Dec 11, 2020
+# Updated: Oct 17, 2026
 
 app = Flask(__name__)
 Bootstrap(app)
 
+# the parameters of the ranker the web app searches with (SEARCH_RANKER)
+SEARCH_PARAMS = RANKER_PARAMS[SEARCH_RANKER]
+# the number of results per page of /api/search (by default, and at most)
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+INDEX_CHANGED_ERROR = "the index has changed since the first page, " + \
+                      "search again"
+# the number of suggestions of /api/suggest (by default, and at most)
+SUGGEST_LIMIT = 8
+SUGGEST_MAX_LIMIT = MAX_SUGGESTIONS
+
+
+@app.before_request
+def start_request_timer():
+  g.request_start = time.perf_counter()
+  g.trace_token = start_trace()
+
+
+@app.after_request
+def record_request_time(response):
+  elapsed = time.perf_counter() - g.request_start
+  request_seconds.observe(request.endpoint or "unknown", elapsed)
+  if "X-Trace" in request.headers or "trace" in request.args:
+    trace = dict(get_trace(), total = elapsed)
+    response.headers["Server-Timing"] = format_server_timing(trace)
+  return response
+
+
+@app.teardown_request
+def end_request_trace(error):
+  # the trace is closed here rather than in after_request, which is skipped
+  # when the view raises, so the next request of the thread starts clean
+  token = g.pop("trace_token", None)
+  if token is not None:
+    end_trace(token)
+
 
 class SearchForm(FlaskForm):
-  character = SelectField("Filter by character", 
-    choices = [("", "Select a character")] + \
-      [(name, name) for name in character_list[:20]]
-  )
+  character = SelectField("Filter by character")
   user_query = StringField(
     validators = [DataRequired()],
     render_kw = {
       "placeholder": "Joey doesn't share food!",
-      "style": "width: 500px; font-size: 15px;"
+      "style": "width: 500px; font-size: 15px;",
+      # suggestions from /api/suggest (see templates/base.html)
+      "list": "query-suggestions",
+      "autocomplete": "off"
     }
   )
   search_button = SubmitField("Search!")
 
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.character.choices = [("", "Select a character")] + \
+      [(name, name) for name in data_prep.character_list[:20]]
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -66,16 +124,14 @@ def search_results(query, character):
   #   num_results = 10
   # )
   result_list = get_retrieval_results(
-    query = query, ranker = "f2exp", 
+    query = query, ranker = SEARCH_RANKER, 
     filter_by_character = character, num_results = 20, 
-    k = 0.1, b = 0.3
+    **SEARCH_PARAMS
   )
-  docs = [get_script_with_uid(
-            df = script_utterance, 
-            u_id = u_id, 
-            plus_minus = 1,
-            output_format = "html"
-          ) for u_id in result_list]
+  with stage_seconds.time("snippets"):
+    docs = data_prep.script_index.render_many(
+      result_list, plus_minus = 1, output_format = "html"
+    )
   finish_time = datetime.now()
 
   search_form = SearchForm(meta={'csrf': False})
@@ -85,22 +141,140 @@ def search_results(query, character):
       character = search_form.character.data
     ))
   
-  return render_template("search_results.html",
-                         processing_time = (finish_time - start_time),
-                         total_doc_num = len(docs),
-                         query = query,
-                         character = character,
-                         docs = docs,
-                         form = search_form)
+  with stage_seconds.time("template"):
+    page = render_template("search_results.html",
+                           processing_time = (finish_time - start_time),
+                           total_doc_num = len(docs),
+                           query = query,
+                           character = character,
+                           docs = docs,
+                           form = search_form)
+  return page
 
 
 @app.route("/script/<uid>")
 def script(uid):
   sid= int(re.compile("s([0-9]{2})").findall(uid)[0])
   eid= int(re.compile("e([0-9]{2})").findall(uid)[0])
-  return render_template("script.html", 
-                         episode_id = "Season {} Episode {}".format(sid, eid), 
-                         script = get_episode_with_uid(script_utterance, uid))
+  with stage_seconds.time("episode"):
+    episode = data_prep.script_index.render_episode(uid)
+  with stage_seconds.time("template"):
+    page = render_template("script.html", 
+                           episode_id = "Season {} Episode {}".format(
+                             sid, eid
+                           ), 
+                           script = episode)
+  return page
+
+
+@app.route("/api/search")
+def api_search():
+  # the results of a query as JSON, one page at a time: the first request 
+  # gives the query (q) and optionally a character to filter by (character);
+  # each response has a next_cursor (null on the last page) to pass as the 
+  # cursor parameter of the request for the next page, which is sliced from
+  # the ranked list kept by the first request (see 
+  # inverted_index.get_ranked_page); page_size sets the number of results 
+  # per page
+  try:
+    page_size = int(request.args.get("page_size", API_PAGE_SIZE))
+  except ValueError:
+    return jsonify(error = "page_size must be an integer"), 400
+  if not 1 <= page_size <= API_MAX_PAGE_SIZE:
+    return jsonify(error = "page_size must be between 1 and {}".format(
+      API_MAX_PAGE_SIZE
+    )), 400
+  if "cursor" in request.args:
+    cursor = decode_cursor(request.args["cursor"])
+    if cursor is None:
+      return jsonify(error = "invalid cursor"), 400
+  elif request.args.get("q", "").strip() != "":
+    cursor = dict(q = request.args["q"], 
+                  c = request.args.get("character", ""), o = 0, v = None)
+  else:
+    return jsonify(error = "missing query (q) or cursor"), 400
+
+  # the pages of a query all come from one version of the index: a cursor
+  # of an older version is rejected before the query is ranked again (and
+  # after, if the index has changed in the meantime)
+  if cursor["v"] is not None and \
+     cursor["v"] != inverted_index.lazy_data.get("indexes").version:
+    return jsonify(error = INDEX_CHANGED_ERROR), 410
+  version, doc_ids, scores, total = get_ranked_page(
+    query = cursor["q"], ranker = SEARCH_RANKER, 
+    filter_by_character = cursor["c"], offset = cursor["o"], 
+    page_size = page_size, **SEARCH_PARAMS
+  )
+  if cursor["v"] is not None and cursor["v"] != version:
+    return jsonify(error = INDEX_CHANGED_ERROR), 410
+  with stage_seconds.time("snippets"):
+    snippets = data_prep.script_index.render_many(
+      doc_ids, plus_minus = 1, output_format = "html"
+    )
+  next_offset = cursor["o"] + len(doc_ids)
+  if next_offset < total:
+    next_cursor = encode_cursor(dict(cursor, o = next_offset, v = version))
+  else:
+    next_cursor = None
+  return jsonify(
+    query = cursor["q"], character = cursor["c"], offset = cursor["o"],
+    total = total, next_cursor = next_cursor,
+    results = [dict(u_id = u_id, score = score, snippet = snippet) 
+               for u_id, score, snippet in zip(doc_ids, scores, snippets)]
+  )
+
+
+@app.route("/api/suggest")
+def api_suggest():
+  # the completions of a partial query (q) as JSON, most frequent first; 
+  # limit sets the number of suggestions
+  try:
+    limit = int(request.args.get("limit", SUGGEST_LIMIT))
+  except ValueError:
+    return jsonify(error = "limit must be an integer"), 400
+  if not 1 <= limit <= SUGGEST_MAX_LIMIT:
+    return jsonify(error = "limit must be between 1 and {}".format(
+      SUGGEST_MAX_LIMIT
+    )), 400
+  query = request.args.get("q", "")
+  return jsonify(query = query, 
+                 suggestions = get_suggestions(query, num_results = limit))
+
+
+@app.route("/metrics")
+def metrics():
+  # the metrics of this process in the Prometheus text format (each gunicorn
+  # worker reports its own)
+  return Response(render_all(), mimetype = "text/plain; version=0.0.4")
+
+# function: encode_cursor -----------------------------------------------------
+def encode_cursor(cursor):
+  # returns the opaque token /api/search hands out for the next page
+  # input - cursor: a dictionary with the query (q), the character to filter
+  #         by (c), the offset of the next page (o) and the version of the 
+  #         index (v)
+  return(base64.urlsafe_b64encode(
+    json.dumps(cursor, separators = (",", ":")).encode("UTF-8")
+  ).decode("ascii").rstrip("="))
+
+# function: decode_cursor -----------------------------------------------------
+def decode_cursor(token):
+  # the reverse of encode_cursor
+  # output: a dictionary, or None if the token is not a valid cursor
+  try:
+    cursor = json.loads(base64.urlsafe_b64decode(
+      token + "=" * (-len(token) % 4)
+    ).decode("UTF-8"))
+  except (binascii.Error, UnicodeDecodeError, ValueError):
+    return(None)
+  if not isinstance(cursor, dict) or \
+     not isinstance(cursor.get("q"), str) or \
+     not isinstance(cursor.get("c"), str) or \
+     type(cursor.get("o")) is not int or cursor["o"] < 0 or \
+     "v" not in cursor:
+    return(None)
+  return(cursor)
 
 if __name__ == "__main__":
+  preload()
   app.run() # threaded = False for the metapy implementation